@@ -0,0 +1,234 @@
+"""
+Synthetic load for billing_handler: generated billing messages go through the real handler with an
+in-memory aio_mysql and a ContentHelper stub, so only the Python side of the billing path is measured.
+
+    python -m billing_consumer_new.benchmarks.bench_billing_handler --batches 200 --batch-size 50
+
+With the local AES-SIV backend instead of the stub, plus 0.2 ms per record like the JVM calls:
+    python -m billing_consumer_new.benchmarks.bench_billing_handler --crypto local --crypto-record-latency-ms 0.2
+
+The memory of the first --alloc-batches batches is traced with tracemalloc:
+    allocated_bytes_per_record  bytes the handler allocated per record, peak traced size during the batch minus the size at its start
+    retained_blocks_per_record  memory blocks still allocated after the batch, per record (caches, leaks)
+    peak_kib_per_batch          highest traced size during a batch
+
+Checking a run against the committed baseline_billing_handler.json, exits with 1 on a regression:
+    python -m billing_consumer_new.benchmarks.bench_billing_handler --compare
+    python -m billing_consumer_new.benchmarks.bench_billing_handler --compare other_baseline.json --tolerance 0.15
+The timings depend on the machine, --save without a path refreshes the committed baseline with the default
+settings, run it on the machine that runs --compare and commit it with the change that moved the numbers.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import string
+import asyncio
+import argparse
+import platform
+import tracemalloc
+from types import SimpleNamespace
+from cryptography.hazmat.primitives.ciphers.aead import AESSIV
+from billing_consumer_new.billing_service.billing_handler import billing_handler
+from billing_consumer_new.helpers.crypto_backend import LocalCryptoBackend
+
+# the baseline of the default settings, --save and --compare without a path use it
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline_billing_handler.json")
+
+FIRST_NAMES = ["JESSE", "MARIA", "JOHN", "ANA", "ROBERT", "LINDA", "MICHAEL", "PATRICIA"]
+LAST_NAMES = ["ANASTASIO", "GARCIA", "SMITH", "JOHNSON", "WILLIAMS", "BROWN", "MARTINEZ", "O'CONNOR-HERNANDEZ"]
+STREETS = ["SOLOMONS ISLAND RD", "MAIN ST", "N BROADWAY AVE", "ELM", "HARBOR BLVD APT 12", "PO BOX 1223"]
+CITIES = [("EDGEWATER", "MD"), ("COSTA MESA", "CA"), ("AUSTIN", "TX"), ("ALLEN", "TX"), ("CHICAGO", "IL")]
+GENERATION_CODES = [None, None, None, "JR", "SR", "III"]
+
+
+def generate_address(rng: random.Random) -> dict:
+    city, state = rng.choice(CITIES)
+    return {
+        "line1": f"{rng.randint(1, 99999)} {rng.choice(STREETS)}",
+        "line2": None,
+        "city": city,
+        "state": state,
+        "zip_code": f"{rng.randint(10000, 99999)}{rng.choice(['', str(rng.randint(1000, 9999))])}",
+        "country": ""
+    }
+
+
+def generate_billing_message(rng: random.Random, idx: int) -> dict:
+    """ a billing message with 1 to 30 product codes and 0 to 2 previous addresses """
+    product_codes = [{"productCode": "0AGSVC1", "index": "999"}, {"productCode": f"PPC{rng.randint(0, 9999):04}", "index": "10"}]
+    product_codes.extend({"productCode": f"00{rng.randint(10, 99)}{rng.choice('ABCDEFGHXYZ')}{rng.choice('ABCDRX')}1", "index": "999"}
+                         for _ in range(rng.randint(0, 28)))
+    day = rng.randint(1, 28)
+    # MMDDYYYYHHMMSS in UTC followed by 9 letters
+    timestamp = f"{rng.randint(1, 12):02}{day:02}2024{rng.randint(0, 23):02}{rng.randint(0, 59):02}{rng.randint(0, 59):02}"
+    return {
+        "transaction_id": timestamp + "".join(rng.choice(string.ascii_uppercase) for _ in range(9)),
+        "product_codes": product_codes[rng.randint(0, 1):],
+        "solution_id": rng.choice(["AOOMFDAT", "AOOMPREQ", "AOXPLORE"]),
+        "subcode": f"{rng.randint(1000000, 9999999)}",
+        "client_id": "",
+        "arf_version": rng.choice(["07", "06"]),
+        "is_silent_launch_enabled": rng.random() < 0.1,
+        "applicant_pii": {
+            "name": {
+                "last_name": rng.choice(LAST_NAMES),
+                "first_name": rng.choice(FIRST_NAMES),
+                "middle_name": rng.choice(["", "A", "LEE"]),
+                "generation_code": rng.choice(GENERATION_CODES),
+                "prefix": None
+            },
+            "dob": f"{rng.randint(1, 12):02}-{day:02}-{rng.randint(1930, 2005)}",
+            "ssn": f"{rng.randint(100000000, 899999999)}",
+            "phone": None,
+            "current_address": generate_address(rng),
+            "previous_address": [generate_address(rng) for _ in range(rng.randint(0, 2))] or None,
+            "inquiry_address": generate_address(rng),
+            "epin": "9A50F1ECDEE98DF431"
+        }
+    }
+
+
+def generate_batches(seed: int, batches: int, batch_size: int) -> list:
+    rng = random.Random(seed)
+    return [
+        [SimpleNamespace(key=f"key-{idx}".encode("utf-8"), value=json.dumps(generate_billing_message(rng, idx)).encode("utf-8"))
+         for idx in range(batch * batch_size, (batch + 1) * batch_size)]
+        for batch in range(batches)
+    ]
+
+
+class InMemoryMySQL:
+    """ the aio_mysql.bulk_insert_data contract, the rows are only counted """
+
+    def __init__(self):
+        self.rows = 0
+
+    async def bulk_insert_data(self, table_1, columns_1, data_1, table_2, columns_2, data_2, mode=None):
+        self.rows += len(data_1) + len(data_2)
+        return [], []
+
+
+class StubContentHelper:
+    """ the ContentHelper batch API, returns the payloads as they are """
+
+    async def aetask_many(self, inps):
+        return list(inps), 0.0
+
+
+async def run_batches(batches: list, crypto_util, mysql) -> list:
+    latencies = []
+    for batch in batches:
+        st = time.perf_counter()
+        await billing_handler(batch, crypto_util, mysql)
+        latencies.append(time.perf_counter() - st)
+    return latencies
+
+
+def percentile(values: list, pct: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * pct / 100), len(ordered) - 1)]
+
+
+async def run(args) -> dict:
+    batches = generate_batches(args.seed, args.batches, args.batch_size)
+    records = args.batches * args.batch_size
+    mysql = InMemoryMySQL()
+    if args.crypto == "local":
+        # a key of the run, the ciphertexts are thrown away
+        crypto_util = LocalCryptoBackend(AESSIV.generate_key(512), latency_ms=args.crypto_latency_ms,
+                                         record_latency_ms=args.crypto_record_latency_ms)
+    else:
+        crypto_util = StubContentHelper()
+
+    await run_batches(batches[:max(args.batches // 10, 1)], crypto_util, mysql)
+    st = time.perf_counter()
+    latencies = await run_batches(batches, crypto_util, mysql)
+    elapsed = time.perf_counter() - st
+
+    # separate pass, tracemalloc slows the handler down
+    tracemalloc.start()
+    allocated_bytes = 0
+    retained_blocks = 0
+    peak = 0
+    for batch in batches[:args.alloc_batches]:
+        before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        start_size, _ = tracemalloc.get_traced_memory()
+        await billing_handler(batch, crypto_util, mysql)
+        _, batch_peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot()
+        # the memory the batch allocated on top of what was live when it started, at its high point
+        allocated_bytes += batch_peak - start_size
+        peak = max(peak, batch_peak)
+        retained_blocks += sum(stat.count_diff for stat in after.compare_to(before, "filename") if stat.count_diff > 0)
+    tracemalloc.stop()
+    if args.crypto == "local":
+        crypto_util.close()
+    alloc_records = min(args.alloc_batches, args.batches) * args.batch_size
+
+    return {
+        "python": platform.python_version(),
+        "seed": args.seed,
+        "batch_size": args.batch_size,
+        "crypto": args.crypto,
+        "records": records,
+        "records_per_sec": round(records / elapsed, 1),
+        "p50_batch_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p99_batch_ms": round(percentile(latencies, 99) * 1000, 3),
+        "allocated_bytes_per_record": round(allocated_bytes / alloc_records, 1),
+        "retained_blocks_per_record": round(retained_blocks / alloc_records, 2),
+        "peak_kib_per_batch": round(peak / 1024, 1)
+    }
+
+
+def compare(result: dict, baseline: dict, tolerance: float) -> list:
+    """ returns the metrics that regressed by more than tolerance """
+    regressions = []
+    if result["records_per_sec"] < baseline["records_per_sec"] * (1 - tolerance):
+        regressions.append("records_per_sec")
+    for metric in ("p50_batch_ms", "p99_batch_ms", "allocated_bytes_per_record"):
+        if metric in baseline and result[metric] > baseline[metric] * (1 + tolerance):
+            regressions.append(metric)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batches", type=int, default=200)
+    parser.add_argument("--batch-size", type=int, default=50, help="messages per getmany batch")
+    parser.add_argument("--alloc-batches", type=int, default=5, help="batches measured with tracemalloc")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--crypto", choices=["stub", "local"], default="stub", help="stub returns the payloads, local encrypts them")
+    parser.add_argument("--crypto-latency-ms", type=float, default=0.0, help="added to every local encryption call")
+    parser.add_argument("--crypto-record-latency-ms", type=float, default=0.0, help="added per record to the local encryption calls")
+    parser.add_argument("--save", nargs="?", const=BASELINE_PATH, default=None,
+                        help="write the result to this baseline file, the committed baseline without a path")
+    parser.add_argument("--compare", nargs="?", const=BASELINE_PATH, default=None,
+                        help="baseline file to check the result against, the committed baseline without a path")
+    parser.add_argument("--tolerance", type=float, default=0.15)
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    print(json.dumps(result, indent=4))
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(result, f, indent=4)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(result, baseline, args.tolerance)
+        for metric in ("records_per_sec", "p50_batch_ms", "p99_batch_ms", "allocated_bytes_per_record"):
+            if metric not in baseline:
+                continue
+            change = (result[metric] - baseline[metric]) / baseline[metric] * 100 if baseline[metric] else 0.0
+            print(f"{metric:>28} {baseline[metric]:>12} -> {result[metric]:>12} {change:>+7.1f}%{'  REGRESSION' if metric in regressions else ''}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Measures the rows/sec of the columnar sink per file format, the files are written to a temporary directory and not uploaded
+
+    python -m billing_consumer_new.benchmarks.bench_columnar_sink --rows 200000 --batch-size 500
+"""
+
+import os
+import time
+import shutil
+import asyncio
+import argparse
+import datetime
+import tempfile
+from billing_consumer_new.helpers import app_config
+from billing_consumer_new.helpers.columnar_sink import ColumnarSink, SINK_FORMATS, SINK_FORMAT_PARQUET, pyarrow
+from billing_consumer_new.billing_service.billing_message_processor import AlloutBillingRecord, ProductCodeRecord
+
+SOLUTION_IDS = ("GOCR", "GOXX", "SSKB", "ASCD")
+
+
+def make_rows(count: int) -> tuple:
+    """ allout rows and 3 product code rows per transaction, over 2 days and the solution ids """
+    allout_rows, product_code_rows = [], []
+    for idx in range(count):
+        transaction_id = f"10232024095207EP{idx:07d}"
+        inquiry_timestamp = datetime.datetime(2024, 10, 23 + idx % 2, 9, 52, 7)
+        solution_id = SOLUTION_IDS[idx % len(SOLUTION_IDS)]
+        allout_rows.append(AlloutBillingRecord(transaction_id, inquiry_timestamp, "x" * 600, False, solution_id, "2730590"))
+        for code in range(3):
+            product_code_rows.append(ProductCodeRecord(transaction_id, inquiry_timestamp, solution_id, "2730590", f"P{code}", "product", False))
+    return allout_rows, product_code_rows
+
+
+async def run_format(file_format: str, allout_rows: list, product_code_rows: list, batch_size: int) -> float:
+    directory = tempfile.mkdtemp(dir=app_config.APP_TEMP_DIR)
+    try:
+        sink = ColumnarSink(directory=directory, file_format=file_format, bucket="")
+        await sink.start()
+        st = time.perf_counter()
+        for idx in range(0, len(allout_rows), batch_size):
+            await sink.write(app_config.ALLOUT_BILLING_TABLE_NAME, app_config.ALLOUT_BILLING_TABLE_COLUMNS, allout_rows[idx:idx + batch_size])
+            await sink.write(app_config.PRODUCT_CODES_BILLING_TABLE_NAME, app_config.PRODUCT_CODES_BILLING_TABLE_COLUMNS,
+                             product_code_rows[idx * 3:(idx + batch_size) * 3])
+        await sink.stop()
+        elapsed = time.perf_counter() - st
+        size = sum(os.path.getsize(os.path.join(root, each)) for root, _, files in os.walk(directory) for each in files)
+        print(f"{file_format:>8} {(len(allout_rows) + len(product_code_rows)) / elapsed:>12,.0f} rows/sec {size / 1e6:>8.2f} MB on disk")
+        return elapsed
+    finally:
+        shutil.rmtree(directory)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=100000, help="transactions, each with an allout row and 3 product code rows")
+    parser.add_argument("--batch-size", type=int, default=500, help="transactions per write, like a consumer batch")
+    parser.add_argument("--formats", nargs="+", default=list(SINK_FORMATS), choices=SINK_FORMATS)
+    args = parser.parse_args()
+
+    allout_rows, product_code_rows = make_rows(args.rows)
+    for file_format in args.formats:
+        if file_format == SINK_FORMAT_PARQUET and pyarrow is None:
+            print(f"{file_format:>8} skipped, pyarrow is not installed")
+            continue
+        await run_format(file_format, allout_rows, product_code_rows, args.batch_size)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,75 @@
+"""
+Measures the encryption throughput of the crypto worker processes on its own
+
+Against the workers of a running billing consumer:
+    python -m billing_consumer_new.benchmarks.bench_crypto_workers --workers 2
+
+Starting the workers (needs CRYPTO_LJAR and the CRYPTO_* settings):
+    python -m billing_consumer_new.benchmarks.bench_crypto_workers --workers 2 --start-workers
+
+Starting workers with the local backend, no JVM nor key service:
+    CRYPTO_BACKEND=local CRYPTO_LOCAL_KEY=$(openssl rand -hex 64) CRYPTO_LOCAL_RECORD_LATENCY_MS=0.2 python -m billing_consumer_new.benchmarks.bench_crypto_workers --workers 2 --start-workers
+"""
+
+import time
+import asyncio
+import argparse
+from multiprocessing import Process
+from billing_consumer_new.helpers.crypto_workers import CryptoWorkerClient, crypto_worker_socket_paths, run_crypto_worker
+
+
+async def run(args, socket_paths):
+    client = CryptoWorkerClient(socket_paths)
+    # size of the json of a 785 characters billing record
+    payload = b'{"0": "' + b"G" * 785 + b'"}'
+    await client.aetask_many([payload])
+
+    for batch_size in args.batch_sizes:
+        batches = max(args.payloads // batch_size, 1)
+        queue = asyncio.Queue()
+        for _ in range(batches):
+            queue.put_nowait([payload] * batch_size)
+        crypto_time = 0.0
+
+        async def sender():
+            nonlocal crypto_time
+            while not queue.empty():
+                batch = queue.get_nowait()
+                _, elapsed = await client.aetask_many(batch)
+                crypto_time += elapsed
+
+        st = time.perf_counter()
+        await asyncio.gather(*[sender() for _ in range(args.concurrency)])
+        elapsed = time.perf_counter() - st
+        payloads = batches * batch_size
+        print(f"batch {batch_size:>4} {payloads / elapsed:>10,.0f} payloads/sec "
+              f"{elapsed / batches * 1000:>8.2f} ms/batch {crypto_time / payloads * 1000:>8.3f} ms JVM/payload")
+    client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--socket-dir", default="/tmp/")
+    parser.add_argument("--start-workers", action="store_true")
+    parser.add_argument("--payloads", type=int, default=5000)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument("--concurrency", type=int, default=4, help="requests in flight, e.g. consumers x processes")
+    args = parser.parse_args()
+
+    socket_paths = crypto_worker_socket_paths(args.workers, args.socket_dir)
+    workers = []
+    if args.start_workers:
+        workers = [Process(target=run_crypto_worker, args=(each,)) for each in socket_paths]
+        for each in workers:
+            each.start()
+    try:
+        asyncio.run(run(args, socket_paths))
+    finally:
+        for each in workers:
+            each.terminate()
+            each.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+"""
+Compares the decode modes of billing_decoder on recorded Kafka payloads
+
+With the sample message of the design notes:
+    python -m billing_consumer_new.benchmarks.bench_decoder
+
+With recorded payloads, one raw message value per line:
+    python -m billing_consumer_new.benchmarks.bench_decoder --payloads billing_messages.jsonl
+"""
+
+import os
+import time
+import json
+import argparse
+from billing_consumer_new.billing_service.billing_decoder import DECODE_MODES, decode_billing_message
+
+SAMPLE_MESSAGE = os.path.join(os.path.dirname(os.path.dirname(__file__)), "design_notes", "Sample_Kafka_Billing_Message.json")
+
+
+def load_payloads(path: str) -> list:
+    if path is None:
+        with open(SAMPLE_MESSAGE, "rb") as f:
+            # compact it like the producer does
+            return [json.dumps(json.loads(f.read()), separators=(",", ":")).encode("utf-8")]
+    with open(path, "rb") as f:
+        return [line.rstrip(b"\n") for line in f if line.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--payloads", default=None, help="file with one raw message value per line")
+    parser.add_argument("--records", type=int, default=50000, help="messages decoded per mode")
+    parser.add_argument("--modes", nargs="+", default=list(DECODE_MODES), choices=DECODE_MODES)
+    args = parser.parse_args()
+
+    payloads = load_payloads(args.payloads)
+    batch = [payloads[idx % len(payloads)] for idx in range(args.records)]
+    results = {}
+    for mode in args.modes:
+        for each in payloads:
+            decode_billing_message(each, mode)
+        st = time.perf_counter()
+        for each in batch:
+            decode_billing_message(each, mode)
+        results[mode] = (time.perf_counter() - st) / len(batch)
+
+    baseline = results.get(args.modes[0])
+    for mode, elapsed in results.items():
+        print(f"{mode:>8} {elapsed * 1e6:>8.2f} us/message {1 / elapsed:>12,.0f} messages/sec {baseline / elapsed:>6.2f}x")
+
+
+if __name__ == "__main__":
+    main()
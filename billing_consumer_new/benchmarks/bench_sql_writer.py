@@ -0,0 +1,110 @@
+"""
+Compares the rows/sec of the bulk_insert_data write modes against a local MySQL container
+
+    docker run -d --name billing-mysql -p 3306:3306 -e MYSQL_ROOT_PASSWORD=bench \
+        -e MYSQL_DATABASE=billing_bench mysql:8.0 --local-infile=1
+
+    MYSQL_LOCAL_INFILE=true python -m billing_consumer_new.benchmarks.bench_sql_writer --rows 20000
+"""
+
+import os
+import time
+import asyncio
+import argparse
+import datetime
+from billing_consumer_new.helpers import app_config
+from billing_consumer_new.helpers.sql_util import aio_mysql, WRITE_MODES
+
+ALLOUT_TABLE = "bench_bc_billing"
+PRODUCT_CODES_TABLE = "bench_bc_product_codes_info"
+
+CREATE_TABLES = [
+    f"""CREATE TABLE IF NOT EXISTS {ALLOUT_TABLE} (
+        transaction_id VARCHAR(23) NOT NULL PRIMARY KEY,
+        inquiry_timestamp DATETIME NOT NULL,
+        billing_record TEXT NOT NULL,
+        silent_launch TINYINT(1),
+        solution_id VARCHAR(32),
+        subcode VARCHAR(16))""",
+    f"""CREATE TABLE IF NOT EXISTS {PRODUCT_CODES_TABLE} (
+        transaction_id VARCHAR(23) NOT NULL,
+        inquiry_timestamp DATETIME NOT NULL,
+        solution_id VARCHAR(32),
+        subcode VARCHAR(16),
+        product_code VARCHAR(16) NOT NULL,
+        product_code_type VARCHAR(16),
+        silent_launch TINYINT(1),
+        PRIMARY KEY (transaction_id, product_code))"""
+]
+
+
+def make_rows(count: int, product_codes_per_transaction: int):
+    inquiry_timestamp = datetime.datetime(2024, 10, 23, 9, 52, 7)
+    allout_rows = []
+    product_code_rows = []
+    for idx in range(count):
+        transaction_id = f"10232024095207{idx:09d}"
+        # size of a base64 encoded, encrypted 785 characters billing record
+        allout_rows.append((transaction_id, inquiry_timestamp, "SEncr:" + "A" * 1100, False, "AOOMFDAT", "2344867"))
+        for code in range(product_codes_per_transaction):
+            product_code_rows.append((transaction_id, inquiry_timestamp, "AOOMFDAT", "2344867", f"{code:07d}",
+                                      "base" if code == 0 else "optional", False))
+    return allout_rows, product_code_rows
+
+
+async def run(args):
+    mysql = aio_mysql(secret_json={
+        "host": args.host,
+        "port": args.port,
+        "username": args.user,
+        "password": args.password
+    })
+    app_config.ANALYTICS_RDS_DATABASE_SCHEMA = args.database
+    await mysql.connect(size=2)
+    async with mysql.connection_pool.acquire() as connection:
+        async with connection.cursor() as cursor:
+            for statement in CREATE_TABLES:
+                await cursor.execute(statement)
+        await connection.commit()
+
+    allout_rows, product_code_rows = make_rows(args.rows, args.product_codes)
+    total_rows = len(allout_rows) + len(product_code_rows)
+    print(f"{args.rows} transactions, {total_rows} rows, chunk budget {app_config.MYSQL_CHUNK_BYTES} bytes")
+    for mode in args.modes:
+        async with mysql.connection_pool.acquire() as connection:
+            async with connection.cursor() as cursor:
+                await cursor.execute(f"TRUNCATE TABLE {ALLOUT_TABLE}")
+                await cursor.execute(f"TRUNCATE TABLE {PRODUCT_CODES_TABLE}")
+            await connection.commit()
+
+        st = time.perf_counter()
+        for start in range(0, len(allout_rows), args.batch):
+            end = start + args.batch
+            await mysql.bulk_insert_data(
+                ALLOUT_TABLE, app_config.ALLOUT_BILLING_TABLE_COLUMNS, allout_rows[start:end],
+                PRODUCT_CODES_TABLE, app_config.PRODUCT_CODES_BILLING_TABLE_COLUMNS,
+                product_code_rows[start * args.product_codes:end * args.product_codes], mode=mode)
+        elapsed = time.perf_counter() - st
+        print(f"{mode:<12} {total_rows / elapsed:>12,.0f} rows/sec {elapsed:>8.2f} s")
+
+    mysql.connection_pool.close()
+    await mysql.connection_pool.wait_closed()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default=os.getenv("BENCH_MYSQL_HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("BENCH_MYSQL_PORT", "3306")))
+    parser.add_argument("--user", default=os.getenv("BENCH_MYSQL_USER", "root"))
+    parser.add_argument("--password", default=os.getenv("BENCH_MYSQL_PASSWORD", "bench"))
+    parser.add_argument("--database", default=os.getenv("BENCH_MYSQL_DATABASE", "billing_bench"))
+    parser.add_argument("--rows", type=int, default=10000, help="number of transactions")
+    parser.add_argument("--product-codes", type=int, default=5, help="product codes per transaction")
+    parser.add_argument("--batch", type=int, default=app_config.NUMBER_OF_MSG_HANDLERS,
+                        help="transactions per bulk_insert_data call, 50 is a poll batch, use a large value for backfills")
+    parser.add_argument("--modes", nargs="+", default=list(WRITE_MODES), choices=WRITE_MODES)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -3,24 +3,44 @@
 
 import copy
 from billing_consumer_new.helpers.app_logger import custom_logger as logger
+from billing_consumer_new.billing_service.record_layout import Field, FixedWidthLayout, fit
 from ascendops_commonlib.models.billing_message import ApplicantPII
 
 
+CONSUMER_NAME_LAYOUT = FixedWidthLayout([
+    Field("last_name", 32),
+    Field("second_last_name", 32),
+    Field("first_name", 32),
+    Field("middle_name", 32),
+    Field("generation_code", 1)
+], length=129)
+
+ADDRESS_LAYOUT = FixedWidthLayout([
+    Field("street_number", 10),
+    Field("street_name", 32),
+    Field("street_suffix", 4),
+    Field("city", 32),
+    Field("state", 2),
+    Field("unit_id", 8),
+    Field("zip_code", 9)
+], length=97)
+
+
 async def process_applicant_pii(applicant_pii: ApplicantPII, transaction_id: str):
     processed_applicant_pii = {}
     try:
-        processed_applicant_pii["ssn"] = await add_padding_spaces(getattr(applicant_pii, "ssn", ""), 9, transaction_id)
-        processed_applicant_pii["year_of_birth"] = await add_padding_spaces(await get_yob(getattr(applicant_pii, "dob", "")), 4, transaction_id)
-        processed_applicant_pii["consumer_name"] = await create_consumer_name(applicant_pii, transaction_id)
-        processed_applicant_pii["current_address"] = await create_address(getattr(applicant_pii, "inquiry_address", ""), transaction_id)
+        processed_applicant_pii["ssn"] = fit(getattr(applicant_pii, "ssn", ""), 9)
+        processed_applicant_pii["year_of_birth"] = fit(get_yob(getattr(applicant_pii, "dob", "")), 4)
+        processed_applicant_pii["consumer_name"] = create_consumer_name(applicant_pii, transaction_id)
+        processed_applicant_pii["current_address"] = create_address(getattr(applicant_pii, "inquiry_address", ""), transaction_id)
         applicant_previous_addresses = getattr(applicant_pii, "previous_address", [""])
         previous_addresses = copy.deepcopy(applicant_previous_addresses)
         if not previous_addresses:
             previous_addresses = ["",""]
         elif len(previous_addresses) == 1:
             previous_addresses.append("")
-        processed_applicant_pii["1st_previous_address"] = await create_address(previous_addresses[0], transaction_id)
-        processed_applicant_pii["2nd_previous_address"] = await create_address(previous_addresses[1], transaction_id)
+        processed_applicant_pii["1st_previous_address"] = create_address(previous_addresses[0], transaction_id)
+        processed_applicant_pii["2nd_previous_address"] = create_address(previous_addresses[1], transaction_id)
     except Exception as xcp:
         logger.log_message(
             message=f"Error in processing applicant PII: {str(xcp)}",
@@ -30,7 +50,7 @@ async def process_applicant_pii(applicant_pii: ApplicantPII, transaction_id: str
     return processed_applicant_pii
 
 
-async def get_yob(dob: str):
+def get_yob(dob: str):
     """ return year of birth or empty """
     if dob and len(dob)>3:
         return dob[-4:]
@@ -38,7 +58,7 @@ async def get_yob(dob: str):
         return ""
 
 
-async def get_generation_code(generation_code: str):
+def get_generation_code(generation_code: str):
     """
     Generation Code           1
             J= Junior
@@ -54,7 +74,7 @@ async def get_generation_code(generation_code: str):
     return gen_code
 
 
-async def create_consumer_name(applicant_pii: ApplicantPII, transaction_id: str):
+def create_consumer_name(applicant_pii: ApplicantPII, transaction_id: str):
     """
     Consumer Name                129
         Last Name                 32
@@ -71,13 +91,13 @@ async def create_consumer_name(applicant_pii: ApplicantPII, transaction_id: str)
     consumer_name = ""
     try:
         applicant_name_details = getattr(applicant_pii, "name", "")
-        last_name =  await add_padding_spaces(getattr(applicant_name_details, "last_name", ""), 32, transaction_id)
-        second_last_name = await add_padding_spaces(getattr(applicant_name_details, "second_last_name", ""), 32, transaction_id)
-        first_name = await add_padding_spaces(getattr(applicant_name_details, "first_name", ""), 32, transaction_id)
-        middle_name = await add_padding_spaces(getattr(applicant_name_details, "middle_name", ""), 32, transaction_id)
-        generation_code = await add_padding_spaces(await get_generation_code(getattr(applicant_name_details, "generation_code", "")), 1, transaction_id)
-        
-        consumer_name = last_name + second_last_name + first_name + middle_name + generation_code
+        consumer_name = CONSUMER_NAME_LAYOUT.format({
+            "last_name": getattr(applicant_name_details, "last_name", ""),
+            "second_last_name": getattr(applicant_name_details, "second_last_name", ""),
+            "first_name": getattr(applicant_name_details, "first_name", ""),
+            "middle_name": getattr(applicant_name_details, "middle_name", ""),
+            "generation_code": get_generation_code(getattr(applicant_name_details, "generation_code", ""))
+        })
 
     except Exception as xcp:
         logger.log_message(
@@ -113,7 +133,7 @@ def get_street_number_and_name(street_address: str, transaction_id: str):
     return st_number, st_name
 
 
-async def create_address(address: str, transaction_id: str):
+def create_address(address: str, transaction_id: str):
     """
     SAME FORMAT FOR CURRENT ADDRESS, 1ST PREVIOUS ADDRESS AND 2ND PREVIOUS ADDRESS
         field 	            length
@@ -140,14 +160,15 @@ async def create_address(address: str, transaction_id: str):
         if line2:
             street_address+=line2
         st_number,st_name = get_street_number_and_name(street_address, transaction_id)
-        street_number = await add_padding_spaces(st_number, 10, transaction_id)
-        street_name = await add_padding_spaces(st_name, 32, transaction_id)
-        street_suffix = await add_padding_spaces(getattr(address, "street_suffix", ""), 4, transaction_id)
-        city_name = await add_padding_spaces(getattr(address, "city", ""), 32, transaction_id)
-        state_code = await add_padding_spaces(getattr(address, "state", ""), 2, transaction_id)
-        unit_id = await add_padding_spaces(getattr(address, "unit_id", ""), 8, transaction_id)
-        zip_code = await add_padding_spaces(getattr(address, "zip_code", ""), 9, transaction_id)
-        formatted_address = street_number + street_name + street_suffix + city_name + state_code + unit_id + zip_code
+        formatted_address = ADDRESS_LAYOUT.format({
+            "street_number": st_number,
+            "street_name": st_name,
+            "street_suffix": getattr(address, "street_suffix", ""),
+            "city": getattr(address, "city", ""),
+            "state": getattr(address, "state", ""),
+            "unit_id": getattr(address, "unit_id", ""),
+            "zip_code": getattr(address, "zip_code", "")
+        })
 
     except Exception as xcp:
         logger.log_message(
@@ -157,21 +178,3 @@ async def create_address(address: str, transaction_id: str):
         )
     return formatted_address
 
-
-async def add_padding_spaces(data_string: str, required_length: int, transaction_id: str):
-    try:
-        if data_string is None:
-            data_string = ""
-        data_string = str(data_string)
-        if len(data_string) <= required_length:
-            data_string += " " * (required_length - len(data_string))
-        else:
-            data_string = data_string[:required_length]
-        
-    except Exception as xcp:
-        logger.log_message(
-            message=f"Error in adding the padding spaces: {str(xcp)}",
-            transaction_id=transaction_id,
-            level="ERROR"
-        )
-    return str(data_string) if data_string else ""        
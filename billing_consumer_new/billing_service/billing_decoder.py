@@ -0,0 +1,51 @@
+""" This module contains the decoding of the raw Kafka billing messages """
+
+import json
+from typing import List, Optional
+from pydantic import BaseModel
+from billing_consumer_new.helpers import app_config
+from ascendops_commonlib.models.billing_message import Address, BillingCodes, BillingMessage, Name
+
+# Decode modes
+DECODE_MODE_LEGACY = "legacy"  # json.loads of the decoded str, then BillingMessage.model_validate of the dict
+DECODE_MODE_JSON = "json"      # BillingMessage.model_validate_json straight from the raw bytes
+DECODE_MODE_LAZY = "lazy"      # BillingRecordMessage.model_validate_json, only the fields the billing record needs
+DECODE_MODES = (DECODE_MODE_LEGACY, DECODE_MODE_JSON, DECODE_MODE_LAZY)
+
+
+class BillingRecordApplicantPII(BaseModel):
+    """ The applicant PII fields written to the billing record """
+    name: Name | None = None
+    dob: str | None = None
+    ssn: str | None = None
+    inquiry_address: Address | None = None
+    previous_address: List[Address] | None = None
+
+
+class BillingRecordMessage(BaseModel):
+    """
+    The BillingMessage fields needed for the billing records, the other fields
+    (client_id, end_date, phone, employment ...) are skipped by the parser instead of being materialized.
+    The skipped fields are not validated either, a message with a malformed phone is billed in lazy mode
+    """
+    transaction_id: str
+    solution_id: str
+    subcode: str
+    arf_version: str
+    is_silent_launch_enabled: Optional[bool] = False
+    product_codes: List[BillingCodes]
+    applicant_pii: BillingRecordApplicantPII | None = None
+
+
+def decode_billing_message(raw: bytes, mode: str = app_config.BILLING_DECODE_MODE):
+    """
+    Decodes and validates a raw Kafka message value
+    Raises:
+        ValueError: the message is not valid JSON or does not match the schema, a ValidationError with json and lazy,
+            a JSONDecodeError or UnicodeDecodeError for invalid JSON with legacy
+    """
+    if mode == DECODE_MODE_LAZY:
+        return BillingRecordMessage.model_validate_json(raw)
+    if mode == DECODE_MODE_JSON:
+        return BillingMessage.model_validate_json(raw)
+    return BillingMessage.model_validate(json.loads(raw.decode("utf-8")))
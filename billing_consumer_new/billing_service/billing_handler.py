@@ -1,174 +1,234 @@
 
 """ This module contains the billing handler from which the processing of the billing messages starts """
 
-import json
-from pydantic import ValidationError
-from billing_consumer_new.helpers import app_config
+import time
+from typing import NamedTuple
+from billing_consumer_new.helpers import app_config, metrics
 from billing_consumer_new.helpers.app_logger import custom_logger as logger
 from billing_consumer_new.helpers.sql_util import aio_mysql
 from billing_consumer_new.helpers.crypto_util import ContentHelper
+from billing_consumer_new.helpers.dedup_index import TransactionDedupIndex
 from ascendops_commonlib.models.billing_message import BillingMessage
-from billing_consumer_new.billing_service import applicant_pii_processor, billing_message_processor
+from billing_consumer_new.billing_service import applicant_pii_processor, billing_message_processor, billing_decoder
+from billing_consumer_new.billing_service.transaction_timestamps import TransactionTimestamps
 
 
-async def billing_handler(messages, crypto_util: ContentHelper, mysql: aio_mysql):
+class BillingFailure(NamedTuple):
+    """ a Kafka message that was not written to RDS """
+    message: object
+    stage: str
+    error: str
+    # False when the message would fail the same way again, e.g. a schema violation
+    retryable: bool
+
+
+class BillingBatch:
+    """ A poll batch and the output of each billing step, used to tell which messages were not written """
+
+    def __init__(self, messages):
+        self.messages = messages
+        self.stage = "decode"
+        self.failures = []
+        self.records = {}
+        self.billing_messages = []
+        self.processed_messages = []
+        self.billing_records = ([], [], [])
+        self.timestamps = TransactionTimestamps()
+
+    @property
+    def transactions(self) -> list:
+        return self.billing_records[2]
+
+    def set_decoded(self, billing_messages: list):
+        """ maps the transactions back to their Kafka message, decode keeps the order of the valid messages """
+        failed = {id(each.message) for each in self.failures}
+        valid_messages = [each for each in self.messages if id(each) not in failed]
+        self.records = {billing_message.transaction_id: message for message, (_, billing_message) in zip(valid_messages, billing_messages)}
+        self.billing_messages = billing_messages
+
+    def set_written(self, rejected_records: tuple):
+        """ the messages that did not make it through format, encrypt or write are failures """
+        processed = {billing_message.transaction_id for _, billing_message, _, _ in self.processed_messages}
+        encrypted = set(self.transactions)
+        rejected = {each[0] for records in rejected_records for each in records}
+        for transaction_id in dict.fromkeys(billing_message.transaction_id for _, billing_message in self.billing_messages):
+            message = self.records[transaction_id]
+            if transaction_id not in processed:
+                self.failures.append(BillingFailure(message, "format", "the billing record could not be created", False))
+            elif transaction_id not in encrypted:
+                self.failures.append(BillingFailure(message, "encrypt", "the billing record could not be encrypted", True))
+            elif transaction_id[0:23] in rejected:
+                self.failures.append(BillingFailure(message, "write", "the billing records were rejected by RDS", True))
+
+    def fail_pending(self, error: str):
+        """ the step in progress raised, every message not failed yet is to be retried """
+        if self.stage == "decode":
+            failed = {id(each.message) for each in self.failures}
+            pending = [each for each in self.messages if id(each) not in failed]
+        else:
+            pending = [self.records[transaction_id] for transaction_id in dict.fromkeys(billing_message.transaction_id for _, billing_message in self.billing_messages)]
+        self.failures.extend(BillingFailure(message, self.stage, error, True) for message in pending)
+
+
+async def billing_handler(messages, crypto_util: ContentHelper, mysql: aio_mysql, dedup_index: TransactionDedupIndex = None):
+    """ Runs the billing steps on a poll batch, returns the BillingFailure of the messages that were not written """
+    batch = BillingBatch(messages)
+    try:
+        batch.set_decoded(decode_billing_messages(messages, batch.failures))
+        batch.billing_messages = await drop_duplicate_messages(batch.billing_messages, dedup_index)
+        batch.stage = "format"
+        batch.processed_messages = await format_billing_messages(batch.billing_messages, batch.timestamps)
+        batch.stage = "encrypt"
+        batch.billing_records = await encrypt_billing_messages(batch.processed_messages, crypto_util, batch.timestamps)
+        batch.stage = "write"
+        batch.set_written(await write_billing_records(batch.billing_records, mysql, dedup_index))
+    except Exception as xcp:
+        logger.log_message(
+            message=f"Error in the main billing handler: {str(xcp)}",
+            level="ERROR"
+        )
+        batch.fail_pending(str(xcp))
+    return batch.failures
+
+
+def decode_billing_messages(messages, failures: list = None):
+    """
+    Step 1: Do the schema validation, returns the (message_key, billing_message) of the valid messages
+    The invalid messages are added to failures
+    """
+    st = time.perf_counter()
+    billing_messages = []
+    for each in messages:
+        message_key = each.key
+        try:
+            billing_message: BillingMessage = billing_decoder.decode_billing_message(each.value)
+        except ValueError as xcp:
+            # ValidationError, or invalid JSON in legacy mode, fails this message only
+            metrics.VALIDATION_FAILURES.inc()
+            if failures is not None:
+                failures.append(BillingFailure(each, "decode", str(xcp), False))
+            logger.log_message(
+                message=f"Schema Validation Error: {str(xcp)}",
+                transaction_id=message_key,
+                level="WARNING"
+            )
+            continue
+        billing_messages.append((message_key, billing_message))
+    metrics.STAGE_LATENCY.observe(time.perf_counter() - st, stage="decode")
+    return billing_messages
+
+
+async def drop_duplicate_messages(billing_messages: list, dedup_index: TransactionDedupIndex):
+    """ Skips the transactions already written to RDS and the repeats within the batch, before any formatting or encryption """
+    if dedup_index is None or not billing_messages:
+        return billing_messages
+    duplicates = await dedup_index.find_duplicates([billing_message.transaction_id[0:23] for _, billing_message in billing_messages])
+    new_messages = []
+    skipped = []
+    for message_key, billing_message in billing_messages:
+        transaction_id = billing_message.transaction_id[0:23]
+        if transaction_id in duplicates:
+            skipped.append(transaction_id)
+            continue
+        duplicates.add(transaction_id)
+        new_messages.append((message_key, billing_message))
+    if skipped:
+        logger.log_message(
+            message="Skipped the redelivered transactions: %s",
+            level="INFO",
+            args=(skipped,),
+            event="redelivered"
+        )
+    return new_messages
+
+
+async def format_billing_messages(billing_messages: list, timestamps: TransactionTimestamps = None):
+    """
+    Step 2: Process the consumer_pii
+    Step 3: Create the raw billing payload and the product code records based on the billing data
+    """
+    if timestamps is None:
+        timestamps = TransactionTimestamps()
+    processed_messages = []
+    pii_time, format_time = 0.0, 0.0
+    for message_key, billing_message in billing_messages:
+        st = time.perf_counter()
+        applicant_pii: dict = await applicant_pii_processor.process_applicant_pii(billing_message.applicant_pii, billing_message.transaction_id)
+        pii_done = time.perf_counter()
+
+        billing_payload, product_code_records = await billing_message_processor.process_billing_message(billing_message, applicant_pii, timestamps)
+        pii_time += pii_done - st
+        format_time += time.perf_counter() - pii_done
+
+        if billing_payload and product_code_records:
+            processed_messages.append((message_key, billing_message, billing_payload, product_code_records))
+        else:
+            # Log the transaction ID
+            logger.log_message(
+                message=f"Failure in the creation of billing records for transaction: {billing_message.transaction_id}",
+                transaction_id=message_key,
+                level="INFO"
+            )
+    metrics.STAGE_LATENCY.observe(pii_time, stage="pii")
+    metrics.STAGE_LATENCY.observe(format_time, stage="format")
+    return processed_messages
+
+
+async def encrypt_billing_messages(processed_messages: list, crypto_util: ContentHelper, timestamps: TransactionTimestamps = None):
+    """
+    Step 4: Encrypt the billing payloads of the whole batch in one call
+    Step 5: Append to the ops billing records
+    """
+    if timestamps is None:
+        timestamps = TransactionTimestamps()
     allout_billing_records = []
     dashboard_billing_records = []
     transactions = []
-    try:
-        for each in messages:
-            # Step 1: Do the schema validation
-            message_key = each.key
-            try:
-                billing_message = json.loads(each.value.decode("utf-8"))
-                billing_message: BillingMessage  = BillingMessage.model_validate(billing_message)
-            except ValidationError as xcp:
-                logger.log_message(
-                    message=f"Schema Validation Error: {str(xcp)}",
-                    transaction_id=message_key,
-                    level="WARNING"
-                )
-                continue
-            
-            # Step 2: Process the consumer_pii
-            applicant_pii: dict = await applicant_pii_processor.process_applicant_pii(billing_message.applicant_pii, billing_message.transaction_id)
-
-            # Step 3: Create RDS billing records based on the billing data        
-            billing_record, product_code_records = await billing_message_processor.process_billing_message(billing_message, applicant_pii, crypto_util)
-
-            if billing_record and product_code_records:
-                # Step 4: Append to the ops billing records
-                allout_billing_records.append(billing_record)
-                dashboard_billing_records.extend(product_code_records)
-                transactions.append(billing_message.transaction_id)
-            else:
-                # Log the transaction ID
-                logger.log_message(
-                    message=f"Failure in the creation of billing records for transaction: {billing_message.transaction_id}",
-                    transaction_id=message_key,
-                    level="INFO"
-                )
-        
-        if allout_billing_records and dashboard_billing_records:
-            # Write all the message to RDS
-            await mysql.bulk_insert_data(app_config.ALLOUT_BILLING_TABLE_NAME, app_config.ALLOUT_BILLING_TABLE_COLUMNS, allout_billing_records, 
-                                         app_config.PRODUCT_CODES_BILLING_TABLE_NAME, app_config.PRODUCT_CODES_BILLING_TABLE_COLUMNS, dashboard_billing_records)
+    st = time.perf_counter()
+    encrypted_billing_records = await billing_message_processor.encrypt_billing_records(
+        [billing_payload for _, _, billing_payload, _ in processed_messages], crypto_util)
+    metrics.STAGE_LATENCY.observe(time.perf_counter() - st, stage="encrypt")
+
+    for (message_key, billing_message, _, product_code_records), encrypted_billing_record in zip(processed_messages, encrypted_billing_records):
+        if encrypted_billing_record:
+            allout_billing_records.append(billing_message_processor.create_allout_billing_record(billing_message, encrypted_billing_record, timestamps))
+            dashboard_billing_records.extend(product_code_records)
+            transactions.append(billing_message.transaction_id)
+        else:
             logger.log_message(
-                message=f"Transactions successfully processed: {transactions}",
+                message=f"Failure in the creation of billing records for transaction: {billing_message.transaction_id}",
+                transaction_id=message_key,
                 level="INFO"
             )
-    except Exception as xcp:
+    return allout_billing_records, dashboard_billing_records, transactions
+
+
+async def write_billing_records(billing_records: tuple, mysql: aio_mysql, dedup_index: TransactionDedupIndex = None):
+    """
+    Step 6: Write all the message to RDS, returns the rejected allout and product code records
+    The written transactions are added to the dedup index
+    """
+    allout_billing_records, dashboard_billing_records, transactions = billing_records
+    rejected_allout_records, rejected_product_code_records = [], []
+    if allout_billing_records and dashboard_billing_records:
+        st = time.perf_counter()
+        rejected_allout_records, rejected_product_code_records = await mysql.bulk_insert_data(
+            app_config.ALLOUT_BILLING_TABLE_NAME, app_config.ALLOUT_BILLING_TABLE_COLUMNS, allout_billing_records, 
+            app_config.PRODUCT_CODES_BILLING_TABLE_NAME, app_config.PRODUCT_CODES_BILLING_TABLE_COLUMNS, dashboard_billing_records)
+        metrics.STAGE_LATENCY.observe(time.perf_counter() - st, stage="db_insert")
+        rejected_transactions = {each[0] for each in rejected_allout_records} | {each[0] for each in rejected_product_code_records}
+        if rejected_transactions:
+            logger.log_message(
+                message=f"Transactions rejected by RDS: {sorted(rejected_transactions)}",
+                level="ERROR"
+            )
+        written_transactions = [each for each in transactions if each[0:23] not in rejected_transactions]
+        if dedup_index is not None:
+            dedup_index.mark(each[0:23] for each in written_transactions)
         logger.log_message(
-            message=f"Error in the main billing handler: {str(xcp)}",
-            level="ERROR"
+            message="Transactions successfully processed: %s",
+            level="INFO",
+            args=(written_transactions,),
+            event="batch_written"
         )
-    
-
-
-
-
-"""
-import asyncio
-
-if __name__ == "__main__":    
-    # logger = CustomLogger("billing-consumer")
-    # mysql = aio_mysql(logger.logger)
-    # mysql.connect(size=4)
-    # crypto_util = ContentHelper(app_config.CRYPTO_LJAR, app_config.CRYPTO_ENV, 
-    #                             app_config.CRYPTO_ENV_PREFIX, app_config.CRYPTO_AWS_PROFILE, 
-    #                             instances = app_config.CRYPTO_INSTANCES)
-    asyncio.run(billing_handler(logger=None, crypto_util=None, messages=None, mysql=None))
-
-        messages = [
-            {
-                "transaction_id": "10232024095207EPUJQINUP",
-                "product_codes": [
-                    {
-                        "productCode": "0AGSVC1",
-                        "index": "999"
-                    },
-                    {
-                        "productCode": "PPC0001",
-                        "index": "10"
-                    },
-                    {
-                        "productCode": "0040BX1",
-                        "index": "999"
-                    },
-                    {
-                        "productCode": "0040FR1",
-                        "index": "999"
-                    },
-                    {
-                        "productCode": "1234567",
-                        "index": "999"
-                    },
-                    {
-                        "productCode": "2345678",
-                        "index": "999"
-                    },
-                    {
-                        "productCode": "3456789",
-                        "index": "999"
-                    },
-                    {
-                        "productCode": "4567890",
-                        "index": "999"
-                    },
-                    {
-                        "productCode": "ABCDEFG",
-                        "index": "999"
-                    },
-                    {
-                        "productCode": "BCDEFGH",
-                        "index": "999"
-                    },
-                    {
-                        "productCode": "CDEFGHI",
-                        "index": "999"
-                    }
-                ],
-                "solution_id": "AOOMFDAT",
-                "subcode": "2344867",
-                "client_id": "",
-                "inquiry_date": "10232024",
-                "inquiry_time": "095207",
-                "arf_version": "07",
-                "applicant_pii": {
-                    "name": {
-                        "last_name": "ANASTASIO",
-                        "first_name": "JESSE",
-                        "middle_name": "",
-                        "generation_code": None,
-                        "prefix": None
-                    },
-                    "dob": "",
-                    "ssn": "666131472",
-                    "ein": None,
-                    "tin": None,
-                    "driverslicense": None,
-                    "secondary_id": None,
-                    "phone": None,
-                    "email_id": None,
-                    "employment": None,
-                    "current_address": {
-                        "line1": "2752 SOLOMONS ISLAND RD",
-                        "line2": None,
-                        "city": "EDGEWATER",
-                        "state": "MD",
-                        "zip_code": "210371211",
-                        "country": ""
-                    },
-                    "previous_address": None,
-                    "inquiry_address": {
-                        "line1": "2752 SOLOMONS ISLAND RD",
-                        "line2": None,
-                        "city": "EDGEWATER",
-                        "state": "MD",
-                        "zip_code": "210371211",
-                        "country": ""
-                    }
-                }
-            }
-        ]
-"""
\ No newline at end of file
+    return rejected_allout_records, rejected_product_code_records
\ No newline at end of file
@@ -1,93 +1,141 @@
 
 """ This module contains the code to process the billing message """
 
+import sys
 import json
+import asyncio
 import base64
-from datetime import datetime, timedelta
-from zoneinfo import ZoneInfo
-from billing_consumer_new.helpers import app_config
+from datetime import datetime
+from typing import NamedTuple
+from billing_consumer_new.helpers import app_config, metrics
 from billing_consumer_new.helpers.app_logger import custom_logger as logger
 from billing_consumer_new.helpers.crypto_util import ContentHelper
+from billing_consumer_new.billing_service.transaction_timestamps import TransactionTimestamps
+from billing_consumer_new.billing_service.record_layout import EXACT, PAD_STRICT, Field, FixedWidthLayout, constant, spaces
 from ascendops_commonlib.models.billing_message import BillingMessage
 
 
-async def process_billing_message(billing_message: BillingMessage, applicant_pii: dict, crypto_util: ContentHelper):  
-    allout_billing_record = ""
+# 39 characters prefix + 746 characters billing record = 785
+BILLING_RECORD_LAYOUT = FixedWidthLayout([
+    constant("GCRGOINQ   00", 39),
+    constant("B"),
+    constant("1.00"),
+    Field("transaction_id", 23, EXACT),
+    constant("GOINQ", 8),
+    spaces(8),
+    spaces(8),
+    Field("inquiry_date", 8, EXACT),
+    Field("inquiry_time", 8, EXACT),
+    constant(app_config.OPS_SUB_SYSTEM_NAME),
+    Field("product_codes", 70, PAD_STRICT),
+    spaces(50),
+    Field("subcode", 7, EXACT),
+    spaces(4),
+    spaces(4),
+    Field("arf_version", 2, EXACT),
+    spaces(53),
+    Field("ssn", 9, EXACT),
+    Field("year_of_birth", 4, EXACT),
+    Field("consumer_name", 129, EXACT),
+    Field("current_address", 97, EXACT),
+    Field("1st_previous_address", 97, EXACT),
+    Field("2nd_previous_address", 97, EXACT),
+    Field("continuation_flag", 1, EXACT),
+    constant(app_config.OPS_CALLING_SUB_SYSTEM_NAME),
+    spaces(46)
+], length=app_config.BILLING_RECORD_LENGTH)
+
+
+class AlloutBillingRecord(NamedTuple):
+    """ a row of the allout billing table, in the order of ALLOUT_BILLING_TABLE_COLUMNS """
+    transaction_id: str
+    inquiry_timestamp: datetime
+    billing_record: str
+    silent_launch: bool
+    solution_id: str
+    subcode: str
+
+
+class ProductCodeRecord(NamedTuple):
+    """ a row of the product codes billing table, in the order of PRODUCT_CODES_BILLING_TABLE_COLUMNS """
+    transaction_id: str
+    inquiry_timestamp: datetime
+    solution_id: str
+    subcode: str
+    product_code: str
+    product_code_type: str
+    silent_launch: bool
+
+
+# a billing record holds 10 product codes, a transaction at most 3 billing records
+PRODUCT_CODES_PER_RECORD = 10
+MAX_PRODUCT_CODES = 30
+BASE_PRODUCT_CODE_INDEX = "10"
+
+
+def intern(value):
+    """ the few distinct solution ids, subcodes and product codes are shared by all the rows that repeat them """
+    return sys.intern(value) if type(value) is str else value
+
+
+def expand_product_codes(product_codes: list, transaction_id: str, inquiry_utc_time: datetime, solution_id: str,
+                         subcode: str, silent_launch: bool):
+    """
+    Splits the product codes of a transaction in one pass, returns its product code records and its billing record chunks,
+    a (product codes, continuation flag) pair per billing record. The base code comes first in the chunks,
+    the records keep the order of the message. At most MAX_PRODUCT_CODES codes are billed, counting the base one
+    """
+    records = []
+    # slot 0 is kept for the base code, empty when the message has none
+    codes = [""]
+    for each in product_codes:
+        if each.index == BASE_PRODUCT_CODE_INDEX:
+            codes[0] = each.productCode
+            product_code_type = "base"
+        else:
+            codes.append(each.productCode)
+            product_code_type = "optional"
+        records.append(ProductCodeRecord(transaction_id, inquiry_utc_time, solution_id, subcode, intern(each.productCode),
+                                         product_code_type, silent_launch))
+    return records, product_code_chunks(codes, min(len(product_codes), MAX_PRODUCT_CODES))
+
+
+def product_code_chunks(codes: list, count: int) -> list:
+    """ the codes of each billing record, every record but the last of a transaction is flagged as continued """
+    return [("".join(codes[start:start + PRODUCT_CODES_PER_RECORD]), "1" if count - start > PRODUCT_CODES_PER_RECORD else "0")
+            for start in range(0, count, PRODUCT_CODES_PER_RECORD)]
+
+
+async def process_billing_message(billing_message: BillingMessage, applicant_pii: dict, timestamps: TransactionTimestamps = None):
+    """
+    Builds the raw (unencrypted) billing payload and the product code records for a billing message.
+    The payload is encrypted later for the whole batch, see encrypt_billing_records
+    timestamps is the cache of the batch, the transaction timestamp is parsed once for all the rows
+    """
+    billing_payload = b""
     dashboard_billing_records = []
+    if timestamps is None:
+        timestamps = TransactionTimestamps()
     try:
-        inquiry_date_time_in_cst = convert_utc_to_cst(billing_message.transaction_id)
-        i = 0
-        billing_record = ["B", "1.00"]
-        i += 2
-        billing_record.append(billing_message.transaction_id[0:23])
-        i += 1
-        billing_record.append("GOINQ" + _make_padding_spaces(3))
-        i += 1
-        billing_record.append(_make_padding_spaces(8))
-        i += 1
-        billing_record.append(_make_padding_spaces(8))
-        i += 1
-        billing_record.append(inquiry_date_time_in_cst[0:8])
-        i += 1
-        billing_record.append(inquiry_date_time_in_cst[8:14] + "00")
-        i += 1
-        billing_record.append(app_config.OPS_SUB_SYSTEM_NAME)
-        i += 1
-        billing_record.append(_make_padding_spaces(70))
-        product_codes_index = i
-        i += 1
-        billing_record.append(_make_padding_spaces(50))
-        i += 1
-        billing_record.append(billing_message.subcode)
-        i += 1
-        billing_record.append(_make_padding_spaces(4))
-        i += 1
-        billing_record.append(_make_padding_spaces(4))
-        i += 1
-        billing_record.append(billing_message.arf_version)
-        i += 1
-        billing_record.append(_make_padding_spaces(53))
-        i += 1
-        billing_record.append(applicant_pii.get("ssn"))
-        i += 1
-        billing_record.append(applicant_pii.get("year_of_birth"))
-        i += 1
-        billing_record.append(applicant_pii.get("consumer_name"))
-        i += 1
-        billing_record.append(applicant_pii.get("current_address"))
-        i += 1
-        billing_record.append(applicant_pii.get("1st_previous_address"))
-        i += 1
-        billing_record.append(applicant_pii.get("2nd_previous_address"))
-        i += 1
-        billing_record.append("0")
-        continuation_index = i
-        i += 1
-        billing_record.append(app_config.OPS_CALLING_SUB_SYSTEM_NAME)
-        i += 1
-        billing_record.append(_make_padding_spaces(46))
-        i += 1
-
-        base_product_code = ""
-        product_codes = []
-        
-        for each in billing_message.product_codes:            
-            if each.index == "10":
-                base_product_code = each.productCode 
-                product_code_type = "base"   
-            else:
-                product_codes.append(each.productCode)
-                product_code_type = "optional"
-            dashboard_billing_records.append((billing_message.transaction_id[0:23], datetime.strptime(billing_message.transaction_id[0:14], '%m%d%Y%H%M%S'), billing_message.solution_id, billing_message.subcode, each.productCode, product_code_type, billing_message.is_silent_launch_enabled))
-        
-        product_codes.insert(0, base_product_code)
-        
-        encrypted_billing_record = await create_transaction_billing_record(billing_message, billing_record, product_codes_index, continuation_index, crypto_util, product_codes)
-
-        if encrypted_billing_record:
-            allout_billing_record = (billing_message.transaction_id[0:23], datetime.strptime(billing_message.transaction_id[0:14], '%m%d%Y%H%M%S'), 
-                                            encrypted_billing_record, billing_message.is_silent_launch_enabled, billing_message.solution_id, billing_message.subcode)
-        else:
+        inquiry_utc_time, inquiry_date_time_in_cst = timestamps.get(billing_message.transaction_id)
+        transaction_id = billing_message.transaction_id[0:23]
+        solution_id = intern(billing_message.solution_id)
+        subcode = intern(billing_message.subcode)
+        record_values = {
+            "transaction_id": transaction_id,
+            "inquiry_date": inquiry_date_time_in_cst[0:8],
+            "inquiry_time": inquiry_date_time_in_cst[8:14] + "00",
+            "subcode": billing_message.subcode,
+            "arf_version": billing_message.arf_version
+        }
+        record_values.update(applicant_pii)
+
+        dashboard_billing_records, product_code_chunks = expand_product_codes(
+            billing_message.product_codes, transaction_id, inquiry_utc_time, solution_id, subcode, billing_message.is_silent_launch_enabled)
+
+        billing_payload = create_transaction_billing_record(billing_message, record_values, product_code_chunks)
+
+        if not billing_payload:
             logger.log_message(
                 message=f"Error in creating the billing record",
                 transaction_id=billing_message.transaction_id,
@@ -100,45 +148,20 @@ async def process_billing_message(billing_message: BillingMessage, applicant_pii
             transaction_id=billing_message.transaction_id,
             level="ERROR"
         )
-    return allout_billing_record, dashboard_billing_records
+    return billing_payload, dashboard_billing_records
 
 
-async def create_transaction_billing_record(billing_message: BillingMessage, billing_record: list, product_codes_index: int, continuation_index: int, crypto_util: ContentHelper, product_codes: list):
-    encrypted_billing_record = ""
+def create_transaction_billing_record(billing_message: BillingMessage, record_values: dict, product_code_chunks: list):
+    """ the billing records of a transaction, one per chunk of expand_product_codes """
+    billing_payload = b""
     try:
-        billing_record_prefix = "GCRGOINQ   00                          "
-        product_code_counter = 0
-        record_index = 0
-        record_data = {}
-        # max limit is 30 products/transaction
-        product_codes_count = min(len(billing_message.product_codes), 30)
-        while product_code_counter < product_codes_count:
-            temp_record = billing_record.copy()
-            product_codes_str = "".join(product_codes[product_code_counter:product_code_counter + 10])
-            padding_length = 70 - len(product_codes_str)
-            temp_record[product_codes_index] = product_codes_str + " " * padding_length
-
-            continuation_flag = "0"
-            if ((product_code_counter % 10) == 0) and ((product_codes_count - product_code_counter) > 10):
-                continuation_flag = "1"
-
-            temp_record[continuation_index] = continuation_flag
-
-            raw_billing_record = billing_record_prefix + "".join(temp_record)
-
-            if len(raw_billing_record) != app_config.BILLING_RECORD_LENGTH:  # 39+746=785
-                raise Exception("Billing record string length ({}) != expected length ({})".format(
-                    len(raw_billing_record),
-                    app_config.BILLING_RECORD_LENGTH))
-
-            # index ordering is important for transaction with more than 10 products
-            record_data[record_index] = raw_billing_record
-            record_index += 1
-            product_code_counter += 10  # iterate every 10 products 
-
-        # Encrypting 
-        cnt_java = await crypto_util.aetask(json.dumps(record_data).encode("utf-8"))
-        encrypted_billing_record = "SEncr:"+base64.b64encode(bytes(cnt_java[0])).decode("utf-8")
+        # the fields shared by the continuation records are fitted once
+        builder = BILLING_RECORD_LAYOUT.builder(record_values)
+        # index ordering is important for transaction with more than 10 products
+        record_data = {record_index: builder.format(product_codes=product_codes, continuation_flag=continuation_flag)
+                       for record_index, (product_codes, continuation_flag) in enumerate(product_code_chunks)}
+
+        billing_payload = json.dumps(record_data).encode("utf-8")
 
     except Exception as xcp:
         logger.log_message(
@@ -146,22 +169,49 @@ async def create_transaction_billing_record(billing_message: BillingMessage, bil
             transaction_id=billing_message.transaction_id,
             level="ERROR"
         )
-    return encrypted_billing_record
+    return billing_payload
+
+
+async def encrypt_billing_records(billing_payloads: list, crypto_util: ContentHelper):
+    """
+    Encrypts the billing payloads of a whole batch in one executor hop and one cipher checkout.
+    When the batch call fails, the payloads are encrypted one by one so that a payload the encryptor
+    rejects only fails its own record.
+    Returns the encrypted billing records in the input order, an empty string marks a failure
+    """
+    encrypted_billing_records = [""] * len(billing_payloads)
+    if not billing_payloads:
+        return encrypted_billing_records
+    try:
+        cnt_java, elapsed = await crypto_util.aetask_many(billing_payloads)
+        metrics.CRYPTO_LATENCY.observe(elapsed)
+        return ["SEncr:" + base64.b64encode(bytes(each)).decode("utf-8") for each in cnt_java]
+    except Exception as xcp:
+        logger.log_message(
+            message=f"Error in encrypting {len(billing_payloads)} billing records, encrypting them one by one: {str(xcp)}",
+            level="WARNING"
+        )
+    results = await asyncio.gather(*[crypto_util.aetask(each) for each in billing_payloads], return_exceptions=True)
+    for idx, result in enumerate(results):
+        if isinstance(result, BaseException):
+            logger.log_message(message=f"Error in encrypting billing record {idx} of the batch: {str(result)}", level="ERROR")
+            continue
+        cnt_java, elapsed = result
+        metrics.CRYPTO_LATENCY.observe(elapsed)
+        encrypted_billing_records[idx] = "SEncr:" + base64.b64encode(bytes(cnt_java)).decode("utf-8")
+    return encrypted_billing_records
 
 
-def _make_padding_spaces(count: int):
-    """To fill non require fields with spaces"""
-    return "".join([" " for _ in range(0, count)])
+def create_allout_billing_record(billing_message: BillingMessage, encrypted_billing_record: str, timestamps: TransactionTimestamps = None):
+    if timestamps is None:
+        timestamps = TransactionTimestamps()
+    return AlloutBillingRecord(billing_message.transaction_id[0:23], timestamps.utc(billing_message.transaction_id), encrypted_billing_record,
+                               billing_message.is_silent_launch_enabled, intern(billing_message.solution_id), intern(billing_message.subcode))
 
 
 def convert_utc_to_cst(transaction_id):
     try:
-        # Combine date and time
-        datetime_str = transaction_id[0:14]
-        utc_time = datetime.strptime(datetime_str, "%m%d%Y%H%M%S").replace(tzinfo=ZoneInfo("UTC"))
-        cst_time = utc_time.astimezone(ZoneInfo("US/Central"))
-        cst_datetime_str = cst_time.strftime("%m%d%Y%H%M%S")
-        return cst_datetime_str
+        return TransactionTimestamps().central(transaction_id)
     except Exception as xcp:
         logger.log_message(
             message=f"Error in converting time from UTC to CST: {str(xcp)}",
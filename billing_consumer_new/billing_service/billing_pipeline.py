@@ -0,0 +1,168 @@
+""" This module contains the staged billing pipeline: decode -> PII -> encrypt -> DB write """
+
+import time
+import asyncio
+from billing_consumer_new.helpers import app_config
+from billing_consumer_new.helpers.app_logger import custom_logger as logger
+from billing_consumer_new.helpers.sql_util import aio_mysql
+from billing_consumer_new.helpers.crypto_util import ContentHelper
+from billing_consumer_new.helpers.dedup_index import TransactionDedupIndex
+from billing_consumer_new.billing_service import billing_handler
+
+
+class BillingJob:
+    """ A poll batch travelling through the pipeline """
+
+    def __init__(self, messages):
+        self.messages = messages
+        self.data = billing_handler.BillingBatch(messages)
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class PipelineStage:
+    """
+    A pipeline stage: `workers` coroutines take jobs from a bounded queue, run `func`
+    on the job data and hand the result to the next stage
+    """
+
+    def __init__(self, name: str, func, workers: int, queue_size: int):
+        self.name = name
+        self.func = func
+        self.workers = max(workers, 1)
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.next_stage = None
+        self.tasks = []
+        self.in_flight = 0
+        self.processed = 0
+        self.failed = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    async def _worker(self):
+        while True:
+            job: BillingJob = await self.queue.get()
+            try:
+                if job.future.done():
+                    # the caller went away, e.g. the consumer was cancelled
+                    continue
+                self.in_flight += 1
+                st = time.perf_counter()
+                try:
+                    job.data = await self.func(job.data)
+                except Exception as xcp:
+                    self.failed += 1
+                    if not job.future.done():
+                        job.future.set_exception(xcp)
+                    continue
+                finally:
+                    latency = time.perf_counter() - st
+                    self.in_flight -= 1
+                    self.processed += 1
+                    self.total_latency += latency
+                    self.max_latency = max(self.max_latency, latency)
+
+                if self.next_stage:
+                    # blocks while the next stage is full, which throttles this stage
+                    await self.next_stage.queue.put(job)
+                elif not job.future.done():
+                    job.future.set_result(job.data)
+            finally:
+                self.queue.task_done()
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue.qsize(),
+            "in_flight": self.in_flight,
+            "processed": self.processed,
+            "failed": self.failed,
+            "avg_latency_ms": round(self.total_latency / self.processed * 1000, 3) if self.processed else 0.0,
+            "max_latency_ms": round(self.max_latency * 1000, 3)
+        }
+
+
+class BillingPipeline:
+    """
+    Runs the billing handler steps as stages connected by bounded queues, so batch N+1
+    can be decoded and encrypted while batch N is written to RDS.
+    process() returns only once the DB stage completed for the batch, offsets are
+    therefore committed after the write, same as with billing_handler
+    """
+
+    def __init__(self, crypto_util: ContentHelper, mysql: aio_mysql,
+                 decode_workers: int = app_config.BILLING_PIPELINE_DECODE_WORKERS,
+                 pii_workers: int = app_config.BILLING_PIPELINE_PII_WORKERS,
+                 encrypt_workers: int = app_config.BILLING_PIPELINE_ENCRYPT_WORKERS,
+                 write_workers: int = app_config.BILLING_PIPELINE_WRITE_WORKERS,
+                 queue_size: int = app_config.BILLING_PIPELINE_QUEUE_SIZE,
+                 stats_interval: int = app_config.BILLING_PIPELINE_STATS_INTERVAL,
+                 dedup_index: TransactionDedupIndex = None):
+        self.crypto_util = crypto_util
+        self.mysql = mysql
+        self.dedup_index = dedup_index
+        self.stats_interval = stats_interval
+        self.stages = [
+            PipelineStage("decode", self._decode, decode_workers, queue_size),
+            PipelineStage("pii", self._format, pii_workers, queue_size),
+            PipelineStage("encrypt", self._encrypt, encrypt_workers, queue_size),
+            PipelineStage("write", self._write, write_workers, queue_size)
+        ]
+        for stage, next_stage in zip(self.stages, self.stages[1:]):
+            stage.next_stage = next_stage
+        self._stats_task = None
+
+    async def start(self):
+        for stage in self.stages:
+            stage.start()
+        if self.stats_interval > 0:
+            self._stats_task = asyncio.create_task(self._report_stats())
+
+    async def stop(self):
+        if self._stats_task:
+            self._stats_task.cancel()
+        for stage in self.stages:
+            await stage.stop()
+
+    async def process(self, messages):
+        """ Runs a poll batch through every stage, returns the written transactions, raises if a stage failed """
+        batch = await self.process_batch(messages)
+        return batch.transactions
+
+    async def process_batch(self, messages) -> billing_handler.BillingBatch:
+        """ Runs a poll batch through every stage, returns the BillingBatch with its failures, raises if a stage failed """
+        job = BillingJob(messages)
+        await self.stages[0].queue.put(job)
+        return await job.future
+
+    def stats(self) -> dict:
+        return {stage.name: stage.stats() for stage in self.stages}
+
+    async def _decode(self, batch: billing_handler.BillingBatch):
+        batch.set_decoded(billing_handler.decode_billing_messages(batch.messages, batch.failures))
+        batch.billing_messages = await billing_handler.drop_duplicate_messages(batch.billing_messages, self.dedup_index)
+        return batch
+
+    async def _format(self, batch: billing_handler.BillingBatch):
+        batch.processed_messages = await billing_handler.format_billing_messages(batch.billing_messages, batch.timestamps)
+        return batch
+
+    async def _encrypt(self, batch: billing_handler.BillingBatch):
+        batch.billing_records = await billing_handler.encrypt_billing_messages(batch.processed_messages, self.crypto_util, batch.timestamps)
+        return batch
+
+    async def _write(self, batch: billing_handler.BillingBatch):
+        batch.set_written(await billing_handler.write_billing_records(batch.billing_records, self.mysql, self.dedup_index))
+        return batch
+
+    async def _report_stats(self):
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            logger.log_json({"message": "Billing pipeline stats", "stats": self.stats()}, level="INFO")
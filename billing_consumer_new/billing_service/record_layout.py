@@ -0,0 +1,117 @@
+""" This module contains the declarative fixed-width layout used to build the billing records """
+
+from typing import NamedTuple
+
+# Field rules
+PAD = "pad"                 # pad with trailing spaces, truncate values longer than the width
+PAD_STRICT = "pad_strict"   # pad with trailing spaces, values longer than the width are an error
+EXACT = "exact"             # value must already be exactly the width
+
+
+class Field(NamedTuple):
+    """
+    A single fixed-width field
+    Args:
+        name (str): key looked up in the values passed to format, unused for constants.
+        width (int): number of characters the field occupies.
+        rule (str): one of PAD, PAD_STRICT or EXACT.
+        value (str): constant value, the field is resolved once when the layout is compiled.
+    """
+    name: str
+    width: int
+    rule: str = PAD
+    value: str = None
+
+
+def constant(value: str, width: int = None) -> Field:
+    """ constant field, padded with spaces up to width """
+    return Field("", len(value) if width is None else width, PAD_STRICT, value)
+
+
+def spaces(width: int) -> Field:
+    """ filler field for the non required fields """
+    return Field("", width, PAD, "")
+
+
+def fit(value, width: int, rule: str = PAD) -> str:
+    """ returns value as a string of exactly width characters according to rule """
+    if value is None:
+        value = ""
+    value = str(value)
+    if len(value) == width:
+        return value
+    if rule == EXACT or (rule == PAD_STRICT and len(value) > width):
+        raise ValueError(f"Field value length ({len(value)}) != expected length ({width})")
+    if len(value) > width:
+        return value[:width]
+    return value + " " * (width - len(value))
+
+
+class FixedWidthLayout:
+    """
+    Compiles a list of fields into a single synchronous formatter.
+    Adjacent constant fields are joined once, so formatting a record is a handful of
+    fits and one join. The total length is validated when the layout is built.
+    """
+
+    def __init__(self, fields: list, length: int = None):
+        for each in fields:
+            if each.rule not in (PAD, PAD_STRICT, EXACT):
+                raise ValueError(f"Unknown rule {each.rule} for field {each.name}")
+        self.fields = tuple(fields)
+        self.length = sum(each.width for each in self.fields)
+        if length is not None and self.length != length:
+            raise ValueError(f"Layout length ({self.length}) != expected length ({length})")
+
+        self._parts = []
+        self._slots = []
+        for each in self.fields:
+            if each.value is not None:
+                text = fit(each.value, each.width, each.rule)
+                if self._parts and self._parts[-1] is not None:
+                    self._parts[-1] += text
+                else:
+                    self._parts.append(text)
+            else:
+                self._slots.append((len(self._parts), each.name, each.width, each.rule))
+                self._parts.append(None)
+
+    @property
+    def names(self) -> tuple:
+        """ names of the fields resolved at format time, in layout order """
+        return tuple(name for _, name, _, _ in self._slots)
+
+    def format(self, values: dict) -> str:
+        """ formats the values into a single fixed-width string """
+        parts = self._parts.copy()
+        for idx, name, width, rule in self._slots:
+            parts[idx] = fit(values.get(name), width, rule)
+        return "".join(parts)
+
+    def builder(self, values: dict) -> "RecordBuilder":
+        """ a buffer filled with the values shared by several records, see RecordBuilder """
+        return RecordBuilder(self, values)
+
+
+class RecordBuilder:
+    """
+    A layout buffer filled once with the values shared by the records of a transaction,
+    each record then only refits the fields that change and joins the same buffer.
+    Every field must be set either in the shared values or on each format call
+    """
+    __slots__ = ("_parts", "_slots")
+
+    def __init__(self, layout: FixedWidthLayout, values: dict):
+        self._parts = layout._parts.copy()
+        self._slots = {}
+        for idx, name, width, rule in layout._slots:
+            self._slots[name] = (idx, width, rule)
+            if name in values:
+                self._parts[idx] = fit(values[name], width, rule)
+
+    def format(self, **values) -> str:
+        """ formats a record, the given values replace the ones of the previous record """
+        for name, value in values.items():
+            idx, width, rule = self._slots[name]
+            self._parts[idx] = fit(value, width, rule)
+        return "".join(self._parts)
@@ -0,0 +1,56 @@
+""" This module contains the timestamps derived from the 14 digits MMDDYYYYHHMMSS prefix of the transaction ids """
+
+from datetime import datetime, timedelta
+from functools import lru_cache
+from zoneinfo import ZoneInfo
+
+UTC = ZoneInfo("UTC")
+CENTRAL = ZoneInfo("US/Central")
+TIMESTAMP_LENGTH = 14
+
+
+def parse_timestamp(prefix: str) -> datetime:
+    """ naive UTC datetime of a MMDDYYYYHHMMSS prefix, raises ValueError like strptime when it is not one """
+    if len(prefix) != TIMESTAMP_LENGTH or not prefix.isascii() or not prefix.isdigit():
+        raise ValueError(f"time data {prefix!r} does not match format '%m%d%Y%H%M%S'")
+    return datetime(int(prefix[4:8]), int(prefix[0:2]), int(prefix[2:4]),
+                    int(prefix[8:10]), int(prefix[10:12]), int(prefix[12:14]))
+
+
+@lru_cache(maxsize=4096)
+def central_offset(utc_hour: datetime) -> timedelta:
+    """ UTC offset of US/Central during a UTC hour, the DST changes happen on the hour """
+    return utc_hour.replace(tzinfo=UTC).astimezone(CENTRAL).utcoffset()
+
+
+def to_central(utc_time: datetime) -> str:
+    """ MMDDYYYYHHMMSS of a naive UTC datetime in US/Central """
+    cst_time = utc_time + central_offset(utc_time.replace(minute=0, second=0))
+    return (f"{cst_time.month:02d}{cst_time.day:02d}{cst_time.year:04d}"
+            f"{cst_time.hour:02d}{cst_time.minute:02d}{cst_time.second:02d}")
+
+
+class TransactionTimestamps:
+    """
+    Per batch cache of the transaction timestamps, each distinct prefix is parsed
+    and converted to US/Central once for all the rows of its transactions
+    """
+
+    def __init__(self):
+        self._timestamps = {}
+
+    def get(self, transaction_id: str) -> tuple:
+        """ (naive UTC datetime, US/Central MMDDYYYYHHMMSS) of a transaction id """
+        prefix = transaction_id[0:TIMESTAMP_LENGTH]
+        timestamps = self._timestamps.get(prefix)
+        if timestamps is None:
+            utc_time = parse_timestamp(prefix)
+            timestamps = (utc_time, to_central(utc_time))
+            self._timestamps[prefix] = timestamps
+        return timestamps
+
+    def utc(self, transaction_id: str) -> datetime:
+        return self.get(transaction_id)[0]
+
+    def central(self, transaction_id: str) -> str:
+        return self.get(transaction_id)[1]
@@ -14,28 +14,140 @@ KAFKA_NO_CONSUMER_PER_INSTANCE_MAX = 8
 KAFKA_NO_CONSUMER_PER_INSTANCE = int(os.getenv("KAFKA_NO_CONSUMER_PER_INSTANCE", 4))
 NUMBER_OF_MSG_HANDLERS = int(os.getenv("NUMBER_OF_MSG_HANDLERS", "50"))
 MSK_BOOTSTRAP_SERVERS = os.getenv("MSK_BOOTSTRAP_SERVERS", "localhost:9092")
+KAFKA_POLL_TIMEOUT_MS = int(os.getenv("KAFKA_POLL_TIMEOUT_MS", "10000"))
+KAFKA_INFLIGHT_POLL_TIMEOUT_MS = int(os.getenv("KAFKA_INFLIGHT_POLL_TIMEOUT_MS", "200"))
+# 0 processes the partitions of a poll one after the other, > 0 caps the partition batches in flight per consumer
+KAFKA_PARTITION_CONCURRENCY = int(os.getenv("KAFKA_PARTITION_CONCURRENCY", "0"))
+# Adaptive batching, the records fetched per poll follow the measured batch time and the consumer lag
+KAFKA_ADAPTIVE_BATCHING = os.getenv("KAFKA_ADAPTIVE_BATCHING", "false").lower() == "true"
+KAFKA_MIN_POLL_RECORDS = int(os.getenv("KAFKA_MIN_POLL_RECORDS", "10"))
+KAFKA_MAX_POLL_RECORDS = int(os.getenv("KAFKA_MAX_POLL_RECORDS", "500"))
+KAFKA_TARGET_BATCH_MS = int(os.getenv("KAFKA_TARGET_BATCH_MS", "2000"))
+KAFKA_MAX_POLL_INTERVAL_MS = int(os.getenv("KAFKA_MAX_POLL_INTERVAL_MS", "300000"))
+
+# Retry tier, the failed billing messages go to the retry topic until BILLING_MAX_ATTEMPTS, then to the dead-letter topic
+BILLING_RETRY_ENABLED = os.getenv("BILLING_RETRY_ENABLED", "false").lower() == "true"
+BILLING_MAX_ATTEMPTS = int(os.getenv("BILLING_MAX_ATTEMPTS", "3"))
+# keep it below KAFKA_MAX_POLL_INTERVAL_MS, the retry consumer waits it out between its polls
+BILLING_RETRY_DELAY_MS = int(os.getenv("BILLING_RETRY_DELAY_MS", "60000"))
+# delay between the group joins of the consumers of a process
+KAFKA_CONSUMER_STAGGER_MS = int(os.getenv("KAFKA_CONSUMER_STAGGER_MS", "1000"))
+KAFKA_RETRY_GROUP_ID = os.getenv("KAFKA_RETRY_GROUP_ID", f"{KAFKA_GROUP_ID}-retry")
+# time given to the batches in flight to be committed on shutdown, keep it below the supervisor stop timeout of 30s
+KAFKA_DRAIN_TIMEOUT_MS = int(os.getenv("KAFKA_DRAIN_TIMEOUT_MS", "20000"))
+# the offsets of the partition batches completing within this interval are committed in one call
+KAFKA_COMMIT_INTERVAL_MS = int(os.getenv("KAFKA_COMMIT_INTERVAL_MS", "100"))
+# a partition batch whose handler raised is fetched again after a backoff doubling from KAFKA_BATCH_RETRY_BACKOFF_MS up to
+# KAFKA_BATCH_RETRY_MAX_BACKOFF_MS, until it succeeds. With KAFKA_BATCH_MAX_RETRIES > 0 and the retry tier enabled, the batch
+# is sent to the dead-letter topic after that many retries and committed once produced, 0 retries forever
+KAFKA_BATCH_MAX_RETRIES = int(os.getenv("KAFKA_BATCH_MAX_RETRIES", "0"))
+KAFKA_BATCH_RETRY_BACKOFF_MS = int(os.getenv("KAFKA_BATCH_RETRY_BACKOFF_MS", "500"))
+KAFKA_BATCH_RETRY_MAX_BACKOFF_MS = int(os.getenv("KAFKA_BATCH_RETRY_MAX_BACKOFF_MS", "30000"))
 
 # Billing Config
 BILLING_TOPIC = os.getenv("BILLING_TOPIC", "refactored_billing")
+BILLING_RETRY_TOPIC = os.getenv("BILLING_RETRY_TOPIC", f"{BILLING_TOPIC}_retry")
+BILLING_DLQ_TOPIC = os.getenv("BILLING_DLQ_TOPIC", f"{BILLING_TOPIC}_dlq")
 BILLING_RECORD_LENGTH = 785
 ALLOUT_BILLING_TABLE_NAME = os.getenv("ALLOUT_BILLING_TABLE_NAME", "uat_bc_billing")
 PRODUCT_CODES_BILLING_TABLE_NAME = os.getenv("PRODUCT_CODES_BILLING_TABLE_NAME", "uat_bc_product_codes_info")
 ALLOUT_BILLING_TABLE_COLUMNS = ["transaction_id", "inquiry_timestamp", "billing_record", "silent_launch", "solution_id", "subcode"]
 PRODUCT_CODES_BILLING_TABLE_COLUMNS = ["transaction_id", "inquiry_timestamp", "solution_id", "subcode", "product_code", "product_code_type", "silent_launch"]
 
+# Decoding of the billing messages, one of:
+#   legacy  json.loads then model_validate
+#   json    model_validate_json straight from the bytes
+#   lazy    only the fields of the billing record are decoded
+BILLING_DECODE_MODE = os.getenv("BILLING_DECODE_MODE", "json")
+
+# Billing pipeline Config, stages connected by bounded queues instead of the serial billing handler
+BILLING_PIPELINE_ENABLED = os.getenv("BILLING_PIPELINE_ENABLED", "false").lower() == "true"
+BILLING_PIPELINE_QUEUE_SIZE = int(os.getenv("BILLING_PIPELINE_QUEUE_SIZE", "4"))
+BILLING_PIPELINE_DECODE_WORKERS = int(os.getenv("BILLING_PIPELINE_DECODE_WORKERS", "1"))
+BILLING_PIPELINE_PII_WORKERS = int(os.getenv("BILLING_PIPELINE_PII_WORKERS", "1"))
+BILLING_PIPELINE_ENCRYPT_WORKERS = int(os.getenv("BILLING_PIPELINE_ENCRYPT_WORKERS", "2"))
+BILLING_PIPELINE_WRITE_WORKERS = int(os.getenv("BILLING_PIPELINE_WRITE_WORKERS", "2"))
+BILLING_PIPELINE_STATS_INTERVAL = int(os.getenv("BILLING_PIPELINE_STATS_INTERVAL", "60"))
 
 LOG_LEVEL = int(os.getenv("LOG_LEVEL", "10"))
+# records waiting for the logging thread, 0 for unbounded. drop discards the records of a full queue, block waits for room
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_QUEUE_POLICY = os.getenv("LOG_QUEUE_POLICY", "drop")
+# per event type, e.g. "batch_written=0.1,db_chunk_written=0.01" keeps 10% and 1% of those records
+LOG_SAMPLING = os.getenv("LOG_SAMPLING", "")
+# per event type, e.g. "redelivered=5" emits at most 5 of those records per second
+LOG_RATE_LIMITS = os.getenv("LOG_RATE_LIMITS", "")
 
 # Crypto Config
 CRYPTO_ENV = os.getenv("CRYPTO_ENV")
 CRYPTO_ENV_PREFIX = os.getenv("CRYPTO_ENV_PREFIX")
 CRYPTO_AWS_PROFILE = os.getenv("CRYPTO_AWS_PROFILE")
-CRYPTO_INSTANCES = int(os.getenv("CRYPTO_INSTANCES"))
+CRYPTO_INSTANCES = int(os.getenv("CRYPTO_INSTANCES", "3"))
 CRYPTO_LJAR = os.getenv("CRYPTO_LJAR")
+# jpype runs the JVM crypto library, local is an AES-SIV stand-in for load tests without JVM nor key service
+CRYPTO_BACKEND = os.getenv("CRYPTO_BACKEND", "jpype")
+# hex of a 32, 48 or 64 bytes key, required by the local backend
+CRYPTO_LOCAL_KEY = os.getenv("CRYPTO_LOCAL_KEY")
+CRYPTO_LOCAL_LATENCY_MS = float(os.getenv("CRYPTO_LOCAL_LATENCY_MS", "0"))
+CRYPTO_LOCAL_RECORD_LATENCY_MS = float(os.getenv("CRYPTO_LOCAL_RECORD_LATENCY_MS", "0"))
+# > 0 hosts the JVMs in that many crypto worker processes shared by all the consumer processes
+CRYPTO_WORKER_PROCESSES = int(os.getenv("CRYPTO_WORKER_PROCESSES", "0"))
+CRYPTO_WORKER_SOCKET_DIR = os.getenv("CRYPTO_WORKER_SOCKET_DIR", "/tmp/")
+CRYPTO_WORKER_CONNECT_TIMEOUT = float(os.getenv("CRYPTO_WORKER_CONNECT_TIMEOUT", "120"))
+# requests in flight per worker and consumer process, each on its own connection
+CRYPTO_WORKER_MAX_INFLIGHT = int(os.getenv("CRYPTO_WORKER_MAX_INFLIGHT", "4"))
+CRYPTO_WORKER_STATS_INTERVAL = int(os.getenv("CRYPTO_WORKER_STATS_INTERVAL", "60"))
 
 # General Config
 OPS_SUB_SYSTEM_NAME = "GOCR"
 OPS_CALLING_SUB_SYSTEM_NAME = "GOXX"
 
 ANALYTICS_RDS_DATABASE_SCHEMA = os.getenv("ANALYTICS_RDS_DATABASE_SCHEMA", "uat_analytics")
-ANALYTICS_RDS_KEY_NAME = os.getenv("ANALYTICS_RDS_KEY_NAME", "uat-analytics-ops-rw")
\ No newline at end of file
+ANALYTICS_RDS_KEY_NAME = os.getenv("ANALYTICS_RDS_KEY_NAME", "uat-analytics-ops-rw")
+
+# MySQL writer Config
+MYSQL_WRITE_MODE = os.getenv("MYSQL_WRITE_MODE", "executemany")  # executemany, values or load_data
+# chunk budget per DB transaction of the 2 billing tables, keep it well below the max_allowed_packet of the server
+MYSQL_CHUNK_BYTES = int(os.getenv("MYSQL_CHUNK_BYTES", "1000000"))
+MYSQL_LOCAL_INFILE = os.getenv("MYSQL_LOCAL_INFILE", "false").lower() == "true"
+# attempts of a write failing on a transient error, each on a new connection after a backoff doubling from
+# MYSQL_WRITE_RETRY_BACKOFF_MS, the rows still pending after the last attempt are rejected
+MYSQL_WRITE_ATTEMPTS = int(os.getenv("MYSQL_WRITE_ATTEMPTS", "3"))
+MYSQL_WRITE_RETRY_BACKOFF_MS = int(os.getenv("MYSQL_WRITE_RETRY_BACKOFF_MS", "100"))
+# Connection pool, 0 sizes it from the concurrent writers of the process. MINSIZE connections are opened at startup, 0 for all of them
+MYSQL_POOL_SIZE = int(os.getenv("MYSQL_POOL_SIZE", "0"))
+MYSQL_POOL_MINSIZE = int(os.getenv("MYSQL_POOL_MINSIZE", "0"))
+MYSQL_POOL_RECYCLE_SECONDS = int(os.getenv("MYSQL_POOL_RECYCLE_SECONDS", "10800"))
+# a connection idle for longer is pinged before it is lent, -1 never pings
+MYSQL_POOL_PING_IDLE_SECONDS = int(os.getenv("MYSQL_POOL_PING_IDLE_SECONDS", "30"))
+MYSQL_CONNECT_TIMEOUT = int(os.getenv("MYSQL_CONNECT_TIMEOUT", "10"))
+APP_TEMP_DIR = os.getenv("APP_TEMP_DIR", "/tmp/")
+# Metrics of the processes sharing the /metrics port, each writes its snapshot there every interval, empty for this process only
+METRICS_MULTIPROC_DIR = os.getenv("METRICS_MULTIPROC_DIR", os.path.join(APP_TEMP_DIR, "billing_metrics"))
+METRICS_WRITE_INTERVAL_MS = int(os.getenv("METRICS_WRITE_INTERVAL_MS", "1000"))
+# Group commit of the batches of all the consumers of a process, flushed at max records or max delay
+GROUP_COMMIT_ENABLED = os.getenv("GROUP_COMMIT_ENABLED", "false").lower() == "true"
+GROUP_COMMIT_MAX_RECORDS = int(os.getenv("GROUP_COMMIT_MAX_RECORDS", "200"))
+GROUP_COMMIT_MAX_DELAY_MS = int(os.getenv("GROUP_COMMIT_MAX_DELAY_MS", "50"))
+# Columnar copy of the rows written to RDS, rolling files per table, inquiry date and solution id uploaded to S3
+COLUMNAR_SINK_ENABLED = os.getenv("COLUMNAR_SINK_ENABLED", "false").lower() == "true"
+COLUMNAR_SINK_FORMAT = os.getenv("COLUMNAR_SINK_FORMAT", "csv.gz")  # csv.gz or parquet (needs pyarrow)
+COLUMNAR_SINK_DIR = os.getenv("COLUMNAR_SINK_DIR", os.path.join(APP_TEMP_DIR, "billing_sink"))
+COLUMNAR_SINK_MAX_FILE_BYTES = int(os.getenv("COLUMNAR_SINK_MAX_FILE_BYTES", str(64 * 1024 * 1024)))
+COLUMNAR_SINK_MAX_FILE_SECONDS = int(os.getenv("COLUMNAR_SINK_MAX_FILE_SECONDS", "300"))
+COLUMNAR_SINK_MAX_OPEN_FILES = int(os.getenv("COLUMNAR_SINK_MAX_OPEN_FILES", "64"))
+# rows waiting for the file writer, the writes of the consumers wait beyond it
+COLUMNAR_SINK_MAX_PENDING_ROWS = int(os.getenv("COLUMNAR_SINK_MAX_PENDING_ROWS", "50000"))
+# the closed files stay under COLUMNAR_SINK_DIR when no bucket is set
+COLUMNAR_SINK_S3_BUCKET = os.getenv("COLUMNAR_SINK_S3_BUCKET", "")
+COLUMNAR_SINK_S3_PREFIX = os.getenv("COLUMNAR_SINK_S3_PREFIX", "billing")
+# Dedup of the Kafka redeliveries, LRU of the transactions written by the process
+DEDUP_ENABLED = os.getenv("DEDUP_ENABLED", "false").lower() == "true"
+DEDUP_MAX_SIZE = int(os.getenv("DEDUP_MAX_SIZE", "100000"))
+DEDUP_TTL_SECONDS = int(os.getenv("DEDUP_TTL_SECONDS", "3600"))
+# look up the transactions missing from the LRU in the allout table, during the window after a start (0 for always)
+DEDUP_DB_PRECHECK = os.getenv("DEDUP_DB_PRECHECK", "false").lower() == "true"
+DEDUP_DB_PRECHECK_WINDOW_SECONDS = int(os.getenv("DEDUP_DB_PRECHECK_WINDOW_SECONDS", "300"))
+# Supervisor of the processes, a child dying within the min uptime is restarted with a doubling backoff
+SUPERVISOR_MIN_UPTIME_SECONDS = int(os.getenv("SUPERVISOR_MIN_UPTIME_SECONDS", "30"))
+SUPERVISOR_MAX_BACKOFF_SECONDS = int(os.getenv("SUPERVISOR_MAX_BACKOFF_SECONDS", "60"))
@@ -1,22 +1,45 @@
-
 """ Custom Logging Module """
 
 import logging
 import json
+import time
+import queue
+import random
 import datetime
 
 import asyncio
 import logging.handlers
+from typing import List
+from billing_consumer_new.helpers import app_config, metrics
 try:
-    # Python 3.7 and newer, fast reentrant implementation
-    # witohut task tracking (not needed for that when logging)
-    from queue import SimpleQueue as Queue
+    # optional, about 10x faster than json for the log_json records
+    import orjson
 except ImportError:
-    from queue import Queue
-from typing import List
+    orjson = None
+
+# Policies of a full bounded log queue
+QUEUE_POLICY_DROP = "drop"    # the record is discarded and counted
+QUEUE_POLICY_BLOCK = "block"  # the caller waits for the logging thread to make room
+
+LEVELS = {"DEBUG": logging.DEBUG, "INFO": logging.INFO, "WARNING": logging.WARNING, "ERROR": logging.ERROR}
 
 
 class LocalQueueHandler(logging.handlers.QueueHandler):
+    """ enqueues the records unformatted, the messages are built by the logging thread when they are emitted """
+
+    def __init__(self, queue, policy: str = QUEUE_POLICY_DROP):
+        super().__init__(queue)
+        self.policy = policy
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        if self.policy == QUEUE_POLICY_BLOCK:
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.LOG_RECORDS_DROPPED.inc(reason="queue_full")
+
     def emit(self, record: logging.LogRecord) -> None:
         # Removed the call to self.prepare(), handle task cancellation
         try:
@@ -27,77 +50,161 @@ class LocalQueueHandler(logging.handlers.QueueHandler):
             self.handleError(record)
 
 
-def setup_logging_queue() -> None:
+class LocalQueueListener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self) -> None:
+        # a full bounded queue is drained by the logging thread, wait for room instead of raising
+        self.queue.put(self._sentinel)
+
+
+def setup_logging_queue(maxsize: int = app_config.LOG_QUEUE_SIZE, policy: str = app_config.LOG_QUEUE_POLICY) -> logging.handlers.QueueListener:
     """Move log handlers to a separate thread.
 
     Replace handlers on the root logger with a LocalQueueHandler,
     and start a logging.QueueListener holding the original
-    handlers.
+    handlers. Stopping the returned listener flushes the queue.
+    The queue holds at most maxsize records (0 for unbounded),
+    policy tells what happens to the records of a full queue.
 
     """
-    queue = Queue()
+    log_queue = queue.Queue(maxsize) if maxsize > 0 else queue.SimpleQueue()
     root = logging.getLogger()
 
     handlers: List[logging.Handler] = []
 
-    handler = LocalQueueHandler(queue)
+    handler = LocalQueueHandler(log_queue, policy)
     root.addHandler(handler)
     for h in root.handlers[:]:
         if h is not handler:
             root.removeHandler(h)
             handlers.append(h)
 
-    listener = logging.handlers.QueueListener(
-        queue, *handlers, respect_handler_level=True
+    listener = LocalQueueListener(
+        log_queue, *handlers, respect_handler_level=True
     )
     listener.start()
+    return listener
+
+
+def parse_event_settings(setting: str) -> dict:
+    """ "batch_written=0.1,redelivered=5" -> {"batch_written": 0.1, "redelivered": 5.0} """
+    settings = {}
+    for each in setting.split(","):
+        if "=" in each:
+            event, value = each.split("=", 1)
+            settings[event.strip()] = float(value)
+    return settings
+
+
+class LogSampler:
+    """
+    Decides per event type whether a record is emitted: sampling keeps that share of the records,
+    rate_limits emits at most that many records per second (token bucket, bursts up to one second worth)
+    """
+
+    def __init__(self, sampling: dict = None, rate_limits: dict = None):
+        self.sampling = sampling or {}
+        self.rate_limits = rate_limits or {}
+        self._buckets = {}
+        self._random = random.Random()
+
+    def allow(self, event: str) -> bool:
+        rate = self.sampling.get(event)
+        if rate is not None and self._random.random() >= rate:
+            metrics.LOG_RECORDS_DROPPED.inc(reason="sampled")
+            return False
+        limit = self.rate_limits.get(event)
+        if limit is not None:
+            now = time.monotonic()
+            tokens, last = self._buckets.get(event, (limit, now))
+            tokens = min(limit, tokens + (now - last) * limit)
+            if tokens < 1:
+                self._buckets[event] = (tokens, now)
+                metrics.LOG_RECORDS_DROPPED.inc(reason="rate_limited")
+                return False
+            self._buckets[event] = (tokens - 1, now)
+        return True
+
+
+class LogMessage:
+    """ a log_message record, the args and the transaction id are formatted in when the record is emitted """
+    __slots__ = ("message", "transaction_id", "args")
+
+    def __init__(self, message: str, transaction_id, args: tuple):
+        self.message = message
+        self.transaction_id = transaction_id
+        self.args = args
+
+    def __str__(self):
+        message = self.message % self.args if self.args else self.message
+        return f"{self.transaction_id} ------- {message}"
+
+
+class JsonMessage:
+    """ a log_json record, serialized when the record is emitted """
+    __slots__ = ("content", "timestamp")
+
+    def __init__(self, content: dict):
+        self.content = content
+        self.timestamp = datetime.datetime.now()
+
+    def __str__(self):
+        try:
+            message = {
+                "timestamp": str(self.timestamp),
+                "event_type": "BILLING",
+                "exception": None,
+                "traceback": None
+            }
+            message.update(self.content)
+            if orjson is not None:
+                return orjson.dumps(message, default=str).decode("utf-8")
+            return json.dumps(message, default=str)
+        except Exception as xcp:
+            return f" ------- Failed to write log: {str(xcp)}"
 
 
 """ Writing a Custom Logger """
 class CustomLogger():
     """ Custom Logger class """
 
-    def __init__(self, name: str, level = 10) -> None:
+    def __init__(self, name: str, level = 10, sampler: LogSampler = None) -> None:
         self.logger = logging.getLogger(name)
         self.logger.setLevel(level)
-        
+        self.sampler = sampler or LogSampler(parse_event_settings(app_config.LOG_SAMPLING),
+                                             parse_event_settings(app_config.LOG_RATE_LIMITS))
+
         self.transaction_id = ""
 
-    def log_json(self, content: dict, level: str = "INFO"):
+    def is_enabled(self, level: str = "INFO", event: str = None) -> bool:
+        """ False when a record of that level and event type would not be emitted """
+        if not self.logger.isEnabledFor(LEVELS.get(level, logging.INFO)):
+            return False
+        return event is None or self.sampler.allow(event)
+
+    def log_json(self, content: dict, level: str = "INFO", event: str = None):
         """
-        Logs a dictionary as a JSON string
+        Logs a dictionary as a JSON string, serialized when the record is emitted
         Args:
-            content (dict): Dictionary to log.
+            content (dict): Dictionary to log, must not be changed after the call.
             level (str): Logging level. Default is set to "info.
+            event (str): event type of the record for the sampling and the rate limits.
         """
-        try:
-            if "exception" not in content:
-                content.update({"exception": None})
-            if "traceback" not in content:
-                content.update({"traceback": None})
-
-            message = {
-                "timestamp": str(datetime.datetime.now()),
-                "event_type": "BILLING"
-            }
-            message.update(content)
-            self.write_log_item(json.dumps(message), level)
-            
-        except Exception as xcp:
-            log_msg = f" ------- Failed to write log: {str(xcp)}"
-            self.write_log_item(log_msg, level="ERROR")
+        if self.is_enabled(level, event):
+            self.logger.log(LEVELS.get(level, logging.INFO), JsonMessage(content))
 
 
-    def log_message(self, message: str, transaction_id: str = None, level: str = "INFO"):
+    def log_message(self, message: str, transaction_id: str = None, level: str = "INFO", args: tuple = (), event: str = None):
         """
         Logs a message string
 
         Args:
-            message (str): message to log.
+            message (str): message to log, with %-style placeholders for args.
             level (str): Logging level. Default is set to "info.
+            args (tuple): formatted into message when the record is emitted, must not be changed after the call.
+            event (str): event type of the record for the sampling and the rate limits.
         """
-        log_msg = f"{transaction_id} ------- {message}"
-        self.write_log_item(log_msg, level)
+        if self.is_enabled(level, event):
+            self.logger.log(LEVELS.get(level, logging.INFO), LogMessage(message, transaction_id, args))
 
 
     def write_log_item(self, message: str, level: str = "INFO"):
@@ -115,4 +222,4 @@ class CustomLogger():
 
 
 # Logging Config
-custom_logger = CustomLogger("billing_consumer")
\ No newline at end of file
+custom_logger = CustomLogger("billing_consumer")
@@ -0,0 +1,242 @@
+""" This module contains the columnar file sink that keeps a copy of the billing rows written to RDS """
+
+import io
+import os
+import csv
+import gzip
+import time
+import asyncio
+import datetime
+from billing_consumer_new.helpers import app_config, metrics
+from billing_consumer_new.helpers.app_logger import custom_logger as logger
+from billing_consumer_new.helpers.async_cputhread import cpu_task
+from billing_consumer_new.helpers.boto3_sessions import AIOBoto3Session
+try:
+    # only needed by the parquet format
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# File formats of the sink
+SINK_FORMAT_CSV = "csv.gz"       # gzipped CSV with a header line
+SINK_FORMAT_PARQUET = "parquet"  # a row group per append, needs pyarrow
+SINK_FORMATS = (SINK_FORMAT_CSV, SINK_FORMAT_PARQUET)
+
+_STOP = object()
+# the file ages are checked at least that often
+ROLL_CHECK_SECONDS = 1
+
+
+def csv_value(value) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, datetime.datetime):
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    return str(value)
+
+
+def partition_path(table: str, columns: tuple, row) -> str:
+    """ table/inquiry_date=YYYY-MM-DD/solution_id=X, the hive layout the analytics readers prune on """
+    inquiry_timestamp = row[columns.index("inquiry_timestamp")]
+    inquiry_date = inquiry_timestamp.date().isoformat() if isinstance(inquiry_timestamp, datetime.datetime) else "unknown"
+    solution_id = str(row[columns.index("solution_id")] or "unknown").replace("/", "_")
+    return os.path.join(table, f"inquiry_date={inquiry_date}", f"solution_id={solution_id}")
+
+
+class PartitionFile:
+    """ the open file of a table partition, only used from the executor threads """
+
+    def __init__(self, path: str, columns: tuple, file_format: str):
+        self.path = path
+        self.columns = columns
+        self.file_format = file_format
+        self.opened_at = time.monotonic()
+        self.rows = 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if file_format == SINK_FORMAT_PARQUET:
+            self._writer = None
+            self._schema = None
+        else:
+            self._raw = open(path, "wb")
+            self._text = io.TextIOWrapper(gzip.GzipFile(fileobj=self._raw, mode="wb"), encoding="utf-8", newline="")
+            self._csv = csv.writer(self._text)
+            self._csv.writerow(columns)
+
+    @property
+    def size(self) -> int:
+        """ bytes on disk, the compressor holds back a few more """
+        if self.file_format == SINK_FORMAT_PARQUET:
+            return os.path.getsize(self.path) if self._writer is not None else 0
+        return self._raw.tell()
+
+    def append(self, rows: list):
+        if self.file_format == SINK_FORMAT_PARQUET:
+            table = pyarrow.table({column: list(values) for column, values in zip(self.columns, zip(*rows))})
+            if self._writer is None:
+                self._schema = table.schema
+                self._writer = pyarrow.parquet.ParquetWriter(self.path, self._schema)
+            self._writer.write_table(table.cast(self._schema))
+        else:
+            self._csv.writerows([csv_value(value) for value in row] for row in rows)
+        self.rows += len(rows)
+
+    def close(self):
+        if self.file_format == SINK_FORMAT_PARQUET:
+            if self._writer is not None:
+                self._writer.close()
+        else:
+            self._text.close()
+            self._raw.close()
+
+
+class ColumnarSink:
+    """
+    Appends the billing rows to rolling files under directory, one file per table and partition, e.g.
+    uat_bc_billing/inquiry_date=2024-10-23/solution_id=GOCR/part-<pid>-<seq>.csv.gz
+    A file is closed once larger than max_file_bytes or older than max_file_seconds, or when more than
+    max_open_files are open, then uploaded to s3://bucket/prefix/<same path> and deleted.
+    The rows wait for the writer task in a queue of at most max_pending_rows rows, write() waits
+    for room beyond it, so a slow disk or S3 slows the consumers down instead of growing the memory
+    """
+
+    def __init__(self, directory: str = app_config.COLUMNAR_SINK_DIR, file_format: str = app_config.COLUMNAR_SINK_FORMAT,
+                 max_file_bytes: int = app_config.COLUMNAR_SINK_MAX_FILE_BYTES,
+                 max_file_seconds: float = app_config.COLUMNAR_SINK_MAX_FILE_SECONDS,
+                 max_open_files: int = app_config.COLUMNAR_SINK_MAX_OPEN_FILES,
+                 max_pending_rows: int = app_config.COLUMNAR_SINK_MAX_PENDING_ROWS,
+                 bucket: str = app_config.COLUMNAR_SINK_S3_BUCKET, prefix: str = app_config.COLUMNAR_SINK_S3_PREFIX,
+                 s3_client=None):
+        if file_format not in SINK_FORMATS:
+            raise ValueError(f"Unknown sink format {file_format}, expected one of {SINK_FORMATS}")
+        if file_format == SINK_FORMAT_PARQUET and pyarrow is None:
+            raise ValueError("The parquet sink format needs pyarrow")
+        self.directory = directory
+        self.file_format = file_format
+        self.max_file_bytes = max_file_bytes
+        self.max_file_seconds = max_file_seconds
+        self.max_open_files = max_open_files
+        self.max_pending_rows = max_pending_rows
+        self.bucket = bucket
+        self.prefix = prefix
+        self.s3_client = s3_client
+        self._files = {}
+        self._sequence = 0
+        # closed files not uploaded yet
+        self._closed = []
+        self._queue = asyncio.Queue()
+        self._pending_rows = 0
+        self._room = asyncio.Condition()
+        self._task = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """ writes the queued rows, closes and uploads every file """
+        if self._task is not None:
+            self._queue.put_nowait(_STOP)
+            await self._task
+            self._task = None
+
+    async def write(self, table: str, columns: tuple, rows: list):
+        """ queues the rows, waits while max_pending_rows rows are queued """
+        if not rows:
+            return
+        async with self._room:
+            await self._room.wait_for(lambda: self._pending_rows < self.max_pending_rows)
+            self._pending_rows += len(rows)
+        self._queue.put_nowait((table, tuple(columns), rows))
+
+    async def _run(self):
+        while True:
+            try:
+                item = await asyncio.wait_for(self._queue.get(), timeout=ROLL_CHECK_SECONDS)
+            except asyncio.TimeoutError:
+                item = None
+            if item is _STOP:
+                break
+            if item is not None:
+                table, columns, rows = item
+                try:
+                    await self._append(table, columns, rows)
+                except Exception as xcp:
+                    logger.log_message(message=f"Error in writing {len(rows)} rows of {table} to the sink: {str(xcp)}", level="ERROR")
+                async with self._room:
+                    self._pending_rows -= len(rows)
+                    self._room.notify_all()
+            await self._roll()
+        await self._roll(force=True)
+
+    async def _append(self, table: str, columns: tuple, rows: list):
+        partitions = {}
+        for row in rows:
+            partitions.setdefault(partition_path(table, columns, row), []).append(row)
+        await self._append_files(columns, partitions)
+        metrics.SINK_ROWS_WRITTEN.inc(len(rows), table=table)
+
+    @cpu_task
+    def _append_files(self, columns: tuple, partitions: dict):
+        for partition, rows in partitions.items():
+            partition_file = self._files.get(partition)
+            if partition_file is None:
+                self._sequence += 1
+                path = os.path.join(self.directory, partition, f"part-{os.getpid()}-{int(time.time())}-{self._sequence}.{self.file_format}")
+                partition_file = self._files[partition] = PartitionFile(path, columns, self.file_format)
+            partition_file.append(rows)
+
+    async def _roll(self, force: bool = False):
+        """ closes the full, old and least recently opened files, then uploads the closed files """
+        now = time.monotonic()
+        done = [partition for partition, partition_file in self._files.items()
+                if force or partition_file.size >= self.max_file_bytes or now - partition_file.opened_at >= self.max_file_seconds]
+        if len(self._files) - len(done) > self.max_open_files:
+            # the files are kept in opening order
+            remaining = [partition for partition in self._files if partition not in done]
+            done.extend(remaining[:len(remaining) - self.max_open_files])
+        if done:
+            await self._close_files([self._files.pop(partition) for partition in done])
+        if self._closed and self.bucket:
+            await self._upload()
+
+    @cpu_task
+    def _close_files(self, partition_files: list):
+        for partition_file in partition_files:
+            partition_file.close()
+            self._closed.append(partition_file.path)
+
+    async def _upload(self):
+        s3_client = self.s3_client or AIOBoto3Session.instance().get_s3_client()
+        failed = []
+        for path in self._closed:
+            key = "/".join([self.prefix, os.path.relpath(path, self.directory).replace(os.sep, "/")]).lstrip("/")
+            try:
+                await s3_client.upload_file(path, self.bucket, key)
+                os.remove(path)
+                metrics.SINK_FILES.inc(result="uploaded")
+            except Exception as xcp:
+                metrics.SINK_FILES.inc(result="failed")
+                logger.log_message(message=f"Error in uploading {path} to s3://{self.bucket}/{key}: {str(xcp)}", level="ERROR")
+                failed.append(path)
+        self._closed = failed
+
+
+class ColumnarSinkWriter:
+    """
+    bulk_insert_data of the wrapped writer (aio_mysql or GroupCommitWriter), the rows RDS accepted
+    are then appended to the columnar sink
+    """
+
+    def __init__(self, mysql, sink: ColumnarSink):
+        self.mysql = mysql
+        self.sink = sink
+
+    async def bulk_insert_data(self, table_1: str, columns_1: tuple, data_1: list, table_2: str, columns_2: tuple, data_2: list, mode: str = None):
+        rejected_1, rejected_2 = await self.mysql.bulk_insert_data(table_1, columns_1, data_1, table_2, columns_2, data_2, mode=mode)
+        rejected_ids_1 = {id(row) for row in rejected_1}
+        rejected_ids_2 = {id(row) for row in rejected_2}
+        await self.sink.write(table_1, columns_1, [row for row in data_1 if id(row) not in rejected_ids_1])
+        await self.sink.write(table_2, columns_2, [row for row in data_2 if id(row) not in rejected_ids_2])
+        return rejected_1, rejected_2
@@ -0,0 +1,115 @@
+""" This module contains the encryption backends behind the ContentHelper call shape """
+
+import abc
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from cryptography.hazmat.primitives.ciphers.aead import AESSIV
+from billing_consumer_new.helpers import app_config
+
+# Encryption backends
+CRYPTO_BACKEND_JPYPE = "jpype"  # ContentHelper, the JVM crypto library and the key service
+CRYPTO_BACKEND_LOCAL = "local"  # LocalCryptoBackend, AES-SIV with a local key, for benchmarks, soak tests and CI
+CRYPTO_BACKENDS = (CRYPTO_BACKEND_JPYPE, CRYPTO_BACKEND_LOCAL)
+
+
+class CryptoBackend(abc.ABC):
+    """
+    The call shape of the encryption backends: encrypt/decrypt and their batch variants run
+    synchronously and return (result, elapsed seconds), the task variants run them on the executor
+    """
+    executor: ThreadPoolExecutor
+
+    @abc.abstractmethod
+    def encrypt(self, inp):
+        pass
+
+    @abc.abstractmethod
+    def decrypt(self, encrypted):
+        pass
+
+    @abc.abstractmethod
+    def encrypt_many(self, inps):
+        pass
+
+    @abc.abstractmethod
+    def decrypt_many(self, encrypted_items):
+        pass
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+    def etask(self, inp):
+        return self.executor.submit(self.encrypt, inp)
+
+    def dtask(self, encrypted):
+        return self.executor.submit(self.decrypt, encrypted)
+
+    async def aetask(self, inp):
+        return await asyncio.wrap_future(self.executor.submit(self.encrypt, inp))
+
+    async def adtask(self, encrypted):
+        return await asyncio.wrap_future(self.executor.submit(self.decrypt, encrypted))
+
+    async def aetask_many(self, inps):
+        return await asyncio.wrap_future(self.executor.submit(self.encrypt_many, list(inps)))
+
+    async def adtask_many(self, encrypted_items):
+        return await asyncio.wrap_future(self.executor.submit(self.decrypt_many, list(encrypted_items)))
+
+
+class LocalCryptoBackend(CryptoBackend):
+    """
+    Deterministic AES-SIV stand-in for ContentHelper, no JVM and no key service.
+    latency_ms is added to every call and record_latency_ms to every payload, on the executor
+    threads like the JVM calls, so a load test sees the same queueing on the instances
+    """
+
+    def __init__(self, key: bytes, instances: int = app_config.CRYPTO_INSTANCES,
+                 latency_ms: float = app_config.CRYPTO_LOCAL_LATENCY_MS,
+                 record_latency_ms: float = app_config.CRYPTO_LOCAL_RECORD_LATENCY_MS):
+        self.cipher = AESSIV(key)
+        self.latency = latency_ms / 1000
+        self.record_latency = record_latency_ms / 1000
+        self.executor = ThreadPoolExecutor(max_workers=instances)
+
+    def _wait(self, records: int):
+        delay = self.latency + self.record_latency * records
+        if delay > 0:
+            time.sleep(delay)
+
+    def encrypt(self, inp):
+        st = time.time()
+        self._wait(1)
+        return self.cipher.encrypt(bytes(inp), None), time.time() - st
+
+    def decrypt(self, encrypted):
+        st = time.time()
+        self._wait(1)
+        return self.cipher.decrypt(bytes(encrypted), None), time.time() - st
+
+    def encrypt_many(self, inps):
+        """ encrypts every payload in one call, results keep the input order """
+        st = time.time()
+        self._wait(len(inps))
+        return [self.cipher.encrypt(bytes(inp), None) for inp in inps], time.time() - st
+
+    def decrypt_many(self, encrypted_items):
+        """ decrypts every payload in one call, results keep the input order """
+        st = time.time()
+        self._wait(len(encrypted_items))
+        return [self.cipher.decrypt(bytes(encrypted), None) for encrypted in encrypted_items], time.time() - st
+
+
+def create_crypto_backend(backend: str = app_config.CRYPTO_BACKEND) -> CryptoBackend:
+    """ builds the configured backend, blocking: the JPype one starts the JVM and fetches the keys """
+    if backend == CRYPTO_BACKEND_LOCAL:
+        if not app_config.CRYPTO_LOCAL_KEY:
+            raise ValueError("The local crypto backend needs CRYPTO_LOCAL_KEY")
+        return LocalCryptoBackend(bytes.fromhex(app_config.CRYPTO_LOCAL_KEY))
+    if backend == CRYPTO_BACKEND_JPYPE:
+        # jpype is only needed by this backend
+        from billing_consumer_new.helpers.crypto_util import ContentHelper
+        return ContentHelper(app_config.CRYPTO_LJAR, app_config.CRYPTO_ENV, app_config.CRYPTO_ENV_PREFIX,
+                             app_config.CRYPTO_AWS_PROFILE, instances=app_config.CRYPTO_INSTANCES)
+    raise ValueError(f"Unknown crypto backend {backend}, expected one of {CRYPTO_BACKENDS}")
@@ -1,4 +1,3 @@
-import asyncio
 import jpype
 import jpype.imports
 from jpype.types import *
@@ -7,15 +6,17 @@ from concurrent.futures import ThreadPoolExecutor
 import contextlib
 import time
 import queue
+from abc import ABCMeta
+from billing_consumer_new.helpers.crypto_backend import CryptoBackend
 
-class Singleton (type):
+class Singleton (ABCMeta):
     _instances = {}
     def __call__(cls, *args, **kwargs):
         if cls not in cls._instances:
             cls._instances[cls] = super(Singleton, cls).__call__(*args, **kwargs)
         return cls._instances[cls]
 
-class ContentHelper(metaclass=Singleton):
+class ContentHelper(CryptoBackend, metaclass=Singleton):
     def __init__(self, ljar, environment, prefix, awsProfile, instances):
         jpype.startJVM("-Xms64m", "-Xmx64m", classpath=[ljar])
         self.krypt = jpype.JClass("com.experian.ops.crypto.Crypto")
@@ -51,14 +52,16 @@ class ContentHelper(metaclass=Singleton):
           ret = self.krypt.encrypt(obj, inp)
           return (ret, time.time() - st)
 
-    def etask(self, inp):
-       return self.executor.submit(self.encrypt, inp)
-
-    def dtask(self, encrypted):
-       return self.executor.submit(self.decrypt, encrypted)
-
-    async def aetask(self, inp):
-       return await asyncio.wrap_future(self.executor.submit(self.encrypt, inp))
+    def decrypt_many(self, encrypted_items):
+       """ decrypts every payload with a single cipher checkout, results keep the input order """
+       with self.ciface(1) as obj:
+          st = time.time()
+          ret = [self.krypt.decrypt(obj, encrypted) for encrypted in encrypted_items]
+          return (ret, time.time() - st)
 
-    async def adtask(self, encrypted):
-       return await asyncio.wrap_future(self.executor.submit(self.decrypt, encrypted))
\ No newline at end of file
+    def encrypt_many(self, inps):
+       """ encrypts every payload with a single cipher checkout, results keep the input order """
+       with self.ciface(0) as obj:
+          st = time.time()
+          ret = [self.krypt.encrypt(obj, inp) for inp in inps]
+          return (ret, time.time() - st)
@@ -0,0 +1,218 @@
+"""
+Crypto worker processes: a fixed number of processes host the JVM and the ContentHelper (or the CRYPTO_BACKEND),
+the consumer processes reach them over Unix sockets with CryptoWorkerClient.
+
+Frames are a 4 bytes big-endian length followed by the body.
+    request:  op (1 byte, E or D) + count (4 bytes) + count x (length (4 bytes) + payload)
+    response: K + elapsed (8 bytes double) + count (4 bytes) + count x (length (4 bytes) + payload)
+              X + utf-8 error message
+"""
+
+import os
+import time
+import struct
+import asyncio
+import itertools
+from collections import deque
+from billing_consumer_new.helpers import app_config
+from billing_consumer_new.helpers.app_logger import custom_logger as logger
+
+ENCRYPT = b"E"
+DECRYPT = b"D"
+OK = b"K"
+ERROR = b"X"
+
+_LENGTH = struct.Struct(">I")
+_ELAPSED = struct.Struct(">d")
+
+
+class CryptoWorkerError(Exception):
+    """ the crypto worker failed to process the request """
+
+
+def crypto_worker_socket_paths(count: int = app_config.CRYPTO_WORKER_PROCESSES, socket_dir: str = app_config.CRYPTO_WORKER_SOCKET_DIR):
+    return [os.path.join(socket_dir, f"billing-crypto-{idx}.sock") for idx in range(count)]
+
+
+def encode_items(items) -> bytes:
+    parts = [_LENGTH.pack(len(items))]
+    for each in items:
+        parts.append(_LENGTH.pack(len(each)))
+        parts.append(each)
+    return b"".join(parts)
+
+
+def decode_items(body: bytes, offset: int = 0) -> list:
+    count, = _LENGTH.unpack_from(body, offset)
+    offset += _LENGTH.size
+    items = []
+    for _ in range(count):
+        length, = _LENGTH.unpack_from(body, offset)
+        offset += _LENGTH.size
+        items.append(body[offset:offset + length])
+        offset += length
+    return items
+
+
+async def read_frame(reader: asyncio.StreamReader) -> bytes:
+    length, = _LENGTH.unpack(await reader.readexactly(_LENGTH.size))
+    return await reader.readexactly(length)
+
+
+def write_frame(writer: asyncio.StreamWriter, body: bytes):
+    writer.write(_LENGTH.pack(len(body)) + body)
+
+
+async def serve_crypto_worker(crypto_util, socket_path: str):
+    """ serves the requests of the consumer processes with crypto_util until cancelled """
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    stats = {"requests": 0, "payloads": 0, "crypto_time": 0.0, "started": time.time()}
+
+    async def handle_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    body = await read_frame(reader)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                try:
+                    items = decode_items(body, 1)
+                    if body[0:1] == ENCRYPT:
+                        ret, elapsed = await crypto_util.aetask_many(items)
+                    else:
+                        ret, elapsed = await crypto_util.adtask_many(items)
+                    response = OK + _ELAPSED.pack(elapsed) + encode_items([bytes(each) for each in ret])
+                    stats["requests"] += 1
+                    stats["payloads"] += len(items)
+                    stats["crypto_time"] += elapsed
+                except Exception as xcp:
+                    response = ERROR + str(xcp).encode("utf-8")
+                write_frame(writer, response)
+                await writer.drain()
+        finally:
+            writer.close()
+
+    server = await asyncio.start_unix_server(handle_client, path=socket_path)
+    logger.log_message(message=f"Crypto worker {os.getpid()} listening on {socket_path}", level="INFO")
+    try:
+        while True:
+            await asyncio.sleep(app_config.CRYPTO_WORKER_STATS_INTERVAL)
+            uptime = time.time() - stats["started"]
+            logger.log_json({
+                "message": "Crypto worker stats",
+                "socket_path": socket_path,
+                "requests": stats["requests"],
+                "payloads": stats["payloads"],
+                "payloads_per_sec": round(stats["payloads"] / uptime, 2),
+                "avg_crypto_time_per_payload_ms": round(stats["crypto_time"] / stats["payloads"] * 1000, 3) if stats["payloads"] else 0.0
+            }, level="INFO")
+    finally:
+        server.close()
+        await server.wait_closed()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+def run_crypto_worker(socket_path: str):
+    """ Process target: starts the crypto backend of this worker, the JVM by default, and serves the consumer processes """
+    from billing_consumer_new.helpers.crypto_backend import create_crypto_backend
+
+    async def main():
+        crypto_util = create_crypto_backend()
+        try:
+            await serve_crypto_worker(crypto_util, socket_path)
+        finally:
+            crypto_util.close()
+
+    asyncio.run(main())
+
+
+class WorkerConnections:
+    """ the connections of a consumer process to one crypto worker, a connection carries one request at a time """
+
+    def __init__(self, socket_path: str, max_inflight: int):
+        self.socket_path = socket_path
+        # a slot per request in flight, so at most max_inflight connections
+        self.slots = asyncio.Semaphore(max_inflight)
+        # requests sent or waiting for a slot
+        self.inflight = 0
+        # the connection idle for the longest time is reused first
+        self.idle = deque()
+
+    def close(self):
+        while self.idle:
+            _, writer = self.idle.popleft()
+            writer.close()
+
+
+class CryptoWorkerClient:
+    """
+    Same call shape as ContentHelper (aetask/adtask and the batch variants), the work is sent to the
+    crypto worker processes. Each request goes to the worker with the fewest requests in flight (round robin
+    among the ties), a worker gets at most max_inflight requests at a time, the others wait for a slot.
+    The connections of a worker are opened on demand and reused
+    """
+
+    def __init__(self, socket_paths: list, connect_timeout: float = app_config.CRYPTO_WORKER_CONNECT_TIMEOUT,
+                 max_inflight: int = app_config.CRYPTO_WORKER_MAX_INFLIGHT):
+        self.socket_paths = socket_paths
+        self.connect_timeout = connect_timeout
+        self.workers = [WorkerConnections(each, max_inflight) for each in socket_paths]
+        self._turn = itertools.count()
+
+    async def aetask(self, inp):
+        ret, elapsed = await self.aetask_many([inp])
+        return ret[0], elapsed
+
+    async def adtask(self, encrypted):
+        ret, elapsed = await self.adtask_many([encrypted])
+        return ret[0], elapsed
+
+    async def aetask_many(self, inps):
+        return await self._request(ENCRYPT, [bytes(each) for each in inps])
+
+    async def adtask_many(self, encrypted_items):
+        return await self._request(DECRYPT, [bytes(each) for each in encrypted_items])
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
+
+    def pick_worker(self) -> WorkerConnections:
+        """ the least loaded worker, the ties are broken round robin """
+        start = next(self._turn) % len(self.workers)
+        return min(self.workers[start:] + self.workers[:start], key=lambda worker: worker.inflight)
+
+    async def _request(self, op: bytes, items: list):
+        worker = self.pick_worker()
+        worker.inflight += 1
+        try:
+            async with worker.slots:
+                reader, writer = worker.idle.popleft() if worker.idle else await self._connect(worker.socket_path)
+                try:
+                    write_frame(writer, op + encode_items(items))
+                    await writer.drain()
+                    body = await read_frame(reader)
+                except BaseException:
+                    # the connection state is unknown, never reuse it
+                    writer.close()
+                    raise
+                worker.idle.append((reader, writer))
+        finally:
+            worker.inflight -= 1
+        if body[0:1] != OK:
+            raise CryptoWorkerError(body[1:].decode("utf-8"))
+        elapsed, = _ELAPSED.unpack_from(body, 1)
+        return decode_items(body, 1 + _ELAPSED.size), elapsed
+
+    async def _connect(self, socket_path: str):
+        """ the worker may still be starting its JVM, retry until connect_timeout """
+        deadline = time.monotonic() + self.connect_timeout
+        while True:
+            try:
+                return await asyncio.open_unix_connection(socket_path)
+            except (FileNotFoundError, ConnectionError):
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.5)
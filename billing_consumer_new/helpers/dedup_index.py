@@ -0,0 +1,74 @@
+""" This module contains the index of the billing transactions already written to RDS, used to skip the Kafka redeliveries """
+
+import time
+from collections import OrderedDict
+from billing_consumer_new.helpers import app_config, metrics
+from billing_consumer_new.helpers.app_logger import custom_logger as logger
+
+
+class TransactionDedupIndex:
+    """
+    Bounded LRU of the transaction ids written by this process, an entry expires after ttl_seconds.
+    With a mysql instance the ids missing from the index are looked up in the allout billing table,
+    during the first precheck_window_seconds after the start (0 for always), to catch the records
+    written before a restart or by the consumer that owned the partition before a rebalance
+    """
+
+    def __init__(self, max_size: int = app_config.DEDUP_MAX_SIZE, ttl_seconds: int = app_config.DEDUP_TTL_SECONDS,
+                 mysql=None, precheck_window_seconds: int = app_config.DEDUP_DB_PRECHECK_WINDOW_SECONDS):
+        self.max_size = max_size
+        self.ttl = ttl_seconds
+        self.mysql = mysql
+        self.precheck_until = None if precheck_window_seconds <= 0 else time.monotonic() + precheck_window_seconds
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, transaction_id: str) -> bool:
+        written_at = self._entries.get(transaction_id)
+        if written_at is None:
+            return False
+        if time.monotonic() - written_at > self.ttl:
+            del self._entries[transaction_id]
+            return False
+        self._entries.move_to_end(transaction_id)
+        return True
+
+    def mark(self, transaction_ids):
+        """ records transactions written to RDS """
+        now = time.monotonic()
+        for each in transaction_ids:
+            self._entries[each] = now
+            self._entries.move_to_end(each)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        metrics.DEDUP_INDEX_SIZE.set(len(self._entries))
+
+    async def find_duplicates(self, transaction_ids: list) -> set:
+        """ returns the transactions of the list already written to RDS """
+        duplicates = {each for each in transaction_ids if each in self}
+        metrics.DEDUP_LOOKUPS.inc(len(duplicates), result="hit")
+        missing = [each for each in transaction_ids if each not in duplicates]
+        if missing and self.precheck_active():
+            try:
+                written = await self.mysql.select_existing(app_config.ALLOUT_BILLING_TABLE_NAME, "transaction_id", missing)
+            except Exception as xcp:
+                # the DB constraints still reject the duplicates
+                written = set()
+                logger.log_message(
+                    message=f"Error in the dedup pre-check of {len(missing)} transactions: {str(xcp)}",
+                    level="ERROR"
+                )
+            if written:
+                self.mark(written)
+                duplicates |= written
+                metrics.DEDUP_LOOKUPS.inc(len(written), result="db_hit")
+                missing = [each for each in missing if each not in written]
+        metrics.DEDUP_LOOKUPS.inc(len(missing), result="miss")
+        return duplicates
+
+    def precheck_active(self) -> bool:
+        if self.mysql is None:
+            return False
+        return self.precheck_until is None or time.monotonic() < self.precheck_until
@@ -0,0 +1,95 @@
+""" This module contains the write-behind buffer that group commits the billing records of all the consumers of a process """
+
+import asyncio
+from billing_consumer_new.helpers import app_config
+from billing_consumer_new.helpers.app_logger import custom_logger as logger
+from billing_consumer_new.helpers.sql_util import aio_mysql
+
+
+class PendingGroup:
+    """ records waiting for the same tables """
+
+    def __init__(self):
+        self.contributions = []
+        self.size = 0
+        self.timer = None
+
+
+class GroupCommitWriter:
+    """
+    Write-behind aggregator shared by all the BillingConsumer tasks of a process.
+    bulk_insert_data has the signature of aio_mysql.bulk_insert_data, the records of every caller
+    are merged and written with a single aio_mysql.bulk_insert_data call once max_records allout
+    records are pending or max_delay_ms elapsed since the first one. Each call returns its own
+    rejected records once the shared write is done, the consumer then commits its offsets
+    """
+
+    def __init__(self, mysql: aio_mysql, max_records: int = app_config.GROUP_COMMIT_MAX_RECORDS,
+                 max_delay_ms: int = app_config.GROUP_COMMIT_MAX_DELAY_MS):
+        self.mysql = mysql
+        self.max_records = max_records
+        self.max_delay = max_delay_ms / 1000
+        self._groups = {}
+        self._writes = set()
+
+    async def bulk_insert_data(self, table_1: str, columns_1: tuple, data_1: list, table_2: str, columns_2: tuple, data_2: list, mode: str = None):
+        loop = asyncio.get_running_loop()
+        key = (table_1, tuple(columns_1), table_2, tuple(columns_2), mode)
+        group = self._groups.get(key)
+        if group is None:
+            group = self._groups[key] = PendingGroup()
+            group.timer = loop.call_later(self.max_delay, self._flush, key)
+
+        future = loop.create_future()
+        group.contributions.append((data_1, data_2, future))
+        group.size += len(data_1)
+        if group.size >= self.max_records:
+            self._flush(key)
+        # the shared write goes on even if this caller is cancelled
+        return await asyncio.shield(future)
+
+    async def flush(self):
+        """ writes every pending group now and waits for the writes in progress """
+        for key in list(self._groups):
+            self._flush(key)
+        if self._writes:
+            await asyncio.gather(*self._writes, return_exceptions=True)
+
+    def _flush(self, key):
+        group = self._groups.pop(key, None)
+        if group is None:
+            return
+        group.timer.cancel()
+        task = asyncio.create_task(self._write(key, group))
+        self._writes.add(task)
+        task.add_done_callback(self._writes.discard)
+
+    async def _write(self, key, group: PendingGroup):
+        table_1, columns_1, table_2, columns_2, mode = key
+        data_1 = [row for data, _, _ in group.contributions for row in data]
+        data_2 = [row for _, data, _ in group.contributions for row in data]
+        try:
+            rejected_1, rejected_2 = await self.mysql.bulk_insert_data(table_1, columns_1, data_1, table_2, columns_2, data_2, mode=mode)
+        except Exception as xcp:
+            logger.log_message(
+                message=f"Error in the group commit of {len(group.contributions)} batches: {str(xcp)}",
+                level="ERROR"
+            )
+            for _, _, future in group.contributions:
+                if not future.done():
+                    future.set_exception(xcp)
+            return
+
+        logger.log_message(
+            message=f"Group committed {len(data_1)} records of {table_1} and {len(data_2)} records of {table_2} from {len(group.contributions)} batches",
+            level="DEBUG"
+        )
+        # hand every caller back its own rejected rows, the rows are the objects it passed in
+        rejected_ids_1 = {id(row) for row in rejected_1}
+        rejected_ids_2 = {id(row) for row in rejected_2}
+        for contribution_1, contribution_2, future in group.contributions:
+            if not future.done():
+                future.set_result((
+                    [row for row in contribution_1 if id(row) in rejected_ids_1],
+                    [row for row in contribution_2 if id(row) in rejected_ids_2]
+                ))
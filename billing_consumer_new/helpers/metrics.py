@@ -0,0 +1,292 @@
+"""
+In-process metrics of the billing consumer, rendered in the Prometheus text format by the /metrics route.
+
+Every consumer process has its own registry and its own web app on the shared reuse_port port, a scrape
+is answered by one of the processes. MultiProcessExporter shares the registries through a directory so that
+process renders the series of all of them. The series carry a pid label so the processes never overwrite each other.
+"""
+
+import os
+import json
+import time
+import glob
+import bisect
+import asyncio
+from contextlib import contextmanager
+from billing_consumer_new.helpers import app_config
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+_LABEL_ESCAPES = str.maketrans({"\\": "\\\\", '"': '\\"', "\n": "\\n"})
+
+
+def _format_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{str(value).translate(_LABEL_ESCAPES)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def render_snapshots(snapshots: list) -> str:
+    """ renders registry snapshots, the samples of a metric in several snapshots are rendered under one HELP and TYPE """
+    merged = {}
+    for snapshot in snapshots:
+        for name, metric in snapshot.items():
+            merged.setdefault(name, {"help": metric["help"], "type": metric["type"], "samples": []})["samples"].extend(metric["samples"])
+    lines = []
+    for name, metric in merged.items():
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+        for suffix, names, values, value in metric["samples"]:
+            lines.append(f"{name}{suffix}{_format_labels(names, values)} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+class Metric:
+    """ a named metric, one value per combination of label values """
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = ("pid",) + tuple(labelnames)
+        self._values = {}
+
+    def _key(self, labels: dict) -> tuple:
+        return (os.getpid(),) + tuple(labels[name] for name in self.labelnames[1:])
+
+    def samples(self):
+        """ yields (suffix, label names, label values, value) """
+        for key, value in self._values.items():
+            yield "", self.labelnames, key, value
+
+    def snapshot(self) -> dict:
+        return {"help": self.documentation, "type": self.type, "samples": list(self.samples())}
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+    def remove(self, **labels):
+        self._values.pop(self._key(labels), None)
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels))
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            # bucket counts (the last one is +Inf), sum, count
+            state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        st = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - st, **labels)
+
+    def count(self, **labels):
+        state = self._values.get(self._key(labels))
+        return state[2] if state else 0
+
+    def samples(self):
+        bucket_names = self.labelnames + ("le",)
+        for key, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, each in zip(self.buckets + (float("inf"),), counts):
+                cumulative += each
+                yield "_bucket", bucket_names, key + (_format_value(bound),), cumulative
+            yield "_sum", self.labelnames, key, total
+            yield "_count", self.labelnames, key, count
+
+
+class MetricsRegistry:
+    """ holds the metrics of the process, collectors refresh the gauges that are only read at scrape time """
+
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+
+    def _register(self, metric: Metric) -> Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: tuple = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def add_collector(self, collector):
+        """ collector() is called before each render """
+        self._collectors.append(collector)
+
+    def remove_collector(self, collector):
+        if collector in self._collectors:
+            self._collectors.remove(collector)
+
+    def snapshot(self) -> dict:
+        """ name -> help, type and samples of every metric, after running the collectors """
+        for collector in self._collectors:
+            collector()
+        return {name: metric.snapshot() for name, metric in self._metrics.items()}
+
+    def render(self) -> str:
+        return render_snapshots([self.snapshot()])
+
+
+def _is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def clear_multiprocess_dir(directory: str):
+    """ called by the supervisor before it starts the processes, drops the snapshots of a previous run """
+    os.makedirs(directory, exist_ok=True)
+    for path in glob.glob(os.path.join(directory, "*.json")):
+        os.remove(path)
+
+
+class MultiProcessExporter:
+    """
+    Writes the snapshot of the registry of the process to directory/<pid>.json every interval seconds.
+    render() answers a scrape with the live registry of the process and the last snapshots of the other
+    live processes, so the series of the other processes are at most interval seconds old.
+    The snapshot of a dead process is deleted, its series end with it like the series of a restarted exporter
+    """
+
+    def __init__(self, directory: str = app_config.METRICS_MULTIPROC_DIR, registry: MetricsRegistry = None,
+                 interval: float = app_config.METRICS_WRITE_INTERVAL_MS / 1000):
+        self.directory = directory
+        self.registry = registry or REGISTRY
+        self.interval = interval
+        self.path = os.path.join(directory, f"{os.getpid()}.json")
+        self._task = None
+
+    def write(self):
+        """ replaces the snapshot file at once, a reader never sees a partial file """
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as snapshot_file:
+            json.dump(self.registry.snapshot(), snapshot_file)
+        os.replace(temp_path, self.path)
+
+    def read_others(self) -> list:
+        snapshots = []
+        for path in sorted(glob.glob(os.path.join(self.directory, "*.json"))):
+            if path == self.path:
+                continue
+            try:
+                pid = int(os.path.basename(path)[:-len(".json")])
+                if not _is_alive(pid):
+                    os.remove(path)
+                    continue
+                with open(path, encoding="utf-8") as snapshot_file:
+                    snapshots.append(json.load(snapshot_file))
+            except (ValueError, OSError):
+                # not a snapshot, or removed meanwhile
+                continue
+        return snapshots
+
+    def render(self) -> str:
+        return render_snapshots([self.registry.snapshot()] + self.read_others())
+
+    async def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.write()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.write()
+            except OSError:
+                # the next write tries again, the scrapes see the previous snapshot meanwhile
+                continue
+
+
+REGISTRY = MetricsRegistry()
+
+# Stages: decode, pii, format, encrypt, db_insert (per batch), db_write_chunk, db_commit (per chunk), offset_commit (per commit call)
+STAGE_LATENCY = REGISTRY.histogram("billing_stage_duration_seconds", "Time spent per batch in each stage of the billing path", ("stage",))
+# Time reported by the ContentHelper for the cipher calls, without the executor queueing
+CRYPTO_LATENCY = REGISTRY.histogram("billing_crypto_duration_seconds", "Cipher time reported by the crypto util per encrypt call")
+VALIDATION_FAILURES = REGISTRY.counter("billing_validation_failures_total", "Billing messages rejected by the schema validation")
+# reason: retry (a transient error restarted the write), split (a chunk failing on its data was bisected), rejected (a row was dropped)
+DB_FALLBACKS = REGISTRY.counter("billing_db_fallbacks_total", "Bulk inserts that left the fast path", ("table", "reason"))
+RECORDS_WRITTEN = REGISTRY.counter("billing_records_written_total", "Billing records inserted to RDS", ("table",))
+# result: retried (fetched again after the backoff), dead_lettered (sent to the dead-letter topic after the last retry, then committed)
+BATCH_RETRIES = REGISTRY.counter("billing_batch_retries_total", "Partition batches whose handler raised", ("result",))
+CONSUMER_LAG = REGISTRY.gauge("billing_consumer_lag", "Messages between the committed offset and the highwater of the partition", ("topic", "partition"))
+BATCH_MAX_RECORDS = REGISTRY.gauge("billing_batch_max_records", "Records fetched per poll chosen by the adaptive batch controller", ("consumer",))
+BATCH_RECORD_SECONDS = REGISTRY.gauge("billing_batch_record_seconds", "Moving average of the end-to-end time per record seen by the adaptive batch controller", ("consumer",))
+# result: hit (in the index), db_hit (found by the pre-check query), miss
+DEDUP_LOOKUPS = REGISTRY.counter("billing_dedup_lookups_total", "Transactions checked against the dedup index", ("result",))
+DEDUP_INDEX_SIZE = REGISTRY.gauge("billing_dedup_index_size", "Transactions held by the dedup index")
+FAILURES_ROUTED = REGISTRY.counter("billing_failures_routed_total", "Failed billing messages sent to the retry or dead-letter topic", ("topic", "stage"))
+PIPELINE_STATS = REGISTRY.gauge("billing_pipeline_stage", "Stats of the billing pipeline stages", ("stage", "stat"))
+# reason: queue_full (dropped by the bounded log queue), sampled, rate_limited (per event type)
+LOG_RECORDS_DROPPED = REGISTRY.counter("billing_log_records_dropped_total", "Log records that were not emitted", ("reason",))
+DB_POOL_WAIT = REGISTRY.histogram("billing_db_pool_wait_seconds", "Time waited for a free MySQL connection slot")
+# state: in_use, free
+DB_POOL_CONNECTIONS = REGISTRY.gauge("billing_db_pool_connections", "Connections of the MySQL pool", ("state",))
+# reason: closed, recycled (older than the recycle time), ping_failed (idle connection that did not answer the ping)
+DB_POOL_DISCARDED = REGISTRY.counter("billing_db_pool_discarded_total", "MySQL connections dropped by the pool", ("reason",))
+SINK_ROWS_WRITTEN = REGISTRY.counter("billing_sink_rows_written_total", "Billing rows appended to the columnar sink files", ("table",))
+# result: uploaded, failed (kept on disk and uploaded with the next roll)
+SINK_FILES = REGISTRY.counter("billing_sink_files_total", "Columnar sink files closed and uploaded to S3", ("result",))
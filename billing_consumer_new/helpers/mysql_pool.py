@@ -0,0 +1,153 @@
+""" This module contains the connection pool of aio_mysql, with parallel warmup and validation of the idle connections """
+
+import time
+import asyncio
+import contextlib
+from billing_consumer_new.helpers import app_config, metrics
+from billing_consumer_new.helpers.app_logger import custom_logger as logger
+
+
+def mysql_pool_size(num_consumers: int) -> int:
+    """ one connection per task that can write at the same time, MYSQL_POOL_SIZE overrides it """
+    if app_config.MYSQL_POOL_SIZE > 0:
+        return app_config.MYSQL_POOL_SIZE
+    if app_config.BILLING_PIPELINE_ENABLED:
+        # the write workers of the pipeline are the only writers of the consumers
+        writers = app_config.BILLING_PIPELINE_WRITE_WORKERS
+    else:
+        # each consumer, and the retry consumer, writes up to KAFKA_PARTITION_CONCURRENCY partition batches at once
+        consumers = num_consumers + (1 if app_config.BILLING_RETRY_ENABLED else 0)
+        writers = consumers * max(app_config.KAFKA_PARTITION_CONCURRENCY, 1)
+    if app_config.DEDUP_ENABLED and app_config.DEDUP_DB_PRECHECK:
+        writers += 1
+    return writers
+
+
+class MySQLPool:
+    """
+    Pool of at most maxsize connections made by connect(), a coroutine function.
+    warmup() opens minsize connections in parallel, so the first batches do not pay the TCP, TLS and auth round trips.
+    A connection is checked before it is lent: a connection older than recycle seconds is replaced and a connection
+    idle for more than ping_idle seconds is pinged first, a dead one is replaced by a new connection.
+    The most recently released connection is lent first, the others stay idle and are pinged or recycled.
+    """
+
+    def __init__(self, connect, minsize: int, maxsize: int, recycle: float = app_config.MYSQL_POOL_RECYCLE_SECONDS,
+                 ping_idle: float = app_config.MYSQL_POOL_PING_IDLE_SECONDS):
+        if maxsize < 1 or minsize > maxsize:
+            raise ValueError(f"Invalid pool size {minsize}-{maxsize}")
+        self._connect = connect
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.recycle = recycle
+        self.ping_idle = ping_idle
+        # (connection, opened at, released at), the last one is lent first
+        self._free = []
+        self._used = {}
+        # a permit per connection lent or being opened
+        self._permits = asyncio.Semaphore(maxsize)
+        self._closing = False
+
+    @property
+    def size(self) -> int:
+        return len(self._free) + len(self._used)
+
+    @property
+    def freesize(self) -> int:
+        return len(self._free)
+
+    async def warmup(self) -> int:
+        """ opens the missing connections up to minsize in parallel, returns the number of connections opened """
+        missing = max(self.minsize - self.size, 0)
+        results = await asyncio.gather(*[self._connect() for _ in range(missing)], return_exceptions=True)
+        now = time.monotonic()
+        opened = 0
+        for result in results:
+            if isinstance(result, BaseException):
+                logger.log_message(message=f"Error in opening a MySQL connection: {str(result)}", level="ERROR")
+            else:
+                self._free.append((result, now, now))
+                opened += 1
+        self._update_metrics()
+        if missing and not opened:
+            raise results[0]
+        return opened
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        connection = await self._acquire()
+        try:
+            yield connection
+        finally:
+            self.release(connection)
+
+    async def _acquire(self):
+        if self._closing:
+            raise RuntimeError("Cannot acquire a connection after closing the pool")
+        st = time.perf_counter()
+        await self._permits.acquire()
+        metrics.DB_POOL_WAIT.observe(time.perf_counter() - st)
+        try:
+            connection, opened_at = await self._take()
+        except BaseException:
+            self._permits.release()
+            raise
+        self._used[connection] = opened_at
+        self._update_metrics()
+        return connection
+
+    async def _take(self):
+        """ the most recent valid free connection, or a new one """
+        while self._free:
+            connection, opened_at, released_at = self._free.pop()
+            if await self._validate(connection, opened_at, released_at):
+                return connection, opened_at
+        connection = await self._connect()
+        return connection, time.monotonic()
+
+    async def _validate(self, connection, opened_at: float, released_at: float) -> bool:
+        now = time.monotonic()
+        if connection.closed:
+            reason = "closed"
+        elif self.recycle > 0 and now - opened_at > self.recycle:
+            reason = "recycled"
+        elif self.ping_idle >= 0 and now - released_at > self.ping_idle:
+            try:
+                await connection.ping(reconnect=False)
+                return True
+            except Exception:
+                reason = "ping_failed"
+        else:
+            return True
+        metrics.DB_POOL_DISCARDED.inc(reason=reason)
+        connection.close()
+        return False
+
+    def release(self, connection):
+        """ puts the connection back, a connection left in a transaction or released after close() is closed """
+        opened_at = self._used.pop(connection)
+        self._permits.release()
+        if connection.closed:
+            metrics.DB_POOL_DISCARDED.inc(reason="closed")
+        elif self._closing or connection.get_transaction_status():
+            connection.close()
+        else:
+            self._free.append((connection, opened_at, time.monotonic()))
+        self._update_metrics()
+
+    def close(self):
+        """ closes the free connections, the lent ones are closed when they are released """
+        self._closing = True
+        while self._free:
+            connection, _, _ = self._free.pop()
+            connection.close()
+        self._update_metrics()
+
+    async def wait_closed(self):
+        """ waits for the lent connections to be released """
+        while self._used:
+            await asyncio.sleep(0.05)
+
+    def _update_metrics(self):
+        metrics.DB_POOL_CONNECTIONS.set(len(self._used), state="in_use")
+        metrics.DB_POOL_CONNECTIONS.set(len(self._free), state="free")
@@ -1,30 +1,59 @@
 
 """ This module contains the class for connecting to MySQL Database and inserting data into it """
 
+import os
+import time
+import asyncio
+import datetime
+import tempfile
+import functools
 import aiomysql
+import pymysql
 from ascendops_commonlib.ops_utils import ops_config
 from billing_consumer_new.helpers.app_logger import custom_logger as logger
+from billing_consumer_new.helpers.async_cputhread import cpu_task
 from ascendops_commonlib.aws_utils.secrets_manager_util import SecretsManagerUtil
-from billing_consumer_new.helpers import app_config
+from billing_consumer_new.helpers import app_config, metrics
+from billing_consumer_new.helpers.mysql_pool import MySQLPool
+
+# Write modes of bulk_insert_data
+WRITE_MODE_EXECUTEMANY = "executemany"  # cursor.executemany with the single row INSERT
+WRITE_MODE_VALUES = "values"            # one multi-row INSERT ... VALUES statement per chunk
+WRITE_MODE_LOAD_DATA = "load_data"      # LOAD DATA LOCAL INFILE per chunk, for backfills and catch-up
+WRITE_MODES = (WRITE_MODE_EXECUTEMANY, WRITE_MODE_VALUES, WRITE_MODE_LOAD_DATA)
+
 
 class aio_mysql:
-    def __init__(self): 
-        self.secret_json = SecretsManagerUtil().get_secret(secret_name=app_config.ANALYTICS_RDS_KEY_NAME)
+    def __init__(self, secret_json: dict = None): 
+        # fetched by connect() off the event loop when not given
+        self.secret_json = secret_json
         self.connection_pool = None
 
-    async def connect(self, size=4):
+    async def load_secret(self) -> dict:
+        if self.secret_json is None:
+            self.secret_json = await asyncio.get_running_loop().run_in_executor(
+                None, functools.partial(SecretsManagerUtil().get_secret, secret_name=app_config.ANALYTICS_RDS_KEY_NAME))
+        return self.secret_json
+
+    async def open_connection(self):
+        return await aiomysql.connect(
+            host=self.secret_json["host"],
+            user=self.secret_json["username"],
+            password=self.secret_json["password"],
+            db=app_config.ANALYTICS_RDS_DATABASE_SCHEMA,
+            port=self.secret_json["port"],
+            connect_timeout=app_config.MYSQL_CONNECT_TIMEOUT,
+            local_infile=app_config.MYSQL_LOCAL_INFILE
+        )
+
+    async def connect(self, size=4, minsize=None):
+        """ opens a pool of at most size connections, minsize of them (all by default) are opened now in parallel """
         try:
-            self.connection_pool = await aiomysql.create_pool(
-                host=self.secret_json["host"],
-                user=self.secret_json["username"],
-                password=self.secret_json["password"],
-                db=app_config.ANALYTICS_RDS_DATABASE_SCHEMA,
-                port=self.secret_json["port"],
-                maxsize=size,
-                pool_recycle=10800
-            )
+            await self.load_secret()
+            self.connection_pool = MySQLPool(self.open_connection, size if minsize is None else minsize, size)
+            opened = await self.connection_pool.warmup()
             logger.log_message(
-                message="Successfully connected to SQL Database",
+                message=f"Successfully connected to SQL Database, {opened} of {size} connections opened",
                 level="INFO"
             )
         except Exception as xcp:
@@ -33,67 +62,243 @@ class aio_mysql:
                 level="ERROR"
             )
 
-    async def bulk_insert_data(self, table_1: str, columns_1: tuple, data_1: list, table_2: str, columns_2: tuple, data_2: list):
+    async def close(self):
+        if self.connection_pool is not None:
+            self.connection_pool.close()
+            await self.connection_pool.wait_closed()
+
+    async def bulk_insert_data(self, table_1: str, columns_1: tuple, data_1: list, table_2: str, columns_2: tuple, data_2: list, mode: str = None):
         """
         Inserts data into 2 tables in RDS
+        The rows of both tables are grouped per transaction (first column) and the transactions are split in chunks of
+        at most MYSQL_CHUNK_BYTES. The rows of a chunk are committed in one DB transaction, so a transaction is written
+        to both tables or to none. A chunk failing on its data is rolled back and split in halves until the failing
+        transactions are isolated, so the good transactions are still committed in bulk.
+        Transient errors (lost connection, deadlock) are retried up to MYSQL_WRITE_ATTEMPTS times, after a backoff
+        doubling from MYSQL_WRITE_RETRY_BACKOFF_MS, on a new connection with the chunks that are not committed yet,
+        committed chunks are never sent twice.
+        A row already in the table is left as is and counts as written, so a redelivered transaction is not rejected.
         Args:
             table_1 (str): The name of the MySQL table to insert data into.
             columns_1 (tuple): A tuple of column names to insert data into.
             table_2 (str): The name of the MySQL table to insert data into.
             columns_2 (tuple): A tuple of column names to insert data into.     
+            mode (str): one of WRITE_MODES, defaults to MYSQL_WRITE_MODE.
+                With load_data, MySQL skips bad values with a warning instead of an error,
+                so those rows are not reported as rejected.
+        Returns:
+            tuple: the rows of table_1 and the rows of table_2 that could not be inserted
         """    
-        try:
-            query_1 = f"INSERT INTO {table_1} ({', '.join(columns_1)}) VALUES ({', '.join(['%s' for _ in range(len(columns_1))])})"
-            query_2 = f"INSERT INTO {table_2} ({', '.join(columns_2)}) VALUES ({', '.join(['%s' for _ in range(len(columns_2))])})"
-            for _ in range(3):
+        mode = mode or app_config.MYSQL_WRITE_MODE
+        if mode not in WRITE_MODES:
+            raise ValueError(f"Unknown write mode {mode}")
+        tables = ((table_1, tuple(columns_1)), (table_2, tuple(columns_2)))
+        # pending chunks are inserted last chunk first
+        pending = chunk_transactions(data_1, data_2, app_config.MYSQL_CHUNK_BYTES)[::-1]
+        rejected_1 = []
+        rejected_2 = []
+        attempts = max(app_config.MYSQL_WRITE_ATTEMPTS, 1)
+        for attempt in range(attempts):
+            try:
                 async with self.connection_pool.acquire() as connection:
-                    async with connection.cursor() as cursor:
-                        try:
-                            await cursor.executemany(query_1, data_1)
-                            logger.log_message(
-                                message=f"Inserted records to {table_1}",
-                                level="INFO"
-                            )
-                            await cursor.executemany(query_2, data_2)
-                            logger.log_message(
-                                message=f"Inserted records to {table_2}",
-                                level="INFO"
-                            )
-                            await connection.commit()
-                            logger.log_message(
-                                message="Commited",
-                                level="INFO"
-                            )
-                            break
-                        except Exception as xcp:
-                            await connection.rollback()
-                            logger.log_message(
-                                message=f"RDS writes using execute started: {str(xcp)}",
-                                level="ERROR"
-                            )
-                            for record_1 in data_1:
-                                try:
-                                    await cursor.execute(query_1, record_1)
-                                    await connection.commit()
-                                except Exception as error:
-                                    await connection.rollback()
-                                    logger.log_message(
-                                        message=f"Error in inserting the record to {app_config.ALLOUT_BILLING_TABLE_NAME}: {str(error)}",
-                                        level="ERROR"
-                                    )
-
-                            for record_2 in data_2:
-                                try:
-                                    await cursor.execute(query_2, record_2)
-                                    await connection.commit()
-                                except Exception as error:
-                                    await connection.rollback()
-                                    logger.log_message(
-                                        message=f"Error in inserting the record to {app_config.PRODUCT_CODES_BILLING_TABLE_NAME}: {str(error)}",
-                                        level="ERROR"
-                                    )
-        except Exception as xcp:
+                    await self._insert_bisect(connection, mode, tables, pending, rejected_1, rejected_2)
+                break
+            except Exception as xcp:
+                metrics.DB_FALLBACKS.inc(table=table_1, reason="retry")
+                logger.log_message(
+                    message=f"Error in writing to RDS (attempt {attempt + 1}): {str(xcp)}",
+                    level="ERROR"
+                )
+                if attempt + 1 < attempts:
+                    # gives a failover or a deadlock time to clear before the next attempt
+                    await asyncio.sleep(app_config.MYSQL_WRITE_RETRY_BACKOFF_MS / 1000 * 2 ** attempt)
+
+        # chunks still pending after the last attempt were never written
+        for chunk in pending:
+            for rows_1, rows_2 in chunk:
+                rejected_1.extend(rows_1)
+                rejected_2.extend(rows_2)
+        if rejected_1 or rejected_2:
             logger.log_message(
-                message=f"Error acquiring connection to MySQL: {str(xcp)}",
+                message=f"Rejected {len(rejected_1)} records of {table_1} and {len(rejected_2)} records of {table_2}",
                 level="ERROR"
             )
+        return rejected_1, rejected_2
+
+    async def select_existing(self, table: str, column: str, values: list) -> set:
+        """ returns the values of the list present in the column of the table """
+        existing = set()
+        for start in range(0, len(values), 1000):
+            chunk = values[start:start + 1000]
+            async with self.connection_pool.acquire() as connection:
+                async with connection.cursor() as cursor:
+                    await cursor.execute(f"SELECT {column} FROM {table} WHERE {column} IN ({', '.join(['%s'] * len(chunk))})", chunk)
+                    existing.update(row[0] for row in await cursor.fetchall())
+                # ends the transaction the SELECT opened, so the pool takes the connection back instead of closing it
+                await connection.rollback()
+        return existing
+
+    async def _insert_bisect(self, connection, mode: str, tables: tuple, pending: list, rejected_1: list, rejected_2: list):
+        """
+        Inserts the chunks of pending, last chunk first, a chunk is a list of (rows of table 1, rows of table 2) per transaction.
+        A committed chunk is removed from pending, a chunk failing on its data is replaced by its two halves,
+        the rows of a single failing transaction go to rejected_1 and rejected_2.
+        Transient errors are raised with the failing chunk still in pending
+        """
+        (table_1, columns_1), (table_2, columns_2) = tables
+        while pending:
+            chunk = pending[-1]
+            chunk_1 = [row for rows_1, _ in chunk for row in rows_1]
+            chunk_2 = [row for _, rows_2 in chunk for row in rows_2]
+            try:
+                st = time.perf_counter()
+                if chunk_1:
+                    await self._write_chunk(connection, mode, table_1, columns_1, chunk_1)
+                if chunk_2:
+                    await self._write_chunk(connection, mode, table_2, columns_2, chunk_2)
+                written = time.perf_counter()
+                await connection.commit()
+                metrics.STAGE_LATENCY.observe(time.perf_counter() - written, stage="db_commit")
+                metrics.STAGE_LATENCY.observe(written - st, stage="db_write_chunk")
+                metrics.RECORDS_WRITTEN.inc(len(chunk_1), table=table_1)
+                metrics.RECORDS_WRITTEN.inc(len(chunk_2), table=table_2)
+                pending.pop()
+                logger.log_message(
+                    message="Inserted %s records to %s and %s records to %s",
+                    level="INFO",
+                    args=(len(chunk_1), table_1, len(chunk_2), table_2),
+                    event="db_chunk_written"
+                )
+            except Exception as xcp:
+                if is_transient_error(xcp):
+                    raise
+                await connection.rollback()
+                pending.pop()
+                if len(chunk) == 1:
+                    metrics.DB_FALLBACKS.inc(table=table_1, reason="rejected")
+                    rejected_1.extend(chunk_1)
+                    rejected_2.extend(chunk_2)
+                    logger.log_message(
+                        message=f"Error in inserting the records to {table_1} and {table_2}: {str(xcp)}",
+                        transaction_id=(chunk_1 or chunk_2)[0][0],
+                        level="ERROR"
+                    )
+                else:
+                    metrics.DB_FALLBACKS.inc(table=table_1, reason="split")
+                    middle = len(chunk) // 2
+                    pending.append(chunk[middle:])
+                    pending.append(chunk[:middle])
+                    logger.log_message(
+                        message=f"Splitting {len(chunk)} transactions after: {str(xcp)}",
+                        level="WARNING"
+                    )
+
+    async def _write_chunk(self, connection, mode: str, table: str, columns: tuple, chunk: list):
+        async with connection.cursor() as cursor:
+            if mode == WRITE_MODE_VALUES:
+                # a tuple subclass is escaped as its repr, the row types are NamedTuples
+                await cursor.execute(values_statement(table, columns) + ",".join(connection.escape(tuple(row)) for row in chunk)
+                                     + duplicate_key_clause(columns))
+            elif mode == WRITE_MODE_LOAD_DATA:
+                file_path = await write_load_data_file(chunk)
+                try:
+                    await cursor.execute(load_data_statement(table, columns), (file_path,))
+                finally:
+                    os.remove(file_path)
+            else:
+                await cursor.executemany(insert_statement(table, columns), chunk)
+
+
+@functools.lru_cache(maxsize=32)
+def insert_statement(table: str, columns: tuple) -> str:
+    """ single row INSERT used with executemany """
+    return (f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join(['%s' for _ in range(len(columns))])})"
+            + duplicate_key_clause(columns))
+
+
+@functools.lru_cache(maxsize=32)
+def values_statement(table: str, columns: tuple) -> str:
+    """ multi-row INSERT, the escaped rows are appended comma separated, then duplicate_key_clause """
+    return f"INSERT INTO {table} ({', '.join(columns)}) VALUES "
+
+
+@functools.lru_cache(maxsize=32)
+def duplicate_key_clause(columns: tuple) -> str:
+    """
+    leaves a row already in the table as is instead of failing on the duplicate key, unlike INSERT IGNORE
+    the other data errors still fail the statement. LOAD DATA skips the duplicates on its own
+    """
+    return f" ON DUPLICATE KEY UPDATE {columns[0]} = {columns[0]}"
+
+
+@functools.lru_cache(maxsize=32)
+def load_data_statement(table: str, columns: tuple) -> str:
+    return (f"LOAD DATA LOCAL INFILE %s INTO TABLE {table} CHARACTER SET utf8mb4 "
+            f"FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' LINES TERMINATED BY '\\n' ({', '.join(columns)})")
+
+
+def estimate_row_size(row) -> int:
+    """ approximate size of an escaped row in a statement: quotes, separators and the values """
+    return 2 + sum(len(str(value)) + 3 for value in row)
+
+
+def chunk_transactions(rows_1: list, rows_2: list, max_bytes: int) -> list:
+    """
+    groups the rows of both tables per transaction (first column) in (rows of table 1, rows of table 2) pairs,
+    then splits the transactions in consecutive chunks of at most max_bytes, a transaction larger than max_bytes
+    is a chunk on its own. The rows of a transaction are never split across chunks
+    """
+    transactions = {}
+    for idx, rows in enumerate((rows_1, rows_2)):
+        for row in rows or []:
+            transactions.setdefault(row[0], ([], []))[idx].append(row)
+    chunks = []
+    chunk = []
+    chunk_size = 0
+    for transaction in transactions.values():
+        transaction_size = sum(estimate_row_size(row) for rows in transaction for row in rows)
+        if chunk and chunk_size + transaction_size > max_bytes:
+            chunks.append(chunk)
+            chunk = []
+            chunk_size = 0
+        chunk.append(transaction)
+        chunk_size += transaction_size
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+_LOAD_DATA_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r", "\0": "\\0"})
+
+
+def load_data_value(value) -> str:
+    """ a value in the tab separated LOAD DATA format """
+    if value is None:
+        return "\\N"
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, datetime.datetime):
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    return str(value).translate(_LOAD_DATA_ESCAPES)
+
+
+@cpu_task
+def write_load_data_file(rows: list) -> str:
+    with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=app_config.APP_TEMP_DIR, suffix=".tsv", delete=False) as load_file:
+        for row in rows:
+            load_file.write("\t".join(load_data_value(value) for value in row))
+            load_file.write("\n")
+    return load_file.name
+
+
+def is_transient_error(xcp: Exception) -> bool:
+    """
+    Errors worth retrying with the same rows: client/connection errors (2xxx), lock wait timeout and deadlock.
+    Every other server error is caused by the data, e.g. duplicate key or data too long
+    """
+    if isinstance(xcp, pymysql.err.InterfaceError):
+        return True
+    if isinstance(xcp, pymysql.err.OperationalError):
+        code = xcp.args[0] if xcp.args and isinstance(xcp.args[0], int) else 0
+        return code >= 2000 or code in (1205, 1213)
+    return isinstance(xcp, (asyncio.TimeoutError, ConnectionError))
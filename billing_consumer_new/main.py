@@ -1,86 +1,231 @@
 
 """ Main module for the billing consumer application """
 
-import time
+import signal
 import logging
 import asyncio
 import os, sys
 import multiprocessing
 from aiohttp import web
-from multiprocessing import Process
 from helpers import app_config
 from helpers import app_logger
 from helpers import async_cputhread
 from helpers.sql_util import aio_mysql
+from helpers.group_commit import GroupCommitWriter
 from helpers.boto3_sessions import AIOBoto3Session
 from start_up.billing_consumer import BillingConsumer
+from start_up.failure_router import BillingFailureRouter
+from start_up.supervisor import ProcessSupervisor
 from ascendops_commonlib.app_utils.kafka_util import KafkaWriter
-from billing_consumer_new.helpers.crypto_util import ContentHelper
+from billing_consumer_new.helpers import metrics
+from billing_consumer_new.helpers.app_logger import custom_logger as logger
+from billing_consumer_new.helpers.crypto_backend import create_crypto_backend
+from billing_consumer_new.helpers.mysql_pool import mysql_pool_size
+from billing_consumer_new.helpers.dedup_index import TransactionDedupIndex
+from billing_consumer_new.helpers.columnar_sink import ColumnarSink, ColumnarSinkWriter
+from billing_consumer_new.helpers.crypto_workers import CryptoWorkerClient, crypto_worker_socket_paths, run_crypto_worker
+from billing_consumer_new.billing_service.billing_pipeline import BillingPipeline
 
 routes = web.RouteTableDef()
 
 # Adding a health check with /ping
 @routes.get("/ping")
 async def ping(request):
+    if not request.app["state"].ready:
+        return web.Response(text="BillingConsumer Service starting", status=503)
     return web.Response(text="BillingConsumer Service available", status=200)
 
 
+@routes.get("/metrics")
+async def metrics_handler(request):
+    # the series of every process sharing the port when the exporter runs
+    exporter = request.app["state"].metrics_exporter
+    text = exporter.render() if exporter else metrics.REGISTRY.render()
+    return web.Response(text=text, content_type="text/plain", charset="utf-8")
+
+
+def collect_pipeline_stats(pipeline: BillingPipeline):
+    def collect():
+        for stage, stats in pipeline.stats().items():
+            for stat, value in stats.items():
+                metrics.PIPELINE_STATS.set(value, stage=stage, stat=stat)
+    return collect
+
+
+class AppState:
+    """ what the background startup created, read by the routes and the shutdown """
+
+    def __init__(self):
+        self.ready = False
+        self.startup_task = None
+        self.consumers = []
+        self.consumer_tasks = []
+        self.pipeline = None
+        self.group_commit_writer = None
+        self.failure_router = None
+        self.mysql = None
+        self.columnar_sink = None
+        self.metrics_exporter = None
+
+
 def initialize_logger():
     logging.getLogger("billing_consumer").setLevel(app_config.LOG_LEVEL)
     # log_Format = "%(asctime)s - %(name)s - %(process)d - %(levelname)s - %(message)s"
     # logging.basicConfig(stream=sys.stdout, format=log_Format, level=logging.ERROR)    
     logging.basicConfig(stream=sys.stdout, level=logging.ERROR)
-    app_logger.setup_logging_queue()
+    return app_logger.setup_logging_queue()
 
 
 async def startup_tasks(app: web.Application) -> None:
-    
-    consumers = []
-    num_consumers = min(app_config.KAFKA_NO_CONSUMER_PER_INSTANCE, app_config.KAFKA_NO_CONSUMER_PER_INSTANCE_MAX)
-    loop = asyncio.get_running_loop()
-    await AIOBoto3Session.instance().start()
-    mysql = aio_mysql()
-    await mysql.connect(size=num_consumers)
-    crypto_util = ContentHelper(app_config.CRYPTO_LJAR, app_config.CRYPTO_ENV, 
-                                app_config.CRYPTO_ENV_PREFIX, app_config.CRYPTO_AWS_PROFILE, 
-                                instances = app_config.CRYPTO_INSTANCES)
-    for _ in range(3):
-        time.sleep(1)
-        consumer = BillingConsumer(crypto_util=crypto_util, mysql_instance=mysql, name=f"billing_consumer-{os.getpid()}-{_}")
-        consumers.append(consumer)
-        loop.create_task(consumer.run())
+    # the consumers start in the background, /ping answers 503 until they are all assigned
+    state: AppState = app["state"]
+    if app_config.METRICS_MULTIPROC_DIR:
+        state.metrics_exporter = metrics.MultiProcessExporter()
+        await state.metrics_exporter.start()
+    state.startup_task = asyncio.create_task(start_consumers(state))
+
+
+async def start_consumers(state: AppState) -> None:
+    try:
+        num_consumers = min(app_config.KAFKA_NO_CONSUMER_PER_INSTANCE, app_config.KAFKA_NO_CONSUMER_PER_INSTANCE_MAX)
+        mysql = aio_mysql()
+        state.mysql = mysql
+        pool_size = mysql_pool_size(num_consumers)
+        # JVM, MySQL pool and boto session warm up in parallel
+        _, _, crypto_util = await asyncio.gather(
+            AIOBoto3Session.instance().start(),
+            mysql.connect(size=pool_size, minsize=min(app_config.MYSQL_POOL_MINSIZE or pool_size, pool_size)),
+            create_crypto_util()
+        )
+        dedup_index = None
+        if app_config.DEDUP_ENABLED:
+            # one index per process, shared by all the consumers
+            dedup_index = TransactionDedupIndex(mysql=mysql if app_config.DEDUP_DB_PRECHECK else None)
+        writer = mysql
+        if app_config.GROUP_COMMIT_ENABLED:
+            # one write-behind buffer per process, shared by all the consumers
+            writer = GroupCommitWriter(mysql)
+            state.group_commit_writer = writer
+        if app_config.COLUMNAR_SINK_ENABLED:
+            # one sink per process, after the group commit so it appends the merged batches
+            columnar_sink = ColumnarSink(s3_client=AIOBoto3Session.instance().get_s3_client())
+            await columnar_sink.start()
+            state.columnar_sink = columnar_sink
+            writer = ColumnarSinkWriter(writer, columnar_sink)
+        failure_router = None
+        if app_config.BILLING_RETRY_ENABLED:
+            failure_router = BillingFailureRouter()
+            await failure_router.start()
+            state.failure_router = failure_router
+        pipeline = None
+        if app_config.BILLING_PIPELINE_ENABLED:
+            # one pipeline per process, shared by all the consumers
+            pipeline = BillingPipeline(crypto_util, writer, dedup_index=dedup_index)
+            await pipeline.start()
+            state.pipeline = pipeline
+            metrics.REGISTRY.add_collector(collect_pipeline_stats(pipeline))
+
+        consumer_params = dict(crypto_util=crypto_util, mysql_instance=writer, pipeline=pipeline,
+                               dedup_index=dedup_index, failure_router=failure_router)
+        starts = [start_consumer(state, idx, name=f"billing_consumer-{os.getpid()}-{idx}", **consumer_params)
+                  for idx in range(num_consumers)]
+        if failure_router is not None:
+            starts.append(start_consumer(state, num_consumers, name=f"billing_retry_consumer-{os.getpid()}", retry=True, **consumer_params))
+        consumers = await asyncio.gather(*starts)
+        state.consumers = consumers
+
+        await asyncio.gather(*[consumer.msk_consumer.assigned.wait() for consumer in consumers])
+        state.ready = True
+        logger.log_message(message=f"{len(consumers)} billing consumers assigned, ready", level="INFO")
+    except Exception as xcp:
+        logger.log_message(message=f"Error in the startup of the billing consumers: {str(xcp)}", level="ERROR")
+        # stop the app, the supervisor starts a new process
+        signal.raise_signal(signal.SIGTERM)
+
+
+async def create_crypto_util():
+    """ starts the cipher pool off the event loop, then runs one encryption per cipher instance """
+    if app_config.CRYPTO_WORKER_PROCESSES > 0:
+        # the JVMs live in the crypto worker processes started by run()
+        crypto_util = CryptoWorkerClient(crypto_worker_socket_paths())
+        instances = app_config.CRYPTO_WORKER_PROCESSES
+    else:
+        crypto_util = await asyncio.get_running_loop().run_in_executor(None, create_crypto_backend)
+        instances = app_config.CRYPTO_INSTANCES
+    await asyncio.gather(*[crypto_util.aetask_many([b"{}"]) for _ in range(instances)])
+    return crypto_util
+
+
+async def start_consumer(state: AppState, idx: int, **kwargs) -> BillingConsumer:
+    """ staggers the group joins, a rebalance storm is avoided when all the processes start together """
+    await asyncio.sleep(idx * app_config.KAFKA_CONSUMER_STAGGER_MS / 1000)
+    consumer = BillingConsumer(**kwargs)
+    state.consumer_tasks.append(asyncio.create_task(consumer.run()))
+    return consumer
 
 
 async def shutdown_tasks(app: web.Application) -> None:
+    state: AppState = app["state"]
+    state.ready = False
+    if not state.startup_task.done():
+        state.startup_task.cancel()
+    # the batches in flight are committed before the pipeline and the writer they use stop
+    await asyncio.gather(*[consumer.msk_consumer.drain() for consumer in state.consumers], return_exceptions=True)
+    for task in state.consumer_tasks:
+        task.cancel()
+    if state.pipeline:
+        await state.pipeline.stop()
+    if state.group_commit_writer:
+        await state.group_commit_writer.flush()
+    if state.columnar_sink:
+        # before the boto session, the last files are uploaded with its S3 client
+        await state.columnar_sink.stop()
+    if state.failure_router:
+        await state.failure_router.stop()
+    if state.mysql:
+        await state.mysql.close()
+    if state.metrics_exporter:
+        await state.metrics_exporter.stop()
     await AIOBoto3Session.instance().stop()
 
 
 async def main():
     app = web.Application()
+    app.add_routes(routes)
     app.on_startup.append(startup_tasks)
     app.on_shutdown.append(shutdown_tasks)
     app["executor"] = async_cputhread.executor_pool
+    app["state"] = AppState()
     port = int(os.getenv('BILLING_CONSUMER_PORT', 6500))
-    await web._run_app(app, port=port, backlog=32, reuse_port=True)
+    # SIGTERM runs the shutdown tasks, the consumers drain before the process exits
+    await web._run_app(app, port=port, backlog=32, reuse_port=True, handle_signals=True)
 
 
 def start():
+    log_listener = initialize_logger()
+    try:
+        asyncio.run(main())
+    finally:
+        log_listener.stop()
+
+
+def start_crypto_worker(socket_path: str):
     initialize_logger()
-    asyncio.run(main())
+    run_crypto_worker(socket_path)
 
 
 def run():
     KafkaWriter.on_app_start()
     cpu_count = multiprocessing.cpu_count()
     num_processes = int(os.getenv('BILLING_CONSUMER_NUM_PROCESSES', cpu_count))
-    processes = []
-    for _ in range(num_processes):
-        p = Process(target=start)
-        p.start()
-        processes.append(p)   
-    for p in processes:
-        p.join()
-    run()
+    if app_config.METRICS_MULTIPROC_DIR:
+        metrics.clear_multiprocess_dir(app_config.METRICS_MULTIPROC_DIR)
+    supervisor = ProcessSupervisor()
+    for idx, socket_path in enumerate(crypto_worker_socket_paths()):
+        supervisor.add(f"crypto-worker-{idx}", start_crypto_worker, socket_path)
+    for idx in range(num_processes):
+        supervisor.add(f"billing-consumer-{idx}", start)
+    supervisor.run()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,56 @@
+""" This module contains the controller of the number of records fetched per poll by the billing consumers """
+
+from billing_consumer_new.helpers import app_config, metrics
+
+# share of max_poll_interval_ms a batch may take, the rest is left for the slow stragglers
+POLL_INTERVAL_SHARE = 0.5
+# weight of the last batch in the moving average of the time per record
+SMOOTHING = 0.3
+
+
+class AdaptiveBatchController:
+    """
+    Grows the records fetched per poll while the consumer lags behind, shrinks them back to min_records
+    when it is caught up, so a catch-up is done in large batches and light traffic in small ones.
+    A batch never takes more than target_batch_ms, nor more than half of max_poll_interval_ms,
+    at the measured time per record
+    """
+
+    def __init__(self, name: str, initial_records: int = app_config.NUMBER_OF_MSG_HANDLERS,
+                 min_records: int = app_config.KAFKA_MIN_POLL_RECORDS, max_records: int = app_config.KAFKA_MAX_POLL_RECORDS,
+                 target_batch_ms: int = app_config.KAFKA_TARGET_BATCH_MS,
+                 max_poll_interval_ms: int = app_config.KAFKA_MAX_POLL_INTERVAL_MS):
+        self.name = name
+        self.min_records = max(min_records, 1)
+        self.max_records = max(max_records, self.min_records)
+        self.budget = min(target_batch_ms, max_poll_interval_ms * POLL_INTERVAL_SHARE) / 1000
+        self.records = min(max(initial_records, self.min_records), self.max_records)
+        self.seconds_per_record = None
+        self.lag = 0
+        metrics.BATCH_MAX_RECORDS.set(self.records, consumer=self.name)
+
+    def observe(self, records: int, seconds: float, lag: int):
+        """ records the end-to-end time of a batch and the lag left behind it, then sizes the next poll """
+        self.lag = lag
+        if records > 0:
+            per_record = seconds / records
+            if self.seconds_per_record is None:
+                self.seconds_per_record = per_record
+            else:
+                self.seconds_per_record += SMOOTHING * (per_record - self.seconds_per_record)
+
+        if lag > self.records:
+            # catching up, double the batch
+            records = self.records * 2
+        else:
+            records = self.records // 2
+        self.records = min(max(records, self.min_records), self.limit())
+        metrics.BATCH_MAX_RECORDS.set(self.records, consumer=self.name)
+        if self.seconds_per_record is not None:
+            metrics.BATCH_RECORD_SECONDS.set(self.seconds_per_record, consumer=self.name)
+
+    def limit(self) -> int:
+        """ the most records a batch can hold within the time budget """
+        if not self.seconds_per_record:
+            return self.max_records
+        return max(min(int(self.budget / self.seconds_per_record), self.max_records), self.min_records)
@@ -1,29 +1,81 @@
 
 """ This module contains the code to consume messages from Kafka """
 
+import time
+import asyncio
 import traceback
-from aiokafka import AIOKafkaConsumer
+from aiokafka import AIOKafkaConsumer, ConsumerRebalanceListener
 from aiokafka.helpers import create_ssl_context
-from aiokafka import AIOKafkaConsumer
 from billing_consumer_new.helpers import app_config
 from billing_consumer_new.helpers import app_logger
+from billing_consumer_new.helpers import metrics
 from billing_consumer_new.helpers.app_logger import custom_logger
 import traceback
 from ascendops_commonlib.app_utils.kafka_util import KafkaWriter
 from ascendops_commonlib.ops_utils import ops_util
 from billing_consumer_new.helpers import app_config
-from billing_consumer_new.billing_service.billing_handler import billing_handler
+from billing_consumer_new.billing_service.billing_handler import BillingFailure, billing_handler
+from billing_consumer_new.start_up.failure_router import BillingFailureRouter, retry_at
+from billing_consumer_new.start_up.batch_controller import AdaptiveBatchController
+from billing_consumer_new.start_up.offset_tracker import OffsetTracker
+
+
+class AssignmentListener(ConsumerRebalanceListener):
+    """ sets the event once the consumer joined the group, its assignment may be empty """
+
+    def __init__(self, assigned: asyncio.Event, on_revoked=None):
+        self.assigned = assigned
+        self.on_revoked = on_revoked
+
+    async def on_partitions_revoked(self, revoked):
+        if self.on_revoked is not None:
+            await self.on_revoked(revoked)
+
+    def on_partitions_assigned(self, assigned):
+        self.assigned.set()
 
 
 class AIOConsumer:
-    def __init__(self, unique_client_id, unique_group_id, **kwargs):
+    def __init__(self, unique_client_id, unique_group_id, partition_concurrency=0, batch_controller=None,
+                 commit_interval_ms=app_config.KAFKA_COMMIT_INTERVAL_MS, max_batch_retries=app_config.KAFKA_BATCH_MAX_RETRIES,
+                 retry_backoff_ms=app_config.KAFKA_BATCH_RETRY_BACKOFF_MS,
+                 retry_max_backoff_ms=app_config.KAFKA_BATCH_RETRY_MAX_BACKOFF_MS, dead_letter=None, **kwargs):
         """
         Each Consumer MUST have a unique ID.
         Multiple Consumers to consume the same topic MUST belong to the same group
+        partition_concurrency > 0 processes each partition batch as its own task,
+        with at most partition_concurrency batches in flight
+        batch_controller sizes each poll, without it a poll returns at most max_poll_records
+        The offsets of a poll are committed in a single call once its batches are processed,
+        the offsets of the batches in flight are committed together commit_interval_ms after the first completes
+        A batch whose handler raised is fetched again after a backoff doubling from retry_backoff_ms up to
+        retry_max_backoff_ms, it is never committed before it succeeded. With max_batch_retries > 0 and a dead_letter
+        coroutine function (messages, error), the batch is passed to dead_letter after that many retries and
+        committed once dead_letter returned, a dead_letter that raises leaves the batch to the next retry
         """
         self.consumed_msg_count = 0
         self.client_id = unique_client_id
         self.group_id = unique_group_id
+        self.partition_concurrency = partition_concurrency
+        self._partition_slots = asyncio.Semaphore(max(partition_concurrency, 1))
+        self._inflight = {}
+        self._lag = {}
+        self.assigned = asyncio.Event()
+        self.batch_controller = batch_controller
+        self.stopping = False
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._loop_task = None
+        self.offsets = OffsetTracker()
+        self.commit_interval = commit_interval_ms / 1000
+        self._commit_lock = asyncio.Lock()
+        self._commit_timer = None
+        self.max_batch_retries = max_batch_retries
+        self.retry_backoff = retry_backoff_ms / 1000
+        self.retry_max_backoff = retry_max_backoff_ms / 1000
+        self.dead_letter = dead_letter
+        # tp -> (first offset of the failing batch, failed attempts)
+        self._attempts = {}
         protocol = kwargs.pop("security_protocol", "SSL")
         offset_reset = kwargs.pop("auto_offset_reset", "earliest")
         if protocol == "SSL":
@@ -45,6 +97,7 @@ class AIOConsumer:
                 auto_offset_reset=offset_reset,
                 enable_auto_commit=False,
                 max_poll_records=app_config.NUMBER_OF_MSG_HANDLERS,
+                max_poll_interval_ms=app_config.KAFKA_MAX_POLL_INTERVAL_MS,
                 security_protocol=protocol,
                 ssl_context=context
             )
@@ -55,7 +108,8 @@ class AIOConsumer:
                 group_id=unique_group_id,
                 auto_offset_reset=offset_reset,
                 enable_auto_commit=False,
-                max_poll_records=app_config.NUMBER_OF_MSG_HANDLERS
+                max_poll_records=app_config.NUMBER_OF_MSG_HANDLERS,
+                max_poll_interval_ms=app_config.KAFKA_MAX_POLL_INTERVAL_MS
               )
 
     async def consume_batch(self, topic, handler):
@@ -67,43 +121,234 @@ class AIOConsumer:
             blocking execution.
         """
         # Need to check if, what partition configuration here
-        self.consumer.subscribe([topic])
+        self.consumer.subscribe([topic], listener=AssignmentListener(self.assigned, self.partitions_revoked))
         custom_logger.logger.info("[S] %s/%s starts consuming from topic: %s", self.group_id, self.client_id, topic)
         # self.logger.info("[S] bootstrap_connected %s", self.consumer.bootstrap_connected())
         partitions = self.consumer.partitions_for_topic(topic)
         custom_logger.logger.info("[S] partitions_for_topic %s", partitions)
 
+        self._loop_task = asyncio.current_task()
         await self.consumer.start()
 
-        while True:
+        while not self.stopping:
+            if self.partition_concurrency > 0 and self._inflight and len(self._inflight) >= len(self.consumer.assignment()):
+                # every assigned partition is in flight, nothing to fetch until one of them completes
+                await asyncio.wait(list(self._inflight.values()), return_when=asyncio.FIRST_COMPLETED)
+
             # Now, this consumer picks up message at the right position
-            result = await self.consumer.getmany(timeout_ms=10 * 1000)
-            for tp, messages in result.items():
-                # message is an instance of ConsumerRecord(topic='test', partition=0, offset=50,
-                # timestamp=1619202704246, timestamp_type=0, serialized_header_size=-1,
-                # headers=[], checksum=None, serialized_key_size=13, serialized_value_size=44,
-                # key=b'tB_1619202704',
-                # value=b'{"msg": {"id": 46}, "body": "tB_1619202704"}')
+            timeout_ms = app_config.KAFKA_INFLIGHT_POLL_TIMEOUT_MS if self._inflight else app_config.KAFKA_POLL_TIMEOUT_MS
+            max_records = self.batch_controller.records if self.batch_controller else None
+            result = await self.consumer.getmany(timeout_ms=timeout_ms, max_records=max_records)
+            if self.stopping:
+                # fetched after the drain started, left uncommitted for the next owner of the partitions
+                break
+            self.drop_revoked_lag()
+            self._idle.clear()
+            try:
+                await self.process_result(result, handler)
+            finally:
+                self._idle.set()
+
+    async def process_result(self, result, handler):
+        """ Processes the partition batches of a poll """
+        st = time.perf_counter()
+        for tp, messages in result.items():
+            # message is an instance of ConsumerRecord(topic='test', partition=0, offset=50,
+            # timestamp=1619202704246, timestamp_type=0, serialized_header_size=-1,
+            # headers=[], checksum=None, serialized_key_size=13, serialized_value_size=44,
+            # key=b'tB_1619202704',
+            # value=b'{"msg": {"id": 46}, "body": "tB_1619202704"}')
+            if not messages:
+                continue
+            if self.stopping:
+                # the partitions not started yet are fetched again by their next owner
+                break
+            if self.partition_concurrency > 0:
+                await self.start_partition_task(tp, messages, handler)
+            else:
+                await self.process_partition_batch(tp, messages, handler)
+        # one commit for the partitions of the poll, and the batches in flight completed meanwhile
+        await self.commit_offsets()
+        if self.batch_controller and self.partition_concurrency <= 0 and result:
+            self.batch_controller.observe(sum(len(each) for each in result.values()), time.perf_counter() - st, self.total_lag())
+
+    async def process_partition_batch(self, tp, messages, handler):
+        """ Runs the handler for a partition batch, its offset is then ready for the next commit """
+        self.offsets.begin(tp, messages[0].offset, messages[-1].offset + 1)
+        try:
+            await handler(messages)
+            self.offsets.complete(tp, messages[0].offset)
+            self._attempts.pop(tp, None)
+            custom_logger.logger.info("[S] %s/%s consumed (partition %s offset %s) messages length: %s", self.group_id,
+                          self.client_id, tp, messages[-1].offset, len(messages))
+        except Exception as xcp:
+            custom_logger.logger.error("[S] %s", xcp)
+            custom_logger.logger.error("[S] %s", traceback.format_exc())
+            attempt = self.failed_attempt(tp, messages[0].offset)
+            if self.dead_letter is not None and 0 < self.max_batch_retries < attempt:
                 try:
-                    if messages:
-                        await handler(messages)
-                        await self.consumer.commit({tp: messages[-1].offset + 1})
-                        custom_logger.logger.info("[S] %s/%s consumed (partition %s offset %s) messages length: %s", self.group_id,
-                                      self.client_id, tp, messages[-1].offset, len(messages))
-                except Exception as xcp:
-                    custom_logger.logger.error("[S] %s", xcp)
-                    custom_logger.logger.error("[S] %s", traceback.format_exc())
+                    await self.dead_letter(messages, str(xcp))
+                except Exception as dlq_xcp:
+                    # never committed before the messages are somewhere else
+                    custom_logger.logger.error("[S] %s/%s dead-lettering (partition %s offsets %s-%s) failed: %s", self.group_id,
+                                               self.client_id, tp, messages[0].offset, messages[-1].offset, dlq_xcp)
+                else:
+                    custom_logger.logger.error("[S] %s/%s dead-lettered (partition %s offsets %s-%s) after %s attempts", self.group_id,
+                                               self.client_id, tp, messages[0].offset, messages[-1].offset, attempt)
+                    metrics.BATCH_RETRIES.inc(result="dead_lettered")
+                    self._attempts.pop(tp, None)
+                    self.offsets.complete(tp, messages[0].offset)
+                    return
+            metrics.BATCH_RETRIES.inc(result="retried")
+            # nothing of the batch is committed, fetch it again after the backoff
+            self.offsets.fail(tp, messages[0].offset)
+            if not self.stopping:
+                await asyncio.sleep(self.backoff(attempt))
+            if tp in self.consumer.assignment():
+                self.consumer.seek(tp, messages[0].offset)
+
+    def failed_attempt(self, tp, first_offset: int) -> int:
+        """ counts the failures of the batch starting at first_offset, a batch starting elsewhere starts over """
+        failed_offset, attempts = self._attempts.get(tp, (first_offset, 0))
+        attempts = attempts + 1 if failed_offset == first_offset else 1
+        self._attempts[tp] = (first_offset, attempts)
+        return attempts
+
+    def backoff(self, attempt: int) -> float:
+        return min(self.retry_backoff * 2 ** (attempt - 1), self.retry_max_backoff)
+
+    async def commit_offsets(self):
+        """ Commits the ready offsets of every assigned partition in a single call """
+        if self._commit_timer is not None:
+            # this commit covers the scheduled one
+            self._commit_timer.cancel()
+            self._commit_timer = None
+        async with self._commit_lock:
+            offsets = self.offsets.ready(self.consumer.assignment())
+            if not offsets:
+                return
+            st = time.perf_counter()
+            try:
+                await self.consumer.commit(offsets)
+            except Exception as xcp:
+                # the offsets stay ready, the next commit sends them again
+                custom_logger.logger.error("[S] %s/%s commit of %s failed: %s", self.group_id, self.client_id, offsets, xcp)
+                return
+            metrics.STAGE_LATENCY.observe(time.perf_counter() - st, stage="offset_commit")
+            self.offsets.committed(offsets)
+            for tp, offset in offsets.items():
+                self.record_lag(tp, offset)
+
+    def schedule_commit(self):
+        """ commits after commit_interval, the batches completing meanwhile share the commit """
+        if self._commit_timer is None:
+            self._commit_timer = asyncio.create_task(self._commit_later())
+
+    async def _commit_later(self):
+        await asyncio.sleep(self.commit_interval)
+        self._commit_timer = None
+        await self.commit_offsets()
+
+    async def partitions_revoked(self, revoked):
+        """ the completed batches of the revoked partitions are committed before their next owner fetches them """
+        await self.commit_offsets()
+        self.offsets.revoke(revoked)
+        for tp in revoked:
+            self._attempts.pop(tp, None)
+
+    async def drain(self, timeout: float = app_config.KAFKA_DRAIN_TIMEOUT_MS / 1000):
+        """
+        Stops fetching, waits up to timeout for the batches in flight to be committed,
+        then stops the consumer so it leaves the group and its partitions are reassigned at once.
+        A batch still running at the timeout is cancelled uncommitted and fetched again by the next owner
+        """
+        self.stopping = True
+        pending = list(self._inflight.values())
+        if not self._idle.is_set():
+            pending.append(asyncio.create_task(self._idle.wait()))
+        if pending:
+            _, not_done = await asyncio.wait(pending, timeout=timeout)
+            if not_done:
+                custom_logger.logger.warning("[S] %s/%s drain timed out with %s batches in flight", self.group_id,
+                                             self.client_id, len(not_done))
+            for task in not_done:
+                task.cancel()
+        if self._loop_task is not None and not self._loop_task.done():
+            # the loop is waiting on its poll, or on a batch that timed out
+            self._loop_task.cancel()
+            await asyncio.gather(self._loop_task, return_exceptions=True)
+        await asyncio.gather(*self._inflight.values(), return_exceptions=True)
+        # a cancelled batch holds back the offsets of its partition
+        await self.commit_offsets()
+        await self.consumer.stop()
+        custom_logger.logger.info("[S] %s/%s drained and stopped", self.group_id, self.client_id)
+
+    def record_lag(self, tp, committed_offset):
+        """ lag of the partition after a commit, from the highwater of the last fetch """
+        highwater = self.consumer.highwater(tp)
+        if highwater is None:
+            return
+        self._lag[tp] = max(highwater - committed_offset, 0)
+        metrics.CONSUMER_LAG.set(self._lag[tp], topic=tp.topic, partition=tp.partition)
+
+    def drop_revoked_lag(self):
+        """ a partition moved to another consumer by a rebalance is reported by that consumer """
+        revoked = set(self._lag) - self.consumer.assignment()
+        for tp in revoked:
+            metrics.CONSUMER_LAG.remove(topic=tp.topic, partition=tp.partition)
+            del self._lag[tp]
+
+    def total_lag(self) -> int:
+        return sum(self._lag.values())
+
+    async def start_partition_task(self, tp, messages, handler):
+        """
+        Processes a partition batch as its own task, waits for a free slot when
+        partition_concurrency batches are already in flight.
+        The partition is paused until its batch is processed, so there is never more
+        than one batch per partition in flight, the offset tracker keeps the commits ordered per partition
+        """
+        await self._partition_slots.acquire()
+        self.consumer.pause(tp)
+        self._inflight[tp] = asyncio.create_task(self._run_partition_task(tp, messages, handler))
+
+    async def _run_partition_task(self, tp, messages, handler):
+        try:
+            st = time.perf_counter()
+            await self.process_partition_batch(tp, messages, handler)
+            self.schedule_commit()
+            if self.batch_controller:
+                self.batch_controller.observe(len(messages), time.perf_counter() - st, self.total_lag())
+        finally:
+            self._inflight.pop(tp, None)
+            # the partition may have been revoked by a rebalance while in flight
+            if tp in self.consumer.assignment():
+                self.consumer.resume(tp)
+            self._partition_slots.release()
  
 
 class BillingConsumer:
-    def __init__(self, crypto_util, mysql_instance, name="billing_consumer"):
-        self.msk_topic = app_config.BILLING_TOPIC
+    def __init__(self, crypto_util, mysql_instance, name="billing_consumer", pipeline=None, dedup_index=None,
+                 failure_router: BillingFailureRouter = None, retry: bool = False):
+        """
+        failure_router sends the messages that could not be written to the retry or dead-letter topic,
+        without it they are only logged. retry=True consumes the retry topic instead of the billing topic
+        """
+        self.retry = retry
+        self.msk_topic = app_config.BILLING_RETRY_TOPIC if retry else app_config.BILLING_TOPIC
         self.kafka_params = KafkaWriter.KAFKA_PARAMS
         consumer_client_id = name + "-consumer-" + ops_util.get_epoch_seconds_string()
-        self.msk_consumer = AIOConsumer(consumer_client_id, app_config.KAFKA_GROUP_ID,
+        batch_controller = AdaptiveBatchController(consumer_client_id) if app_config.KAFKA_ADAPTIVE_BATCHING else None
+        self.msk_consumer = AIOConsumer(consumer_client_id, app_config.KAFKA_RETRY_GROUP_ID if retry else app_config.KAFKA_GROUP_ID,
+                                        partition_concurrency=app_config.KAFKA_PARTITION_CONCURRENCY,
+                                        batch_controller=batch_controller,
+                                        dead_letter=self.dead_letter_batch if failure_router is not None else None,
                                         **self.kafka_params.copy())
         self.mysql = mysql_instance
         self.crypto_util = crypto_util
+        self.pipeline = pipeline
+        self.dedup_index = dedup_index
+        self.failure_router = failure_router
         self.messages = []
 
     async def run(self):
@@ -112,4 +357,27 @@ class BillingConsumer:
         custom_logger.logger.info("Billing Consumer exists")
 
     async def batch_handler(self, messages):
-        await billing_handler(messages, self.crypto_util, self.mysql)
\ No newline at end of file
+        if self.retry:
+            await self.wait_for_retry(messages)
+        if self.pipeline:
+            try:
+                failures = (await self.pipeline.process_batch(messages)).failures
+            except Exception as xcp:
+                if self.failure_router is None:
+                    raise
+                failures = [BillingFailure(each, "pipeline", str(xcp), True) for each in messages]
+        else:
+            failures = await billing_handler(messages, self.crypto_util, self.mysql, self.dedup_index)
+        if failures and self.failure_router is not None:
+            # raises when the failures could not be produced, the batch is then not committed
+            await self.failure_router.route(failures)
+
+    async def dead_letter_batch(self, messages, error: str):
+        """ a batch that kept failing goes to the dead-letter topic, raises when it could not be produced """
+        await self.failure_router.route([BillingFailure(each, "consumer", error, False) for each in messages])
+
+    async def wait_for_retry(self, messages):
+        """ the retry topic is consumed once the retry-at of the batch is reached """
+        delay = max(retry_at(each) for each in messages) - time.time()
+        if delay > 0:
+            await asyncio.sleep(min(delay, app_config.BILLING_RETRY_DELAY_MS / 1000))
\ No newline at end of file
@@ -0,0 +1,320 @@
+"""
+Replays recorded billing messages through billing_handler, outside of the Kafka consumer group,
+to re-bill a window of transactions after an RDS outage or a fix.
+
+Dump formats:
+    jsonl: one Kafka message value (the billing message JSON) per line
+    lp:    4 bytes big-endian length followed by the Kafka message value, repeated
+
+The dumps are split in units (byte ranges of at most --chunk-bytes for jsonl, whole files for lp)
+that are sharded over --workers processes. Each unit checkpoints the file offset after every
+written batch, a replay started again with the same --checkpoint-dir resumes where it stopped.
+The messages that failed are appended to <checkpoint-dir>/<unit>.failed.lp, replayable with --format lp.
+
+    python -m billing_consumer_new.start_up.billing_replay dumps/*.jsonl --workers 8 --checkpoint-dir replay-2024-10-23
+    python -m billing_consumer_new.start_up.billing_replay replay-2024-10-23/*.failed.lp --format lp --checkpoint-dir replay-2024-10-23-retry
+"""
+
+import os
+import sys
+import json
+import time
+import queue
+import struct
+import asyncio
+import hashlib
+import argparse
+import logging
+import multiprocessing
+from typing import NamedTuple
+from billing_consumer_new.helpers import app_config
+from billing_consumer_new.helpers.app_logger import custom_logger as logger
+from billing_consumer_new.helpers.sql_util import WRITE_MODES, WRITE_MODE_VALUES
+
+# Dump formats
+FORMAT_JSONL = "jsonl"
+FORMAT_LENGTH_PREFIXED = "lp"
+FORMATS = (FORMAT_JSONL, FORMAT_LENGTH_PREFIXED)
+
+_LENGTH = struct.Struct(">I")
+
+
+class ReplayRecord(NamedTuple):
+    """ a recorded message with the ConsumerRecord attributes billing_handler uses, offset is the byte offset in the dump """
+    topic: str
+    partition: int
+    offset: int
+    key: bytes
+    value: bytes
+    headers: tuple = ()
+
+
+class ReplayUnit(NamedTuple):
+    """ the records of a dump starting in [start, end) """
+    path: str
+    fmt: str
+    start: int
+    end: int
+
+    @property
+    def name(self) -> str:
+        digest = hashlib.sha1(f"{os.path.abspath(self.path)}:{self.start}".encode("utf-8")).hexdigest()[:12]
+        return f"{os.path.basename(self.path)}-{self.start}-{digest}"
+
+
+def plan_units(paths: list, fmt: str, chunk_bytes: int) -> list:
+    """ splits the jsonl dumps in byte ranges, a length-prefixed dump cannot be entered mid-file and is one unit """
+    units = []
+    for path in paths:
+        size = os.path.getsize(path)
+        if fmt == FORMAT_JSONL and chunk_bytes > 0:
+            units.extend(ReplayUnit(path, fmt, start, min(start + chunk_bytes, size)) for start in range(0, size, chunk_bytes))
+        else:
+            units.append(ReplayUnit(path, fmt, 0, size))
+    return units
+
+
+def read_jsonl(unit: ReplayUnit, offset: int = None):
+    """ yields (record, offset of the next line) for the lines starting in the unit, from offset when resuming (always a line start) """
+    with open(unit.path, "rb") as f:
+        if offset is None:
+            offset = unit.start
+            if offset > 0:
+                # the line running over the start belongs to the previous unit
+                f.seek(offset - 1)
+                f.readline()
+                offset = f.tell()
+        f.seek(offset)
+        while offset < unit.end:
+            line = f.readline()
+            if not line:
+                break
+            value = line.strip()
+            next_offset = offset + len(line)
+            if value:
+                yield ReplayRecord(unit.path, 0, offset, None, value), next_offset
+            offset = next_offset
+
+
+def read_length_prefixed(unit: ReplayUnit, offset: int = None):
+    """ yields (record, offset of the next record) for a length-prefixed dump, from offset when resuming """
+    offset = unit.start if offset is None else offset
+    with open(unit.path, "rb") as f:
+        f.seek(offset)
+        while offset < unit.end:
+            header = f.read(_LENGTH.size)
+            if not header:
+                break
+            if len(header) < _LENGTH.size:
+                raise ValueError(f"Truncated length at offset {offset} of {unit.path}")
+            length, = _LENGTH.unpack(header)
+            value = f.read(length)
+            if len(value) < length:
+                raise ValueError(f"Truncated message at offset {offset} of {unit.path}")
+            next_offset = offset + _LENGTH.size + length
+            yield ReplayRecord(unit.path, 0, offset, None, value), next_offset
+            offset = next_offset
+
+
+def read_batches(unit: ReplayUnit, batch_size: int, offset: int = None):
+    """ yields (records, offset after the last record) """
+    reader = read_jsonl if unit.fmt == FORMAT_JSONL else read_length_prefixed
+    batch = []
+    next_offset = offset
+    for record, next_offset in reader(unit, offset):
+        batch.append(record)
+        if len(batch) >= batch_size:
+            yield batch, next_offset
+            batch = []
+    if batch:
+        yield batch, next_offset
+
+
+class ReplayCheckpoints:
+    """ one json file per unit with the offset after its last written batch """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, unit: ReplayUnit, suffix: str) -> str:
+        return os.path.join(self.directory, unit.name + suffix)
+
+    def load(self, unit: ReplayUnit) -> dict:
+        try:
+            with open(self._path(unit, ".json")) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"path": unit.path, "start": unit.start, "end": unit.end, "offset": None, "records": 0, "failures": 0}
+
+    def save(self, unit: ReplayUnit, checkpoint: dict):
+        path = self._path(unit, ".json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(checkpoint, f)
+        # a crash leaves either the previous checkpoint or this one
+        os.replace(path + ".tmp", path)
+
+    def save_failures(self, unit: ReplayUnit, failures: list):
+        with open(self._path(unit, ".failed.lp"), "ab") as f:
+            for each in failures:
+                f.write(_LENGTH.pack(len(each.message.value)) + each.message.value)
+
+
+class ModeWriter:
+    """ aio_mysql.bulk_insert_data with the write mode of the replay """
+
+    def __init__(self, mysql, mode: str):
+        self.mysql = mysql
+        self.mode = mode
+
+    async def bulk_insert_data(self, table_1, columns_1, data_1, table_2, columns_2, data_2, mode=None):
+        return await self.mysql.bulk_insert_data(table_1, columns_1, data_1, table_2, columns_2, data_2, mode=self.mode)
+
+    async def select_existing(self, table, column, values):
+        return await self.mysql.select_existing(table, column, values)
+
+
+async def replay_unit(unit: ReplayUnit, handler, checkpoints: ReplayCheckpoints, batch_size: int, progress=None) -> dict:
+    """
+    Runs the batches of a unit through handler (async, messages -> BillingFailure list), from its checkpoint.
+    progress is called with (records, failures, bytes of the unit done) after every batch
+    """
+    checkpoint = checkpoints.load(unit)
+    offset = checkpoint["offset"]
+    done = unit.start if offset is None else min(offset, unit.end)
+    if progress and done > unit.start:
+        # done by a previous run
+        progress(0, 0, done - unit.start)
+    if offset is None or offset < unit.end:
+        for records, next_offset in read_batches(unit, batch_size, offset):
+            failures = await handler(records)
+            if failures:
+                checkpoints.save_failures(unit, failures)
+            checkpoint["offset"] = next_offset
+            checkpoint["records"] += len(records)
+            checkpoint["failures"] += len(failures)
+            checkpoints.save(unit, checkpoint)
+            if progress:
+                progress(len(records), len(failures), min(next_offset, unit.end) - done)
+            done = min(next_offset, unit.end)
+        # every record starting in the unit is written, the last line may end past it
+        checkpoint["offset"] = max(checkpoint["offset"] or unit.end, unit.end)
+        checkpoints.save(unit, checkpoint)
+    if progress and unit.end > done:
+        progress(0, 0, unit.end - done)
+    return checkpoint
+
+
+async def dry_run_handler(messages) -> list:
+    """ decodes the messages without writing them """
+    from billing_consumer_new.billing_service.billing_handler import decode_billing_messages
+    failures = []
+    decode_billing_messages(messages, failures)
+    return failures
+
+
+async def run_worker(units: list, args, progress_queue):
+    """ the replay of the units of a worker process, with its own crypto backend and MySQL pool """
+    from billing_consumer_new.billing_service.billing_handler import billing_handler
+    from billing_consumer_new.helpers.crypto_backend import create_crypto_backend
+    from billing_consumer_new.helpers.dedup_index import TransactionDedupIndex
+    from billing_consumer_new.helpers.sql_util import aio_mysql
+
+    crypto_util = None
+    if args.dry_run:
+        handler = dry_run_handler
+    else:
+        mysql = aio_mysql()
+        crypto_util, _ = await asyncio.gather(
+            asyncio.get_running_loop().run_in_executor(None, create_crypto_backend),
+            mysql.connect(size=1)
+        )
+        writer = ModeWriter(mysql, args.write_mode)
+        dedup_index = TransactionDedupIndex(mysql=writer, precheck_window_seconds=0) if args.dedup else None
+
+        async def handler(messages):
+            return await billing_handler(messages, crypto_util, writer, dedup_index)
+
+    checkpoints = ReplayCheckpoints(args.checkpoint_dir)
+    try:
+        for unit in units:
+            await replay_unit(unit, handler, checkpoints, args.batch_size,
+                              lambda records, failures, size: progress_queue.put((records, failures, size)))
+    finally:
+        if crypto_util is not None:
+            crypto_util.close()
+
+
+def start_worker(units: list, args, progress_queue):
+    try:
+        asyncio.run(run_worker(units, args, progress_queue))
+    except Exception as xcp:
+        logger.log_message(message=f"Error in the billing replay worker {os.getpid()}: {str(xcp)}", level="ERROR")
+        raise
+
+
+def report_progress(workers: list, progress_queue, total_bytes: int, interval: float):
+    """ prints the records, failures and the share of the dumps done until every worker exited """
+    records, failures, done = 0, 0, 0
+    st = time.perf_counter()
+    last = st
+    while True:
+        alive = any(each.is_alive() for each in workers)
+        try:
+            while True:
+                count, failed, size = progress_queue.get(timeout=0.2)
+                records += count
+                failures += failed
+                done += size
+        except queue.Empty:
+            pass
+        now = time.perf_counter()
+        if now - last >= interval or not alive:
+            elapsed = max(now - st, 1e-9)
+            print(f"{records:>12,} records {failures:>8,} failures {done / max(total_bytes, 1) * 100:>6.1f}% "
+                  f"{records / elapsed:>10,.0f} records/sec", flush=True)
+            last = now
+        if not alive:
+            return records, failures
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("dumps", nargs="+", help="dump files")
+    parser.add_argument("--format", choices=FORMATS, default=FORMAT_JSONL)
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--batch-size", type=int, default=500, help="messages per billing_handler call")
+    parser.add_argument("--chunk-bytes", type=int, default=64 * 1024 * 1024, help="size of the jsonl units")
+    parser.add_argument("--write-mode", choices=WRITE_MODES, default=WRITE_MODE_VALUES,
+                        help="load_data needs MYSQL_LOCAL_INFILE=true and does not report the rejected rows")
+    parser.add_argument("--checkpoint-dir", default="billing-replay")
+    parser.add_argument("--dedup", action="store_true", help="skip the transactions already in the allout billing table")
+    parser.add_argument("--dry-run", action="store_true", help="only decode the messages")
+    parser.add_argument("--progress-interval", type=float, default=10.0)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(stream=sys.stdout, level=logging.ERROR)
+    logging.getLogger("billing_consumer").setLevel(app_config.LOG_LEVEL)
+    units = plan_units(args.dumps, args.format, args.chunk_bytes)
+    total_bytes = sum(each.end - each.start for each in units)
+    workers = min(max(args.workers, 1), max(len(units), 1))
+    print(f"Replaying {len(units)} units of {total_bytes:,} bytes with {workers} workers, checkpoints in {args.checkpoint_dir}", flush=True)
+
+    progress_queue = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=start_worker, args=(units[idx::workers], args, progress_queue), name=f"billing-replay-{idx}")
+                 for idx in range(workers)]
+    for each in processes:
+        each.start()
+    try:
+        report_progress(processes, progress_queue, total_bytes, args.progress_interval)
+    finally:
+        for each in processes:
+            each.join()
+    failed = [each.name for each in processes if each.exitcode != 0]
+    if failed:
+        print(f"Workers {failed} failed, run the same command again to resume from the checkpoints", flush=True)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
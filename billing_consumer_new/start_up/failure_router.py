@@ -0,0 +1,110 @@
+""" This module contains the routing of the failed billing messages to the retry and dead-letter topics """
+
+import time
+import asyncio
+from aiokafka import AIOKafkaProducer
+from aiokafka.helpers import create_ssl_context
+from billing_consumer_new.helpers import app_config, metrics
+from billing_consumer_new.helpers.app_logger import custom_logger as logger
+from ascendops_commonlib.app_utils.kafka_util import KafkaWriter
+
+# Failure metadata headers
+ATTEMPTS_HEADER = "billing-attempts"
+STAGE_HEADER = "billing-failed-stage"
+ERROR_HEADER = "billing-error"
+FAILED_AT_HEADER = "billing-failed-at"
+RETRY_AT_HEADER = "billing-retry-at"
+ORIGINAL_TOPIC_HEADER = "billing-original-topic"
+ORIGINAL_PARTITION_HEADER = "billing-original-partition"
+ORIGINAL_OFFSET_HEADER = "billing-original-offset"
+MAX_ERROR_LENGTH = 1000
+
+
+def get_header(message, name: str, default: str = None) -> str:
+    for key, value in getattr(message, "headers", None) or ():
+        if key == name:
+            return value.decode("utf-8")
+    return default
+
+
+def retry_at(message) -> float:
+    """ epoch seconds before which a message of the retry topic must not be processed, 0 without the header """
+    return int(get_header(message, RETRY_AT_HEADER, "0")) / 1000
+
+
+def create_producer(kafka_params: dict) -> AIOKafkaProducer:
+    """ producer with the same security settings as the consumers """
+    kafka_params = kafka_params.copy()
+    protocol = kafka_params.pop("security_protocol", "SSL")
+    if protocol == "SSL":
+        context = create_ssl_context(
+            cafile=kafka_params.pop("cafile_path"),
+            certfile=kafka_params.pop("certfile_path"),
+            keyfile=kafka_params.pop("keyfile_path"),
+            password=kafka_params.pop("private_key_pwd")
+        )
+        return AIOKafkaProducer(bootstrap_servers=app_config.MSK_BOOTSTRAP_SERVERS, acks="all",
+                                security_protocol=protocol, ssl_context=context)
+    return AIOKafkaProducer(bootstrap_servers=app_config.MSK_BOOTSTRAP_SERVERS, acks="all")
+
+
+class BillingFailureRouter:
+    """
+    Sends the BillingFailure of a batch to the retry topic with a retry-at header, or to the dead-letter
+    topic once max_attempts is reached or when the failure is not retryable.
+    The consumer commits its batch only once route returned, so a failed message is never lost
+    """
+
+    def __init__(self, producer: AIOKafkaProducer = None, retry_topic: str = app_config.BILLING_RETRY_TOPIC,
+                 dlq_topic: str = app_config.BILLING_DLQ_TOPIC, max_attempts: int = app_config.BILLING_MAX_ATTEMPTS,
+                 retry_delay_ms: int = app_config.BILLING_RETRY_DELAY_MS):
+        self.producer = producer
+        self.retry_topic = retry_topic
+        self.dlq_topic = dlq_topic
+        self.max_attempts = max_attempts
+        self.retry_delay_ms = retry_delay_ms
+
+    async def start(self):
+        if self.producer is None:
+            self.producer = create_producer(KafkaWriter.KAFKA_PARAMS)
+        await self.producer.start()
+
+    async def stop(self):
+        if self.producer is not None:
+            await self.producer.stop()
+
+    async def route(self, failures: list):
+        """ produces every failure and waits for the acks, raises if one of them could not be produced """
+        deliveries = []
+        routed = []
+        for failure in failures:
+            message = failure.message
+            attempts = int(get_header(message, ATTEMPTS_HEADER, "0")) + 1
+            now_ms = int(time.time() * 1000)
+            headers = [
+                (ATTEMPTS_HEADER, str(attempts)),
+                (STAGE_HEADER, failure.stage),
+                (ERROR_HEADER, failure.error[:MAX_ERROR_LENGTH]),
+                (FAILED_AT_HEADER, str(now_ms)),
+                # the first delivery of the message, kept through the retries
+                (ORIGINAL_TOPIC_HEADER, get_header(message, ORIGINAL_TOPIC_HEADER, message.topic)),
+                (ORIGINAL_PARTITION_HEADER, get_header(message, ORIGINAL_PARTITION_HEADER, str(message.partition))),
+                (ORIGINAL_OFFSET_HEADER, get_header(message, ORIGINAL_OFFSET_HEADER, str(message.offset)))
+            ]
+            if failure.retryable and attempts < self.max_attempts:
+                topic = self.retry_topic
+                headers.append((RETRY_AT_HEADER, str(now_ms + self.retry_delay_ms)))
+            else:
+                topic = self.dlq_topic
+            deliveries.append(await self.producer.send(topic, value=message.value, key=message.key,
+                                                       headers=[(key, value.encode("utf-8")) for key, value in headers]))
+            routed.append((topic, failure.stage))
+            logger.log_message(
+                message=f"Sent to {topic} after attempt {attempts} failed in {failure.stage}: {failure.error[:MAX_ERROR_LENGTH]}",
+                transaction_id=message.key,
+                level="WARNING"
+            )
+        if deliveries:
+            await asyncio.gather(*deliveries)
+        for topic, stage in routed:
+            metrics.FAILURES_ROUTED.inc(topic=topic, stage=stage)
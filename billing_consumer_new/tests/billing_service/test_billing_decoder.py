@@ -0,0 +1,69 @@
+import json
+import unittest
+import functools
+from unittest.mock import Mock, patch
+from pydantic import ValidationError
+from billing_consumer_new.billing_service import billing_decoder
+from billing_consumer_new.billing_service.billing_decoder import DECODE_MODES, DECODE_MODE_LAZY, decode_billing_message
+from billing_consumer_new.billing_service.billing_handler import decode_billing_messages
+from billing_consumer_new.tests.billing_service.test_billing_handler import make_message
+
+
+class TestBillingDecoder(unittest.TestCase):
+
+    def setUp(self):
+        self.raw = make_message(
+            "10232024095207EPUJQINUP",
+            client_id="dummy-client",
+            applicant_pii={
+                "name": {"last_name": "ANASTASIO", "first_name": "JESSE"},
+                "dob": "08-06-1966",
+                "ssn": "666131472",
+                "phone": [{"number": "2025550143", "type": "mobile"}],
+                "inquiry_address": {"line1": "1 MAIN ST", "city": "COSTA MESA", "state": "CA", "zip_code": "92626"},
+                "previous_address": [{"line1": "2 MAIN ST", "city": "IRVINE", "state": "CA", "zip_code": "92602"}]
+            }
+        ).value
+
+    def test_modes_decode_the_same_billing_fields(self):
+        decoded = [decode_billing_message(self.raw, mode) for mode in DECODE_MODES]
+
+        for each in decoded:
+            self.assertEqual(each.transaction_id, "10232024095207EPUJQINUP")
+            self.assertEqual(each.subcode, "2344867")
+            self.assertEqual([(code.productCode, code.index) for code in each.product_codes], [("0AGSVC1", "999"), ("PPC0001", "10")])
+            self.assertEqual(each.applicant_pii.name.first_name, "JESSE")
+            self.assertEqual(each.applicant_pii.dob, "08-06-1966")
+            self.assertEqual(each.applicant_pii.inquiry_address.city, "COSTA MESA")
+            self.assertEqual(each.applicant_pii.previous_address[0].zip_code, "92602")
+
+    def test_lazy_mode_skips_the_unused_fields(self):
+        billing_message = decode_billing_message(self.raw, DECODE_MODE_LAZY)
+
+        self.assertFalse(hasattr(billing_message, "client_id"))
+        self.assertFalse(hasattr(billing_message.applicant_pii, "phone"))
+
+    def test_schema_violation_raises_validation_error(self):
+        raw = make_message("10232024095207EPUJQINUP", subcode=None).value
+        for mode in DECODE_MODES:
+            with self.assertRaises(ValidationError):
+                decode_billing_message(raw, mode)
+
+    def test_invalid_json_raises_validation_error(self):
+        for mode in (billing_decoder.DECODE_MODE_JSON, DECODE_MODE_LAZY):
+            with self.assertRaises(ValidationError):
+                decode_billing_message(b'{"transaction_id": ', mode)
+
+        with self.assertRaises(json.JSONDecodeError):
+            decode_billing_message(b'{"transaction_id": ', billing_decoder.DECODE_MODE_LEGACY)
+
+    def test_malformed_message_fails_alone_in_every_mode(self):
+        malformed = [Mock(key=b"T1", value=b'{"transaction_id": '), Mock(key=b"T2", value=b"\xff\xfe")]
+        for mode in DECODE_MODES:
+            failures = []
+            with patch.object(billing_decoder, "decode_billing_message", functools.partial(decode_billing_message, mode=mode)):
+                decoded = decode_billing_messages([malformed[0], make_message("10232024095207EPUJQINUP"), malformed[1]], failures)
+
+            self.assertEqual([key for key, _ in decoded], [b"10232024095207EPUJQINUP"], mode)
+            self.assertEqual([(each.message, each.stage, each.retryable) for each in failures],
+                             [(malformed[0], "decode", False), (malformed[1], "decode", False)], mode)
@@ -0,0 +1,112 @@
+import json
+import unittest
+from unittest.mock import AsyncMock, Mock
+from billing_consumer_new.helpers import app_config, metrics
+from billing_consumer_new.helpers.dedup_index import TransactionDedupIndex
+from billing_consumer_new.billing_service.billing_handler import billing_handler
+
+
+def make_message(transaction_id: str, **overrides):
+    billing_message = {
+        "transaction_id": transaction_id,
+        "product_codes": [
+            {"productCode": "0AGSVC1", "index": "999"},
+            {"productCode": "PPC0001", "index": "10"}
+        ],
+        "solution_id": "AOOMFDAT",
+        "subcode": "2344867",
+        "arf_version": "07",
+        "applicant_pii": {
+            "name": {"last_name": "ANASTASIO", "first_name": "JESSE"},
+            "ssn": "666131472"
+        }
+    }
+    billing_message.update(overrides)
+    return Mock(key=transaction_id.encode("utf-8"), value=json.dumps(billing_message).encode("utf-8"))
+
+
+class TestBillingHandler(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.crypto_util = Mock()
+        self.crypto_util.aetask_many = AsyncMock(side_effect=lambda payloads: ([b"encrypted"] * len(payloads), 0.01))
+        self.mysql = Mock()
+        self.mysql.bulk_insert_data = AsyncMock(return_value=([], []))
+
+    async def test_batch_is_encrypted_in_one_call(self):
+        messages = [make_message("10232024095207EPUJQINUP"), make_message("10232024095208EPUJQINUQ")]
+
+        await billing_handler(messages, self.crypto_util, self.mysql)
+
+        self.crypto_util.aetask_many.assert_awaited_once()
+        self.assertEqual(len(self.crypto_util.aetask_many.await_args.args[0]), 2)
+        self.mysql.bulk_insert_data.assert_awaited_once()
+        args = self.mysql.bulk_insert_data.await_args.args
+        self.assertEqual(args[0], app_config.ALLOUT_BILLING_TABLE_NAME)
+        self.assertEqual([each[0] for each in args[2]], ["10232024095207EPUJQINUP", "10232024095208EPUJQINUQ"])
+        self.assertTrue(all(each[2] == "SEncr:ZW5jcnlwdGVk" for each in args[2]))
+        self.assertEqual(len(args[5]), 4)
+
+    async def test_invalid_message_is_skipped(self):
+        messages = [make_message("10232024095207EPUJQINUP", subcode=None), make_message("10232024095208EPUJQINUQ")]
+        failures = metrics.VALIDATION_FAILURES.value()
+
+        await billing_handler(messages, self.crypto_util, self.mysql)
+
+        args = self.mysql.bulk_insert_data.await_args.args
+        self.assertEqual([each[0] for each in args[2]], ["10232024095208EPUJQINUQ"])
+        self.assertEqual(metrics.VALIDATION_FAILURES.value(), failures + 1)
+
+    async def test_nothing_written_when_encryption_fails(self):
+        self.crypto_util.aetask_many = AsyncMock(side_effect=RuntimeError("cipher unavailable"))
+
+        await billing_handler([make_message("10232024095207EPUJQINUP")], self.crypto_util, self.mysql)
+
+        self.mysql.bulk_insert_data.assert_not_awaited()
+
+    async def test_redelivered_transactions_are_not_encrypted_again(self):
+        dedup_index = TransactionDedupIndex(max_size=10, ttl_seconds=60)
+        await billing_handler([make_message("10232024095207EPUJQINUP")], self.crypto_util, self.mysql, dedup_index)
+
+        messages = [make_message("10232024095207EPUJQINUP"), make_message("10232024095208EPUJQINUQ"), make_message("10232024095208EPUJQINUQ")]
+        await billing_handler(messages, self.crypto_util, self.mysql, dedup_index)
+
+        self.assertEqual(len(self.crypto_util.aetask_many.await_args.args[0]), 1)
+        args = self.mysql.bulk_insert_data.await_args.args
+        self.assertEqual([each[0] for each in args[2]], ["10232024095208EPUJQINUQ"])
+        self.assertIn("10232024095208EPUJQINUQ", dedup_index)
+
+    async def test_rejected_transactions_are_not_marked(self):
+        dedup_index = TransactionDedupIndex(max_size=10, ttl_seconds=60)
+        self.mysql.bulk_insert_data = AsyncMock(side_effect=lambda *args: ([args[2][0]], []))
+
+        await billing_handler([make_message("10232024095207EPUJQINUP")], self.crypto_util, self.mysql, dedup_index)
+
+        self.assertNotIn("10232024095207EPUJQINUP", dedup_index)
+
+    async def test_failures_are_returned_with_their_stage(self):
+        invalid = make_message("10232024095207EPUJQINUP", subcode=None)
+        valid = make_message("10232024095208EPUJQINUQ")
+        self.crypto_util.aetask_many = AsyncMock(side_effect=RuntimeError("cipher unavailable"))
+
+        failures = await billing_handler([invalid, valid], self.crypto_util, self.mysql)
+
+        self.assertEqual([(each.message, each.stage, each.retryable) for each in failures],
+                         [(invalid, "decode", False), (valid, "encrypt", True)])
+
+    async def test_rejected_rows_are_returned_as_failures(self):
+        messages = [make_message("10232024095207EPUJQINUP"), make_message("10232024095208EPUJQINUQ")]
+        self.mysql.bulk_insert_data = AsyncMock(side_effect=lambda *args: ([args[2][1]], []))
+
+        failures = await billing_handler(messages, self.crypto_util, self.mysql)
+
+        self.assertEqual([(each.message, each.stage) for each in failures], [(messages[1], "write")])
+
+    async def test_handler_error_fails_the_pending_messages(self):
+        messages = [make_message("10232024095207EPUJQINUP"), make_message("10232024095208EPUJQINUQ")]
+        self.mysql.bulk_insert_data = AsyncMock(side_effect=RuntimeError("pool closed"))
+
+        failures = await billing_handler(messages, self.crypto_util, self.mysql)
+
+        self.assertEqual([(each.message, each.stage, each.error) for each in failures],
+                         [(messages[0], "write", "pool closed"), (messages[1], "write", "pool closed")])
@@ -0,0 +1,156 @@
+import gc
+import sys
+import json
+import base64
+import unittest
+import tracemalloc
+from unittest.mock import AsyncMock, Mock
+from ascendops_commonlib.models.billing_message import BillingMessage
+from billing_consumer_new.billing_service.applicant_pii_processor import process_applicant_pii
+from billing_consumer_new.billing_service import billing_message_processor
+from billing_consumer_new.billing_service.transaction_timestamps import TransactionTimestamps
+
+
+class TestBillingMessageProcessor(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.billing_message = BillingMessage.model_validate({
+            "transaction_id": "10232024095207EPUJQINUP",
+            "product_codes": [
+                {"productCode": "0AGSVC1", "index": "999"},
+                {"productCode": "PPC0001", "index": "10"},
+                {"productCode": "0040BX1", "index": "999"},
+                {"productCode": "0040FR1", "index": "999"}
+            ],
+            "solution_id": "AOOMFDAT",
+            "subcode": "2344867",
+            "arf_version": "07",
+            "applicant_pii": {
+                "name": {"last_name": "ANASTASIO", "first_name": "JESSE"},
+                "ssn": "666131472",
+                "inquiry_address": {
+                    "line1": "2752 SOLOMONS ISLAND RD",
+                    "city": "EDGEWATER",
+                    "state": "MD",
+                    "zip_code": "210371211"
+                }
+            }
+        })
+        self.applicant_pii = await process_applicant_pii(self.billing_message.applicant_pii, self.billing_message.transaction_id)
+
+    async def test_process_billing_message(self):
+        billing_payload, product_code_records = await billing_message_processor.process_billing_message(self.billing_message, self.applicant_pii)
+
+        record_data = json.loads(billing_payload)
+        self.assertEqual(list(record_data.keys()), ["0"])
+        raw_billing_record = record_data["0"]
+        self.assertEqual(len(raw_billing_record), 785)
+        self.assertTrue(raw_billing_record.startswith("GCRGOINQ   00                          B1.0010232024095207EPUJQINUPGOINQ   "))
+        # base product code comes first
+        self.assertIn("PPC00010AGSVC10040BX10040FR1" + " " * 42, raw_billing_record)
+
+        self.assertEqual(len(product_code_records), 4)
+        self.assertEqual([each[5] for each in product_code_records], ["optional", "base", "optional", "optional"])
+        self.assertEqual(product_code_records[1][:5][-1], "PPC0001")
+
+    async def test_process_billing_message_continuation(self):
+        billing_message = self.billing_message.model_copy(update={
+            "product_codes": self.billing_message.product_codes + [
+                Mock(productCode=f"{idx:07d}", index="999") for idx in range(20)
+            ]
+        })
+        billing_payload, product_code_records = await billing_message_processor.process_billing_message(billing_message, self.applicant_pii)
+
+        record_data = json.loads(billing_payload)
+        self.assertEqual(list(record_data.keys()), ["0", "1", "2"])
+        # continuation flag is set while more than 10 products remain
+        self.assertEqual([record[-51] for record in record_data.values()], ["1", "1", "0"])
+        self.assertEqual(len(product_code_records), 24)
+
+    def decode_batch(self, size):
+        """ decoded from JSON like the consumer, every message has its own string objects """
+        raw = self.billing_message.model_dump_json()
+        return [BillingMessage.model_validate_json(raw.replace("EPUJQINUP", f"EPUJQI{idx:03d}")) for idx in range(size)]
+
+    async def test_rows_share_their_fields(self):
+        timestamps = TransactionTimestamps()
+        product_code_records = []
+        for billing_message in self.decode_batch(2):
+            product_code_records.extend((await billing_message_processor.process_billing_message(billing_message, self.applicant_pii, timestamps))[1])
+
+        first, last = product_code_records[0], product_code_records[-1]
+        self.assertEqual(first.product_code_type, "optional")
+        self.assertIs(first.solution_id, last.solution_id)
+        self.assertIs(first.subcode, last.subcode)
+        self.assertIs(first.product_code, product_code_records[4].product_code)
+        self.assertIs(first.inquiry_timestamp, last.inquiry_timestamp)
+        self.assertIs(first.transaction_id, product_code_records[1].transaction_id)
+
+        allout_record = billing_message_processor.create_allout_billing_record(self.billing_message, "SEncr:abc", timestamps)
+        self.assertEqual(allout_record, (self.billing_message.transaction_id, first.inquiry_timestamp, "SEncr:abc", False, "AOOMFDAT", "2344867"))
+
+    async def test_rows_memory_per_batch(self):
+        billing_messages = self.decode_batch(50)
+        timestamps = TransactionTimestamps()
+        await billing_message_processor.process_billing_message(billing_messages[0], self.applicant_pii, timestamps)
+        gc.collect()
+
+        tracemalloc.start()
+        try:
+            baseline = tracemalloc.take_snapshot()
+            batch_records = [(await billing_message_processor.process_billing_message(each, self.applicant_pii, timestamps))[1]
+                             for each in billing_messages]
+            gc.collect()
+            stats = tracemalloc.take_snapshot().compare_to(baseline, "filename")
+        finally:
+            tracemalloc.stop()
+
+        # per message: its list, 4 rows and the transaction id, the timestamps and the codes are shared
+        records = batch_records[0]
+        message_size = sys.getsizeof(records) + 4 * (sys.getsizeof(records[0]) + 16) + sys.getsizeof(records[0].transaction_id)
+        self.assertLessEqual(sum(each.size_diff for each in stats), 50 * message_size + 2048)
+        self.assertLessEqual(sum(each.count_diff for each in stats), 50 * 6 + 20)
+
+    async def test_process_billing_message_invalid_pii(self):
+        billing_payload, _ = await billing_message_processor.process_billing_message(self.billing_message, {})
+        self.assertEqual(billing_payload, b"")
+
+    async def test_encrypt_billing_records(self):
+        crypto_util = Mock()
+        crypto_util.aetask_many = AsyncMock(side_effect=lambda payloads: ([payload[::-1] for payload in payloads], 0.01))
+
+        encrypted_billing_records = await billing_message_processor.encrypt_billing_records([b"abc", b"xyz"], crypto_util)
+
+        crypto_util.aetask_many.assert_awaited_once_with([b"abc", b"xyz"])
+        self.assertEqual(encrypted_billing_records, [
+            "SEncr:" + base64.b64encode(b"cba").decode("utf-8"),
+            "SEncr:" + base64.b64encode(b"zyx").decode("utf-8")
+        ])
+
+    async def test_encrypt_billing_records_failure(self):
+        crypto_util = Mock()
+        crypto_util.aetask_many = AsyncMock(side_effect=RuntimeError("cipher unavailable"))
+        crypto_util.aetask = AsyncMock(side_effect=RuntimeError("cipher unavailable"))
+
+        encrypted_billing_records = await billing_message_processor.encrypt_billing_records([b"abc", b"xyz"], crypto_util)
+
+        self.assertEqual(encrypted_billing_records, ["", ""])
+
+    async def test_encrypt_billing_records_bad_payload(self):
+        def encrypt(payload):
+            if payload == b"bad":
+                raise ValueError("payload rejected")
+            return payload[::-1], 0.01
+
+        crypto_util = Mock()
+        crypto_util.aetask_many = AsyncMock(side_effect=lambda payloads: ([encrypt(payload)[0] for payload in payloads], 0.01))
+        crypto_util.aetask = AsyncMock(side_effect=encrypt)
+
+        encrypted_billing_records = await billing_message_processor.encrypt_billing_records([b"abc", b"bad", b"xyz"], crypto_util)
+
+        self.assertEqual(crypto_util.aetask.await_count, 3)
+        self.assertEqual(encrypted_billing_records, [
+            "SEncr:" + base64.b64encode(b"cba").decode("utf-8"),
+            "",
+            "SEncr:" + base64.b64encode(b"zyx").decode("utf-8")
+        ])
@@ -0,0 +1,64 @@
+import asyncio
+import unittest
+from unittest.mock import AsyncMock, Mock
+from billing_consumer_new.billing_service.billing_pipeline import BillingPipeline
+from billing_consumer_new.tests.billing_service.test_billing_handler import make_message
+
+
+class TestBillingPipeline(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.crypto_util = Mock()
+        self.crypto_util.aetask_many = AsyncMock(side_effect=lambda payloads: ([b"encrypted"] * len(payloads), 0.01))
+        self.mysql = Mock()
+        self.mysql.bulk_insert_data = AsyncMock(return_value=([], []))
+        self.pipeline = BillingPipeline(self.crypto_util, self.mysql, queue_size=1, stats_interval=0)
+        await self.pipeline.start()
+
+    async def asyncTearDown(self):
+        await self.pipeline.stop()
+
+    async def test_process(self):
+        transactions = await self.pipeline.process([make_message("10232024095207EPUJQINUP")])
+
+        self.assertEqual(transactions, ["10232024095207EPUJQINUP"])
+        self.mysql.bulk_insert_data.assert_awaited_once()
+        stats = self.pipeline.stats()
+        self.assertEqual(list(stats.keys()), ["decode", "pii", "encrypt", "write"])
+        self.assertTrue(all(each["processed"] == 1 and each["queue_depth"] == 0 for each in stats.values()))
+
+    async def test_next_batch_is_encrypted_while_previous_is_written(self):
+        release_write = asyncio.Event()
+        events = []
+
+        async def bulk_insert_data(*args):
+            events.append(("write", args[2][0][0]))
+            await release_write.wait()
+            return [], []
+
+        async def aetask_many(payloads):
+            events.append(("encrypt", len(payloads)))
+            return [b"encrypted"] * len(payloads), 0.01
+
+        self.mysql.bulk_insert_data = AsyncMock(side_effect=bulk_insert_data)
+        self.crypto_util.aetask_many = AsyncMock(side_effect=aetask_many)
+
+        first = asyncio.create_task(self.pipeline.process([make_message("10232024095207EPUJQINUP")]))
+        second = asyncio.create_task(self.pipeline.process([make_message("10232024095208EPUJQINUQ"), make_message("10232024095209EPUJQINUR")]))
+        for _ in range(20):
+            await asyncio.sleep(0)
+
+        self.assertEqual(events, [("encrypt", 1), ("write", "10232024095207EPUJQINUP"), ("encrypt", 2), ("write", "10232024095208EPUJQINUQ")])
+        self.assertFalse(first.done())
+        self.assertEqual(self.pipeline.stats()["write"]["in_flight"], 2)
+
+        release_write.set()
+        self.assertEqual(await first, ["10232024095207EPUJQINUP"])
+        self.assertEqual(await second, ["10232024095208EPUJQINUQ", "10232024095209EPUJQINUR"])
+
+    async def test_failed_write_is_raised_to_the_consumer(self):
+        self.mysql.bulk_insert_data = AsyncMock(side_effect=RuntimeError("RDS unavailable"))
+
+        with self.assertRaises(RuntimeError):
+            await self.pipeline.process([make_message("10232024095207EPUJQINUP")])
+        self.assertEqual(self.pipeline.stats()["write"]["failed"], 1)
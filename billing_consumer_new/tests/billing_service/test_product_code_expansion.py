@@ -0,0 +1,121 @@
+import json
+import random
+import string
+import unittest
+from unittest.mock import Mock
+from ascendops_commonlib.models.billing_message import BillingMessage
+from billing_consumer_new.billing_service.applicant_pii_processor import process_applicant_pii
+from billing_consumer_new.billing_service import billing_message_processor
+from billing_consumer_new.billing_service.billing_message_processor import BILLING_RECORD_LAYOUT, ProductCodeRecord, intern
+from billing_consumer_new.billing_service.transaction_timestamps import TransactionTimestamps
+
+
+def reference_billing_message(billing_message, applicant_pii: dict):
+    """ the product code expansion before expand_product_codes, one code and one 10 codes slice at a time """
+    billing_payload = b""
+    dashboard_billing_records = []
+    try:
+        inquiry_utc_time, inquiry_date_time_in_cst = TransactionTimestamps().get(billing_message.transaction_id)
+        transaction_id = billing_message.transaction_id[0:23]
+        record_values = {
+            "transaction_id": transaction_id,
+            "inquiry_date": inquiry_date_time_in_cst[0:8],
+            "inquiry_time": inquiry_date_time_in_cst[8:14] + "00",
+            "subcode": billing_message.subcode,
+            "arf_version": billing_message.arf_version
+        }
+        record_values.update(applicant_pii)
+        base_product_code = ""
+        product_codes = []
+        for each in billing_message.product_codes:
+            if each.index == "10":
+                base_product_code = each.productCode
+                product_code_type = "base"
+            else:
+                product_codes.append(each.productCode)
+                product_code_type = "optional"
+            dashboard_billing_records.append(ProductCodeRecord(transaction_id, inquiry_utc_time, billing_message.solution_id, billing_message.subcode,
+                                                               intern(each.productCode), product_code_type, billing_message.is_silent_launch_enabled))
+        product_codes.insert(0, base_product_code)
+        try:
+            product_code_counter = 0
+            record_index = 0
+            record_data = {}
+            builder = BILLING_RECORD_LAYOUT.builder(record_values)
+            product_codes_count = min(len(billing_message.product_codes), 30)
+            while product_code_counter < product_codes_count:
+                continuation_flag = "0"
+                if ((product_code_counter % 10) == 0) and ((product_codes_count - product_code_counter) > 10):
+                    continuation_flag = "1"
+                record_data[record_index] = builder.format(
+                    product_codes="".join(product_codes[product_code_counter:product_code_counter + 10]),
+                    continuation_flag=continuation_flag
+                )
+                record_index += 1
+                product_code_counter += 10
+            billing_payload = json.dumps(record_data).encode("utf-8")
+        except Exception:
+            billing_payload = b""
+    except Exception:
+        pass
+    return billing_payload, dashboard_billing_records
+
+
+class TestProductCodeExpansion(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.billing_message = BillingMessage.model_validate({
+            "transaction_id": "10232024095207EPUJQINUP",
+            "product_codes": [{"productCode": "PPC0001", "index": "10"}],
+            "solution_id": "AOOMFDAT",
+            "subcode": "2344867",
+            "arf_version": "07",
+            "applicant_pii": {
+                "name": {"last_name": "ANASTASIO", "first_name": "JESSE"},
+                "ssn": "666131472",
+                "inquiry_address": {"line1": "2752 SOLOMONS ISLAND RD", "city": "EDGEWATER", "state": "MD", "zip_code": "210371211"}
+            }
+        })
+        self.applicant_pii = await process_applicant_pii(self.billing_message.applicant_pii, self.billing_message.transaction_id)
+
+    def random_product_codes(self, rnd: random.Random) -> list:
+        """ 0 to 45 codes, with no, one or several base codes, mostly 7 characters and sometimes longer than a slot """
+        product_codes = []
+        for _ in range(rnd.choice([0, 1, rnd.randint(2, 12), rnd.randint(9, 45)])):
+            length = 7 if rnd.random() < 0.9 else rnd.choice([1, 6, 8])
+            code = "".join(rnd.choice(string.ascii_uppercase + string.digits) for _ in range(length))
+            index = "10" if rnd.random() < 0.1 else rnd.choice(["999", "20", "1"])
+            product_codes.append(Mock(productCode=code, index=index))
+        if product_codes and rnd.random() < 0.5:
+            product_codes[rnd.randrange(len(product_codes))].index = "10"
+        return product_codes
+
+    async def test_matches_the_reference(self):
+        rnd = random.Random(20241023)
+        for _ in range(500):
+            billing_message = self.billing_message.model_copy(update={"product_codes": self.random_product_codes(rnd)})
+
+            billing_payload, product_code_records = await billing_message_processor.process_billing_message(billing_message, self.applicant_pii)
+
+            expected_payload, expected_records = reference_billing_message(billing_message, self.applicant_pii)
+            self.assertEqual(billing_payload, expected_payload, [(each.productCode, each.index) for each in billing_message.product_codes])
+            self.assertEqual(product_code_records, expected_records)
+
+    async def test_boundaries(self):
+        for count in (0, 9, 10, 11, 20, 21, 29, 30, 31, 40):
+            for base in (False, True):
+                product_codes = [Mock(productCode=f"{idx:07d}", index="10" if base and idx == count // 2 else "999") for idx in range(count)]
+                billing_message = self.billing_message.model_copy(update={"product_codes": product_codes})
+
+                billing_payload, product_code_records = await billing_message_processor.process_billing_message(billing_message, self.applicant_pii)
+
+                self.assertEqual((billing_payload, product_code_records), reference_billing_message(billing_message, self.applicant_pii), (count, base))
+
+    def test_chunks(self):
+        codes = [""] + [f"{idx:07d}" for idx in range(25)]
+        chunks = billing_message_processor.product_code_chunks(codes, 25)
+
+        self.assertEqual([flag for _, flag in chunks], ["1", "1", "0"])
+        self.assertEqual(chunks[0][0], "".join(codes[:10]))
+        # without a base code the empty slot shifts the codes, the last chunk takes the 26th
+        self.assertEqual(chunks[2][0], "".join(codes[20:26]))
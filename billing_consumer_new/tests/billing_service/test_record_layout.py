@@ -0,0 +1,60 @@
+import unittest
+from billing_consumer_new.helpers import app_config
+from billing_consumer_new.billing_service.record_layout import EXACT, PAD, PAD_STRICT, Field, FixedWidthLayout, constant, fit, spaces
+from billing_consumer_new.billing_service.billing_message_processor import BILLING_RECORD_LAYOUT
+
+
+class TestRecordLayout(unittest.TestCase):
+
+    def test_fit(self):
+        self.assertEqual(fit(None, 3), "   ")
+        self.assertEqual(fit("ab", 3), "ab ")
+        self.assertEqual(fit("abcd", 3), "abc")
+        self.assertEqual(fit(12, 3), "12 ")
+        self.assertEqual(fit("abc", 3, EXACT), "abc")
+        self.assertEqual(fit("ab", 3, PAD_STRICT), "ab ")
+        with self.assertRaises(ValueError):
+            fit("ab", 3, EXACT)
+        with self.assertRaises(ValueError):
+            fit("abcd", 3, PAD_STRICT)
+
+    def test_format(self):
+        layout = FixedWidthLayout([
+            constant("B"),
+            constant("1.00"),
+            Field("name", 5),
+            spaces(2),
+            Field("code", 3, EXACT),
+            Field("flag", 1, PAD)
+        ], length=16)
+
+        self.assertEqual(layout.names, ("name", "code", "flag"))
+        self.assertEqual(layout.format({"name": "JESSE SMITH", "code": "ABC", "flag": "1"}), "B1.00JESSE  ABC1")
+        self.assertEqual(layout.format({"code": "ABC"}), "B1.00       ABC ")
+        with self.assertRaises(ValueError):
+            layout.format({"code": "AB"})
+
+    def test_builder(self):
+        layout = FixedWidthLayout([
+            constant("B"),
+            Field("name", 5),
+            Field("code", 3, EXACT),
+            Field("flag", 1, EXACT)
+        ], length=10)
+        builder = layout.builder({"name": "JESSE", "code": "ABC"})
+
+        self.assertEqual(builder.format(flag="1"), "BJESSEABC1")
+        # the shared fields are kept, only the given ones change
+        self.assertEqual(builder.format(code="XYZ", flag="0"), "BJESSEXYZ0")
+        self.assertEqual(builder.format(), layout.format({"name": "JESSE", "code": "XYZ", "flag": "0"}))
+        with self.assertRaises(ValueError):
+            builder.format(flag="10")
+
+    def test_length_is_validated_at_build_time(self):
+        with self.assertRaises(ValueError):
+            FixedWidthLayout([constant("B"), Field("name", 5)], length=7)
+        with self.assertRaises(ValueError):
+            FixedWidthLayout([Field("name", 5, "center")])
+
+    def test_billing_record_layout(self):
+        self.assertEqual(BILLING_RECORD_LAYOUT.length, app_config.BILLING_RECORD_LENGTH)
@@ -0,0 +1,44 @@
+import unittest
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+from billing_consumer_new.billing_service.transaction_timestamps import TransactionTimestamps, central_offset, parse_timestamp
+
+
+def strptime_central(transaction_id):
+    """ the conversion the helper replaces """
+    utc_time = datetime.strptime(transaction_id[0:14], "%m%d%Y%H%M%S").replace(tzinfo=ZoneInfo("UTC"))
+    return utc_time.astimezone(ZoneInfo("US/Central")).strftime("%m%d%Y%H%M%S")
+
+
+class TestTransactionTimestamps(unittest.TestCase):
+
+    def test_parse(self):
+        self.assertEqual(parse_timestamp("03092024235959"), datetime(2024, 3, 9, 23, 59, 59))
+        for prefix in ["0309202423595", "0309202423595x", "13092024235959", "03322024000000", "+3092024235959"]:
+            with self.assertRaises(ValueError):
+                parse_timestamp(prefix)
+
+    def test_same_as_strptime_across_dst_changes(self):
+        # hourly around the 2024 spring forward and fall back, then every 7h37m over two years
+        starts = [datetime(2024, 3, 10, 0, 0, 0), datetime(2024, 11, 2, 23, 0, 0)]
+        times = [start + timedelta(minutes=15 * i) for start in starts for i in range(48)]
+        times += [datetime(2023, 1, 1, 0, 0, 1) + timedelta(minutes=457 * i) for i in range(2300)]
+        timestamps = TransactionTimestamps()
+        for each in times:
+            transaction_id = each.strftime("%m%d%Y%H%M%S") + "ABCDEFGHI"
+            self.assertEqual(timestamps.get(transaction_id), (each, strptime_central(transaction_id)))
+
+    def test_each_prefix_is_parsed_once(self):
+        timestamps = TransactionTimestamps()
+        first = timestamps.get("07012024120000ABCDEFGHI")
+        self.assertIs(timestamps.get("07012024120000ZZZZZZZZZ"), first)
+        self.assertEqual(timestamps.central("07012024120000ABCDEFGHI"), "07012024070000")
+        self.assertEqual(timestamps.utc("07012024120000ABCDEFGHI"), datetime(2024, 7, 1, 12, 0, 0))
+
+    def test_offset_is_cached_per_hour(self):
+        central_offset.cache_clear()
+        timestamps = TransactionTimestamps()
+        timestamps.get("01152024101500ABCDEFGHI")
+        timestamps.get("01152024104500ABCDEFGHI")
+        timestamps.get("01152024111500ABCDEFGHI")
+        self.assertEqual(central_offset.cache_info().misses, 2)
@@ -0,0 +1,107 @@
+import json
+import logging
+import queue
+import unittest
+from billing_consumer_new.helpers import app_logger, metrics
+from billing_consumer_new.helpers.app_logger import CustomLogger, LocalQueueHandler, LogSampler, QUEUE_POLICY_BLOCK, parse_event_settings
+
+
+class Unformattable:
+    formatted = 0
+
+    def __str__(self):
+        Unformattable.formatted += 1
+        return "value"
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class TestAppLogger(unittest.TestCase):
+
+    def setUp(self):
+        self.handler = ListHandler()
+        self.logger = CustomLogger("test_app_logger", level=logging.INFO, sampler=LogSampler())
+        self.logger.logger.addHandler(self.handler)
+        self.logger.logger.propagate = False
+
+    def tearDown(self):
+        self.logger.logger.removeHandler(self.handler)
+
+    def dropped(self, reason):
+        return metrics.LOG_RECORDS_DROPPED.value(reason=reason)
+
+    def test_formatting_is_deferred(self):
+        Unformattable.formatted = 0
+        self.logger.log_message("skipped %s", "tid", level="DEBUG", args=(Unformattable(),))
+        self.assertEqual(self.handler.messages, [])
+        self.assertEqual(Unformattable.formatted, 0)
+
+        # formatted by the handler
+        self.logger.log_message("written %s", "tid", args=(Unformattable(),))
+        self.assertEqual(self.handler.messages, ["tid ------- written value"])
+        self.assertGreater(Unformattable.formatted, 0)
+
+    def test_log_json(self):
+        self.logger.log_json({"message": "stats", "stats": {"batches": 2}})
+        content = json.loads(self.handler.messages[0])
+        self.assertEqual(content["event_type"], "BILLING")
+        self.assertEqual(content["stats"], {"batches": 2})
+        self.assertIsNone(content["exception"])
+
+    def test_sampling(self):
+        before = self.dropped("sampled")
+        self.logger.sampler = LogSampler(parse_event_settings("batch_written=0, redelivered=1"))
+        for _ in range(10):
+            self.logger.log_message("written", event="batch_written")
+            self.logger.log_message("skipped", event="redelivered")
+        self.assertEqual(self.handler.messages, ["None ------- skipped"] * 10)
+        self.assertEqual(self.dropped("sampled") - before, 10)
+
+    def test_rate_limit(self):
+        before = self.dropped("rate_limited")
+        self.logger.sampler = LogSampler(rate_limits={"redelivered": 3})
+        for _ in range(10):
+            self.logger.log_message("skipped", event="redelivered")
+        # the burst of the first second, the next tokens come in a third of a second
+        self.assertEqual(len(self.handler.messages), 3)
+        self.assertEqual(self.dropped("rate_limited") - before, 7)
+
+    def test_bounded_queue(self):
+        before = self.dropped("queue_full")
+        handler = LocalQueueHandler(queue.Queue(2))
+        record = logging.LogRecord("test", logging.INFO, __file__, 1, "msg", (), None)
+        for _ in range(5):
+            handler.emit(record)
+        self.assertEqual(handler.queue.qsize(), 2)
+        self.assertEqual(self.dropped("queue_full") - before, 3)
+
+        blocking = LocalQueueHandler(queue.Queue(1), QUEUE_POLICY_BLOCK)
+        blocking.emit(record)
+        with self.assertRaises(queue.Full):
+            blocking.queue.put(record, timeout=0.01)
+
+    def test_listener_flushes_a_full_queue(self):
+        root = logging.getLogger()
+        handlers = root.handlers[:]
+        for each in handlers:
+            root.removeHandler(each)
+        root.addHandler(self.handler)
+        try:
+            listener = app_logger.setup_logging_queue(maxsize=3, policy=QUEUE_POLICY_BLOCK)
+            logger = CustomLogger("test_app_logger_queue", level=logging.INFO, sampler=LogSampler())
+            for idx in range(20):
+                logger.log_message("record %s", args=(idx,))
+            listener.stop()
+        finally:
+            for each in root.handlers[:]:
+                root.removeHandler(each)
+            for each in handlers:
+                root.addHandler(each)
+        self.assertEqual(self.handler.messages, [f"None ------- record {idx}" for idx in range(20)])
@@ -0,0 +1,140 @@
+import os
+import csv
+import gzip
+import shutil
+import datetime
+import tempfile
+import unittest
+from billing_consumer_new.helpers import app_config
+from billing_consumer_new.helpers.columnar_sink import ColumnarSink, ColumnarSinkWriter, SINK_FORMAT_PARQUET, pyarrow
+from billing_consumer_new.billing_service.billing_message_processor import ProductCodeRecord
+
+COLUMNS = tuple(app_config.PRODUCT_CODES_BILLING_TABLE_COLUMNS)
+
+
+def make_row(idx: int, solution_id: str = "GOCR", day: int = 23) -> ProductCodeRecord:
+    return ProductCodeRecord(f"10232024095207EPUJQ{idx:04d}", datetime.datetime(2024, 10, day, 9, 52, 7),
+                             solution_id, "2730590", f"P{idx % 3}", "product", idx % 2 == 0)
+
+
+class FakeS3Client:
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.uploads = {}
+
+    async def upload_file(self, path, bucket, key):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("S3 unavailable")
+        with open(path, "rb") as f:
+            self.uploads[(bucket, key)] = f.read()
+
+
+class FakeMySQL:
+    async def bulk_insert_data(self, table_1, columns_1, data_1, table_2, columns_2, data_2, mode=None):
+        return data_1[:1], []
+
+
+def read_csv(content: bytes) -> list:
+    return list(csv.reader(gzip.decompress(content).decode("utf-8").splitlines()))
+
+
+class TestColumnarSink(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.s3_client = FakeS3Client()
+
+    async def asyncTearDown(self):
+        shutil.rmtree(self.directory)
+
+    def make_sink(self, **kwargs):
+        params = dict(directory=self.directory, bucket="analytics", prefix="billing", s3_client=self.s3_client)
+        params.update(kwargs)
+        return ColumnarSink(**params)
+
+    async def test_rows_are_partitioned(self):
+        sink = self.make_sink()
+        await sink.start()
+        await sink.write("product_codes", COLUMNS, [make_row(0), make_row(1, "GOCR", 24), make_row(2, "GOXX")])
+        await sink.write("product_codes", COLUMNS, [make_row(3)])
+        await sink.stop()
+
+        self.assertEqual(sorted(key.rsplit("/", 1)[0] for _, key in self.s3_client.uploads), [
+            "billing/product_codes/inquiry_date=2024-10-23/solution_id=GOCR",
+            "billing/product_codes/inquiry_date=2024-10-23/solution_id=GOXX",
+            "billing/product_codes/inquiry_date=2024-10-24/solution_id=GOCR",
+        ])
+        content = next(content for (_, key), content in self.s3_client.uploads.items() if "2024-10-23/solution_id=GOCR" in key)
+        lines = read_csv(content)
+        self.assertEqual(lines[0], list(COLUMNS))
+        self.assertEqual(lines[1], ["10232024095207EPUJQ0000", "2024-10-23 09:52:07", "GOCR", "2730590", "P0", "product", "true"])
+        self.assertEqual([each[0] for each in lines[1:]], ["10232024095207EPUJQ0000", "10232024095207EPUJQ0003"])
+        # uploaded files are deleted
+        self.assertEqual([files for _, _, files in os.walk(self.directory) if files], [])
+
+    async def test_files_roll_over(self):
+        sink = self.make_sink(max_file_bytes=1, max_open_files=1)
+        await sink.start()
+        for idx in range(3):
+            await sink.write("product_codes", COLUMNS, [make_row(idx, day=23 + idx % 2)])
+        await sink.stop()
+
+        # each append fills its file, every row ends up in its own file
+        self.assertEqual(len(self.s3_client.uploads), 3)
+        rows = sorted(row[0] for content in self.s3_client.uploads.values() for row in read_csv(content)[1:])
+        self.assertEqual(rows, [make_row(idx).transaction_id for idx in range(3)])
+
+    async def test_failed_upload_is_retried(self):
+        self.s3_client.failures = 1
+        sink = self.make_sink()
+        await sink.start()
+        await sink.write("product_codes", COLUMNS, [make_row(0)])
+        await sink.stop()
+        self.assertEqual(self.s3_client.uploads, {})
+
+        # the file kept on disk goes with the next roll
+        await sink.start()
+        await sink.stop()
+        self.assertEqual(len(self.s3_client.uploads), 1)
+
+    async def test_pending_rows_are_bounded(self):
+        sink = self.make_sink(max_pending_rows=2)
+        # the writer task is not started, the third write waits for room
+        await sink.write("product_codes", COLUMNS, [make_row(0), make_row(1)])
+        await sink.start()
+        await sink.write("product_codes", COLUMNS, [make_row(2)])
+        self.assertLessEqual(sink._pending_rows, 2)
+        await sink.stop()
+        self.assertEqual(sink._pending_rows, 0)
+
+    async def test_writer_appends_the_accepted_rows(self):
+        sink = self.make_sink(bucket="")
+        await sink.start()
+        writer = ColumnarSinkWriter(FakeMySQL(), sink)
+        rows = [make_row(idx) for idx in range(3)]
+
+        rejected_1, rejected_2 = await writer.bulk_insert_data("billing", COLUMNS, rows, "product_codes", COLUMNS, [])
+        await sink.stop()
+
+        self.assertEqual((rejected_1, rejected_2), (rows[:1], []))
+        # without a bucket the files stay on disk
+        paths = [os.path.join(root, each) for root, _, files in os.walk(self.directory) for each in files]
+        self.assertEqual(len(paths), 1)
+        with open(paths[0], "rb") as f:
+            self.assertEqual([each[0] for each in read_csv(f.read())[1:]], [rows[1].transaction_id, rows[2].transaction_id])
+
+    @unittest.skipIf(pyarrow is None, "pyarrow is not installed")
+    async def test_parquet(self):
+        sink = self.make_sink(file_format=SINK_FORMAT_PARQUET, bucket="")
+        await sink.start()
+        await sink.write("product_codes", COLUMNS, [make_row(0), make_row(1)])
+        await sink.stop()
+
+        paths = [os.path.join(root, each) for root, _, files in os.walk(self.directory) for each in files]
+        table = pyarrow.parquet.read_table(paths[0])
+        self.assertEqual(table.column("transaction_id").to_pylist(), [make_row(0).transaction_id, make_row(1).transaction_id])
+
+    def test_unknown_format(self):
+        with self.assertRaises(ValueError):
+            ColumnarSink(file_format="avro")
@@ -0,0 +1,89 @@
+import os
+import asyncio
+import tempfile
+import unittest
+from billing_consumer_new.helpers.crypto_workers import (CryptoWorkerClient, CryptoWorkerError, crypto_worker_socket_paths,
+                                                         decode_items, encode_items, serve_crypto_worker)
+
+
+class StubContentHelper:
+    """ reverses the payloads instead of calling the JVM """
+
+    def __init__(self):
+        self.calls = []
+        self.running = 0
+        self.max_running = 0
+
+    async def aetask_many(self, inps):
+        self.calls.append(len(inps))
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        await asyncio.sleep(0.01)
+        self.running -= 1
+        if b"fail" in inps:
+            raise RuntimeError("cipher unavailable")
+        return [each[::-1] for each in inps], 0.5
+
+    async def adtask_many(self, encrypted_items):
+        return [each[::-1] for each in encrypted_items], 0.25
+
+
+class TestCryptoWorkers(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.socket_dir = tempfile.mkdtemp()
+        self.socket_paths = crypto_worker_socket_paths(2, self.socket_dir)
+        self.crypto_util = StubContentHelper()
+        self.workers = [asyncio.create_task(serve_crypto_worker(self.crypto_util, each)) for each in self.socket_paths]
+        self.client = CryptoWorkerClient(self.socket_paths, connect_timeout=5, max_inflight=2)
+
+    async def asyncTearDown(self):
+        self.client.close()
+        for each in self.workers:
+            each.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        os.rmdir(self.socket_dir)
+
+    def test_encode_items(self):
+        items = [b"", b"abc", bytes(range(256))]
+        self.assertEqual(decode_items(encode_items(items)), items)
+        self.assertEqual(decode_items(b"E" + encode_items(items), 1), items)
+
+    async def test_batch_is_one_request(self):
+        ret, elapsed = await self.client.aetask_many([b"abc", b"xyz", b"123"])
+
+        self.assertEqual(ret, [b"cba", b"zyx", b"321"])
+        self.assertEqual(elapsed, 0.5)
+        self.assertEqual(self.crypto_util.calls, [3])
+
+    async def test_single_payload(self):
+        self.assertEqual(await self.client.aetask(b"abc"), (b"cba", 0.5))
+        self.assertEqual(await self.client.adtask(b"cba"), (b"abc", 0.25))
+
+    async def test_concurrent_requests(self):
+        results = await asyncio.gather(*[self.client.aetask_many([f"{idx}".encode("utf-8")] * 2) for idx in range(20)])
+
+        self.assertEqual([ret for ret, _ in results], [[f"{idx}".encode("utf-8")[::-1]] * 2 for idx in range(20)])
+        # 2 workers with 2 requests in flight each, the 20 requests share 4 connections
+        self.assertEqual(self.crypto_util.max_running, 4)
+        self.assertEqual([len(worker.idle) for worker in self.client.workers], [2, 2])
+        self.assertEqual([worker.inflight for worker in self.client.workers], [0, 0])
+
+    async def test_least_loaded_worker_is_picked(self):
+        first, second = self.client.workers
+        self.assertIs(self.client.pick_worker(), first)
+        # round robin among the ties
+        self.assertIs(self.client.pick_worker(), second)
+
+        second.inflight = 1
+        self.assertIs(self.client.pick_worker(), first)
+        self.assertIs(self.client.pick_worker(), first)
+        first.inflight = 2
+        self.assertIs(self.client.pick_worker(), second)
+        first.inflight = second.inflight = 0
+
+    async def test_worker_error(self):
+        with self.assertRaises(CryptoWorkerError):
+            await self.client.aetask_many([b"abc", b"fail"])
+        # the connection is still usable
+        self.assertEqual(await self.client.aetask(b"abc"), (b"cba", 0.5))
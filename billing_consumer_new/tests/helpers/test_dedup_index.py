@@ -0,0 +1,58 @@
+import unittest
+from unittest.mock import AsyncMock, Mock, patch
+from billing_consumer_new.helpers import metrics
+from billing_consumer_new.helpers.dedup_index import TransactionDedupIndex
+
+
+class TestTransactionDedupIndex(unittest.IsolatedAsyncioTestCase):
+
+    async def test_marked_transactions_are_duplicates(self):
+        dedup_index = TransactionDedupIndex(max_size=10, ttl_seconds=60)
+        dedup_index.mark(["T1", "T2"])
+        hits = metrics.DEDUP_LOOKUPS.value(result="hit")
+
+        self.assertEqual(await dedup_index.find_duplicates(["T1", "T3"]), {"T1"})
+        self.assertEqual(metrics.DEDUP_LOOKUPS.value(result="hit"), hits + 1)
+
+    async def test_least_recently_used_is_evicted(self):
+        dedup_index = TransactionDedupIndex(max_size=2, ttl_seconds=60)
+        dedup_index.mark(["T1", "T2"])
+        self.assertIn("T1", dedup_index)
+        dedup_index.mark(["T3"])
+
+        self.assertEqual(len(dedup_index), 2)
+        self.assertNotIn("T2", dedup_index)
+        self.assertIn("T1", dedup_index)
+
+    async def test_entries_expire_after_ttl(self):
+        dedup_index = TransactionDedupIndex(max_size=10, ttl_seconds=60)
+        with patch("billing_consumer_new.helpers.dedup_index.time.monotonic", return_value=1000.0):
+            dedup_index.mark(["T1"])
+        with patch("billing_consumer_new.helpers.dedup_index.time.monotonic", return_value=1061.0):
+            self.assertNotIn("T1", dedup_index)
+
+    async def test_db_precheck_for_cold_start(self):
+        mysql = Mock()
+        mysql.select_existing = AsyncMock(return_value={"T2"})
+        dedup_index = TransactionDedupIndex(max_size=10, ttl_seconds=60, mysql=mysql, precheck_window_seconds=0)
+        dedup_index.mark(["T1"])
+
+        self.assertEqual(await dedup_index.find_duplicates(["T1", "T2", "T3"]), {"T1", "T2"})
+        self.assertEqual(mysql.select_existing.await_args.args[2], ["T2", "T3"])
+        # found by the pre-check, now held by the index
+        self.assertIn("T2", dedup_index)
+
+    async def test_precheck_failure_lets_the_batch_through(self):
+        mysql = Mock()
+        mysql.select_existing = AsyncMock(side_effect=RuntimeError("RDS unavailable"))
+        dedup_index = TransactionDedupIndex(max_size=10, ttl_seconds=60, mysql=mysql, precheck_window_seconds=0)
+
+        self.assertEqual(await dedup_index.find_duplicates(["T1"]), set())
+
+    async def test_precheck_stops_after_the_window(self):
+        mysql = Mock()
+        with patch("billing_consumer_new.helpers.dedup_index.time.monotonic", return_value=1000.0):
+            dedup_index = TransactionDedupIndex(max_size=10, ttl_seconds=60, mysql=mysql, precheck_window_seconds=300)
+            self.assertTrue(dedup_index.precheck_active())
+        with patch("billing_consumer_new.helpers.dedup_index.time.monotonic", return_value=1301.0):
+            self.assertFalse(dedup_index.precheck_active())
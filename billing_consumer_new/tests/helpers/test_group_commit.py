@@ -0,0 +1,66 @@
+import asyncio
+import unittest
+from unittest.mock import AsyncMock, Mock
+from billing_consumer_new.helpers.group_commit import GroupCommitWriter
+
+
+class TestGroupCommitWriter(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.mysql = Mock()
+        self.mysql.bulk_insert_data = AsyncMock(return_value=([], []))
+
+    def insert(self, writer, *transaction_ids):
+        return writer.bulk_insert_data("billing", ["transaction_id"], [(each,) for each in transaction_ids],
+                                       "product_codes", ["transaction_id", "product_code"], [(each, "PPC0001") for each in transaction_ids])
+
+    async def test_batches_are_merged_at_the_deadline(self):
+        writer = GroupCommitWriter(self.mysql, max_records=100, max_delay_ms=10)
+
+        results = await asyncio.gather(self.insert(writer, "T1", "T2"), self.insert(writer, "T3"))
+
+        self.assertEqual(results, [([], []), ([], [])])
+        self.mysql.bulk_insert_data.assert_awaited_once_with(
+            "billing", ("transaction_id",), [("T1",), ("T2",), ("T3",)],
+            "product_codes", ("transaction_id", "product_code"), [("T1", "PPC0001"), ("T2", "PPC0001"), ("T3", "PPC0001")], mode=None)
+
+    async def test_flush_at_max_records(self):
+        writer = GroupCommitWriter(self.mysql, max_records=3, max_delay_ms=60000)
+
+        first = asyncio.create_task(self.insert(writer, "T1", "T2"))
+        await asyncio.sleep(0)
+        self.mysql.bulk_insert_data.assert_not_awaited()
+        await asyncio.wait_for(asyncio.gather(first, self.insert(writer, "T3")), timeout=1)
+
+        self.assertEqual(self.mysql.bulk_insert_data.await_count, 1)
+        self.assertEqual(writer._groups, {})
+
+    async def test_rejected_records_are_returned_to_their_caller(self):
+        async def bulk_insert_data(table_1, columns_1, data_1, table_2, columns_2, data_2, mode=None):
+            return [row for row in data_1 if row[0] == "T3"], [row for row in data_2 if row[0] == "T3"]
+
+        self.mysql.bulk_insert_data = AsyncMock(side_effect=bulk_insert_data)
+        writer = GroupCommitWriter(self.mysql, max_records=100, max_delay_ms=10)
+
+        first, second = await asyncio.gather(self.insert(writer, "T1", "T2"), self.insert(writer, "T3"))
+
+        self.assertEqual(first, ([], []))
+        self.assertEqual(second, ([("T3",)], [("T3", "PPC0001")]))
+
+    async def test_write_failure_is_raised_to_every_caller(self):
+        self.mysql.bulk_insert_data = AsyncMock(side_effect=RuntimeError("RDS unavailable"))
+        writer = GroupCommitWriter(self.mysql, max_records=100, max_delay_ms=10)
+
+        results = await asyncio.gather(self.insert(writer, "T1"), self.insert(writer, "T2"), return_exceptions=True)
+
+        self.assertTrue(all(isinstance(each, RuntimeError) for each in results))
+
+    async def test_flush(self):
+        writer = GroupCommitWriter(self.mysql, max_records=100, max_delay_ms=60000)
+
+        pending = asyncio.create_task(self.insert(writer, "T1"))
+        await asyncio.sleep(0)
+        await writer.flush()
+
+        self.assertTrue(pending.done())
+        self.mysql.bulk_insert_data.assert_awaited_once()
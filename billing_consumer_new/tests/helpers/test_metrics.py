@@ -0,0 +1,116 @@
+import os
+import json
+import asyncio
+import shutil
+import tempfile
+import unittest
+from billing_consumer_new.helpers.metrics import MetricsRegistry, MultiProcessExporter, clear_multiprocess_dir
+
+
+class TestMetricsRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = MetricsRegistry()
+        self.pid = os.getpid()
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = self.registry.histogram("stage_seconds", "Stage latency", ("stage",), buckets=(0.1, 1.0))
+        histogram.observe(0.05, stage="decode")
+        histogram.observe(0.1, stage="decode")
+        histogram.observe(2.0, stage="decode")
+
+        lines = self.registry.render().splitlines()
+
+        self.assertEqual(lines[:2], ["# HELP stage_seconds Stage latency", "# TYPE stage_seconds histogram"])
+        self.assertEqual(lines[2:], [
+            f'stage_seconds_bucket{{pid="{self.pid}",stage="decode",le="0.1"}} 2',
+            f'stage_seconds_bucket{{pid="{self.pid}",stage="decode",le="1.0"}} 2',
+            f'stage_seconds_bucket{{pid="{self.pid}",stage="decode",le="+Inf"}} 3',
+            f'stage_seconds_sum{{pid="{self.pid}",stage="decode"}} 2.15',
+            f'stage_seconds_count{{pid="{self.pid}",stage="decode"}} 3',
+        ])
+
+    def test_counter_and_gauge(self):
+        counter = self.registry.counter("failures_total", "Failures", ("reason",))
+        gauge = self.registry.gauge("lag", "Lag", ("partition",))
+        counter.inc(reason="split")
+        counter.inc(2, reason="split")
+        gauge.set(5, partition=0)
+        gauge.set(3, partition=0)
+
+        text = self.registry.render()
+
+        self.assertIn(f'failures_total{{pid="{self.pid}",reason="split"}} 3\n', text)
+        self.assertIn(f'lag{{pid="{self.pid}",partition="0"}} 3\n', text)
+
+    def test_collectors_run_before_render(self):
+        gauge = self.registry.gauge("queue_depth", "Queue depth")
+        self.registry.add_collector(lambda: gauge.set(4))
+
+        self.assertIn(f'queue_depth{{pid="{self.pid}"}} 4\n', self.registry.render())
+
+    def test_duplicate_name_is_rejected(self):
+        self.registry.counter("failures_total", "Failures")
+        with self.assertRaises(ValueError):
+            self.registry.gauge("failures_total", "Failures")
+
+    def test_label_values_are_escaped(self):
+        counter = self.registry.counter("failures_total", "Failures", ("reason",))
+        counter.inc(reason='bad "quote" \\ and\nnewline')
+
+        self.assertIn(f'failures_total{{pid="{self.pid}",reason="bad \\"quote\\" \\\\ and\\nnewline"}} 1\n', self.registry.render())
+
+
+class TestMultiProcessExporter(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.registry = MetricsRegistry()
+        self.counter = self.registry.counter("records_total", "Records", ("table",))
+        self.pid = os.getpid()
+
+    def write_snapshot(self, pid: int, value: int):
+        snapshot = {"records_total": {"help": "Records", "type": "counter", "samples": [["", ["pid", "table"], [pid, "billing"], value]]}}
+        with open(os.path.join(self.directory, f"{pid}.json"), "w", encoding="utf-8") as snapshot_file:
+            json.dump(snapshot, snapshot_file)
+
+    async def test_scrape_renders_every_live_process(self):
+        exporter = MultiProcessExporter(self.directory, self.registry, interval=60)
+        self.counter.inc(3, table="billing")
+        # the parent process stands in for another consumer process
+        self.write_snapshot(os.getppid(), 5)
+
+        lines = exporter.render().splitlines()
+
+        self.assertEqual(lines.count("# TYPE records_total counter"), 1)
+        self.assertIn(f'records_total{{pid="{self.pid}",table="billing"}} 3', lines)
+        self.assertIn(f'records_total{{pid="{os.getppid()}",table="billing"}} 5', lines)
+
+    async def test_snapshot_of_a_dead_process_is_dropped(self):
+        exporter = MultiProcessExporter(self.directory, self.registry, interval=60)
+        # above the default pid_max, never a live process
+        self.write_snapshot(4194305, 5)
+
+        self.assertNotIn('pid="4194305"', exporter.render())
+        self.assertFalse(os.path.exists(os.path.join(self.directory, "4194305.json")))
+
+    async def test_snapshot_is_written_until_stop(self):
+        exporter = MultiProcessExporter(self.directory, self.registry, interval=0.01)
+        await exporter.start()
+        self.counter.inc(table="billing")
+        await asyncio.sleep(0.05)
+
+        with open(exporter.path, encoding="utf-8") as snapshot_file:
+            samples = json.load(snapshot_file)["records_total"]["samples"]
+        self.assertEqual(samples, [["", ["pid", "table"], [self.pid, "billing"], 1]])
+
+        await exporter.stop()
+        self.assertFalse(os.path.exists(exporter.path))
+
+    def test_clear_multiprocess_dir(self):
+        self.write_snapshot(4194305, 5)
+
+        clear_multiprocess_dir(self.directory)
+
+        self.assertEqual(os.listdir(self.directory), [])
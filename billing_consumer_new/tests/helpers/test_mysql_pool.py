@@ -0,0 +1,149 @@
+import time
+import asyncio
+import unittest
+from unittest.mock import patch
+from billing_consumer_new.helpers import app_config, metrics
+from billing_consumer_new.helpers.mysql_pool import MySQLPool, mysql_pool_size
+
+
+class FakeConnection:
+    def __init__(self, idx):
+        self.idx = idx
+        self.closed = False
+        self.alive = True
+        self.in_transaction = False
+        self.pings = 0
+
+    async def ping(self, reconnect=True):
+        self.pings += 1
+        if not self.alive:
+            raise ConnectionError("gone away")
+
+    def get_transaction_status(self):
+        return self.in_transaction
+
+    def close(self):
+        self.closed = True
+
+
+class TestMySQLPool(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.connections = []
+
+    async def connect(self):
+        await asyncio.sleep(0.05)
+        connection = FakeConnection(len(self.connections))
+        self.connections.append(connection)
+        return connection
+
+    def discarded(self, reason):
+        return metrics.DB_POOL_DISCARDED.value(reason=reason)
+
+    async def test_warmup_opens_in_parallel(self):
+        pool = MySQLPool(self.connect, 4, 6)
+        st = time.perf_counter()
+        self.assertEqual(await pool.warmup(), 4)
+        self.assertLess(time.perf_counter() - st, 0.15)
+        self.assertEqual((pool.size, pool.freesize), (4, 4))
+
+        # a warm connection is lent without a new connect
+        async with pool.acquire() as connection:
+            self.assertIn(connection, self.connections)
+            self.assertEqual(metrics.DB_POOL_CONNECTIONS.value(state="in_use"), 1)
+        self.assertEqual(len(self.connections), 4)
+
+    async def test_warmup_fails_without_any_connection(self):
+        async def refused():
+            raise ConnectionRefusedError("refused")
+
+        with self.assertRaises(ConnectionRefusedError):
+            await MySQLPool(refused, 2, 2).warmup()
+
+    async def test_maxsize_bounds_the_connections(self):
+        pool = MySQLPool(self.connect, 0, 2)
+        waited = metrics.DB_POOL_WAIT.count()
+        in_use = []
+
+        async def write():
+            async with pool.acquire() as connection:
+                in_use.append(connection)
+                self.assertLessEqual(len(in_use), 2)
+                await asyncio.sleep(0.02)
+                in_use.remove(connection)
+
+        await asyncio.gather(*[write() for _ in range(6)])
+
+        self.assertEqual(len(self.connections), 2)
+        self.assertEqual(pool.freesize, 2)
+        self.assertEqual(metrics.DB_POOL_WAIT.count() - waited, 6)
+
+    async def test_idle_connection_is_pinged(self):
+        pool = MySQLPool(self.connect, 2, 2, ping_idle=0)
+        await pool.warmup()
+        dead = self.connections[1]
+        dead.alive = False
+        before = self.discarded("ping_failed")
+
+        async with pool.acquire() as connection:
+            # the dead connection, released last, is replaced by the other warm one
+            self.assertIs(connection, self.connections[0])
+        self.assertTrue(dead.closed)
+        self.assertEqual(self.discarded("ping_failed") - before, 1)
+
+        # a connection used right before is not pinged
+        pool.ping_idle = 60
+        async with pool.acquire() as connection:
+            self.assertEqual(connection.pings, 1)
+
+    async def test_recycle_and_release(self):
+        pool = MySQLPool(self.connect, 1, 1, recycle=0.01)
+        await pool.warmup()
+        await asyncio.sleep(0.02)
+        before = self.discarded("recycled")
+
+        async with pool.acquire() as connection:
+            self.assertIsNot(connection, self.connections[0])
+            connection.in_transaction = True
+        self.assertEqual(self.discarded("recycled") - before, 1)
+        # left in a transaction, never lent again
+        self.assertTrue(connection.closed)
+        self.assertEqual(pool.size, 0)
+
+    async def test_close(self):
+        pool = MySQLPool(self.connect, 2, 2)
+        await pool.warmup()
+        async with pool.acquire() as connection:
+            pool.close()
+            self.assertTrue(self.connections[0].closed)
+            self.assertFalse(connection.closed)
+        await pool.wait_closed()
+        self.assertTrue(connection.closed)
+        with self.assertRaises(RuntimeError):
+            await pool._acquire()
+
+
+class TestMySQLPoolSize(unittest.TestCase):
+
+    def pool_size(self, num_consumers, **settings):
+        defaults = dict(MYSQL_POOL_SIZE=0, BILLING_PIPELINE_ENABLED=False, BILLING_PIPELINE_WRITE_WORKERS=4,
+                        BILLING_RETRY_ENABLED=False, KAFKA_PARTITION_CONCURRENCY=0, DEDUP_ENABLED=False,
+                        DEDUP_DB_PRECHECK=False)
+        with patch.multiple(app_config, **{**defaults, **settings}):
+            return mysql_pool_size(num_consumers)
+
+    def test_one_connection_per_consumer(self):
+        self.assertEqual(self.pool_size(3), 3)
+        self.assertEqual(self.pool_size(3, BILLING_RETRY_ENABLED=True), 4)
+
+    def test_partition_concurrency_multiplies_the_writers(self):
+        self.assertEqual(self.pool_size(3, KAFKA_PARTITION_CONCURRENCY=4), 12)
+        # the retry consumer runs its partition batches concurrently as well
+        self.assertEqual(self.pool_size(3, KAFKA_PARTITION_CONCURRENCY=4, BILLING_RETRY_ENABLED=True), 16)
+        self.assertEqual(self.pool_size(3, KAFKA_PARTITION_CONCURRENCY=4, DEDUP_ENABLED=True, DEDUP_DB_PRECHECK=True), 13)
+
+    def test_pipeline_write_workers(self):
+        self.assertEqual(self.pool_size(3, BILLING_PIPELINE_ENABLED=True, KAFKA_PARTITION_CONCURRENCY=4), 4)
+
+    def test_override(self):
+        self.assertEqual(self.pool_size(3, MYSQL_POOL_SIZE=20, KAFKA_PARTITION_CONCURRENCY=4), 20)
@@ -0,0 +1,296 @@
+import os
+import datetime
+import unittest
+import contextlib
+import pymysql
+from typing import NamedTuple
+from unittest.mock import AsyncMock, patch
+from billing_consumer_new.helpers import app_config
+from billing_consumer_new.helpers.mysql_pool import MySQLPool
+from billing_consumer_new.helpers.sql_util import (aio_mysql, chunk_transactions, insert_statement, is_transient_error,
+                                                   load_data_value, write_load_data_file)
+
+
+class CodeRow(NamedTuple):
+    transaction_id: str
+    product_code: str
+
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def executemany(self, query, rows):
+        self.connection.statements += 1
+        table = query.split()[2]
+        if self.connection.pool.lost_connections:
+            self.connection.pool.lost_connections -= 1
+            raise pymysql.err.OperationalError(2013, "Lost connection to MySQL server during query")
+        for row in rows:
+            if row[0] in self.connection.pool.poison or (table, row[0]) in self.connection.pool.poison:
+                raise pymysql.err.DataError(1406, f"Data too long for '{row[0]}'")
+        # ON DUPLICATE KEY UPDATE leaves the rows already in the table as is
+        self.connection.uncommitted.append((table, [row for row in rows if row[0] not in self.connection.pool.tables[table]]))
+
+    async def execute(self, query, args=None):
+        self.connection.statements += 1
+        self.connection.executed.append((query, args))
+
+
+class FakeConnection:
+    def __init__(self, pool):
+        self.pool = pool
+        self.uncommitted = []
+        self.executed = []
+        self.statements = 0
+
+    def escape(self, row):
+        return pymysql.converters.escape_item(row, "utf8")
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    async def commit(self):
+        self.pool.commits += 1
+        for table, rows in self.uncommitted:
+            self.pool.tables[table].extend(each[0] for each in rows)
+        self.uncommitted = []
+
+    async def rollback(self):
+        self.uncommitted = []
+
+
+class FakePool:
+    def __init__(self, poison=(), lost_connections=0):
+        self.poison = set(poison)
+        self.lost_connections = lost_connections
+        self.tables = {"billing": [], "product_codes": []}
+        self.commits = 0
+        self.connections = []
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        connection = FakeConnection(self)
+        self.connections.append(connection)
+        yield connection
+
+
+class ReadConnection:
+    """ a connection without autocommit, a SELECT opens a transaction until commit or rollback """
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.closed = False
+        self.in_transaction = False
+
+    def cursor(self):
+        return ReadCursor(self)
+
+    def get_transaction_status(self):
+        return self.in_transaction
+
+    async def rollback(self):
+        self.in_transaction = False
+
+    def close(self):
+        self.closed = True
+
+
+class ReadCursor(FakeCursor):
+    async def execute(self, query, args=None):
+        self.connection.in_transaction = True
+        self.args = args
+
+    async def fetchall(self):
+        return [(each,) for each in self.args if each in self.connection.rows]
+
+
+def make_mysql(pool):
+    with patch("billing_consumer_new.helpers.sql_util.SecretsManagerUtil"):
+        mysql = aio_mysql()
+    mysql.connection_pool = pool
+    return mysql
+
+
+class TestBulkInsertData(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.rows_1 = [(f"T{idx:02d}", "record") for idx in range(50)]
+        self.rows_2 = [(f"T{idx:02d}", "code") for idx in range(50)]
+
+    async def insert(self, mysql):
+        return await mysql.bulk_insert_data("billing", ("transaction_id", "billing_record"), self.rows_1,
+                                            "product_codes", ("transaction_id", "product_code"), self.rows_2)
+
+    async def test_bulk_insert(self):
+        pool = FakePool()
+
+        rejected = await self.insert(make_mysql(pool))
+
+        self.assertEqual(rejected, ([], []))
+        # both tables in one DB transaction
+        self.assertEqual(pool.commits, 1)
+        self.assertEqual(len(pool.tables["billing"]), 50)
+        self.assertEqual(len(pool.tables["product_codes"]), 50)
+
+    async def test_transaction_is_written_to_both_tables_or_none(self):
+        # only the product code row of T17 fails, its allout row is rolled back with it
+        pool = FakePool(poison={("product_codes", "T17")})
+
+        rejected_1, rejected_2 = await self.insert(make_mysql(pool))
+
+        self.assertEqual(rejected_1, [("T17", "record")])
+        self.assertEqual(rejected_2, [("T17", "code")])
+        self.assertNotIn("T17", pool.tables["billing"])
+        self.assertEqual(len(pool.tables["billing"]), 49)
+
+    async def test_rows_already_written_count_as_written(self):
+        pool = FakePool()
+        pool.tables["billing"].extend(["T03", "T04"])
+
+        rejected = await self.insert(make_mysql(pool))
+
+        self.assertEqual(rejected, ([], []))
+        self.assertEqual(sorted(pool.tables["billing"]), [row[0] for row in self.rows_1])
+        self.assertEqual(pool.tables["product_codes"], [row[0] for row in self.rows_2])
+
+    async def test_poison_row_is_isolated(self):
+        pool = FakePool(poison={"T17"})
+
+        rejected_1, rejected_2 = await self.insert(make_mysql(pool))
+
+        self.assertEqual(rejected_1, [("T17", "record")])
+        self.assertEqual(rejected_2, [("T17", "code")])
+        # every good row is written exactly once and in order
+        self.assertEqual(pool.tables["billing"], [row[0] for row in self.rows_1 if row[0] != "T17"])
+        self.assertEqual(pool.tables["product_codes"], [row[0] for row in self.rows_2 if row[0] != "T17"])
+        # log2(50) splits per table instead of one statement per row
+        self.assertLess(sum(each.statements for each in pool.connections), 30)
+
+    async def test_transient_error_is_retried_without_duplicates(self):
+        pool = FakePool(lost_connections=1)
+
+        rejected = await self.insert(make_mysql(pool))
+
+        self.assertEqual(rejected, ([], []))
+        self.assertEqual(len(pool.connections), 2)
+        self.assertEqual(pool.tables["billing"], [row[0] for row in self.rows_1])
+        self.assertEqual(pool.tables["product_codes"], [row[0] for row in self.rows_2])
+
+    async def test_rows_pending_after_retries_are_rejected(self):
+        pool = FakePool(lost_connections=3)
+
+        with patch("billing_consumer_new.helpers.sql_util.asyncio.sleep", new_callable=AsyncMock) as sleep:
+            rejected_1, rejected_2 = await self.insert(make_mysql(pool))
+
+        self.assertEqual(rejected_1, self.rows_1)
+        self.assertEqual(rejected_2, self.rows_2)
+        self.assertEqual(pool.tables["billing"], [])
+        # a backoff doubling between the attempts, none after the last one
+        self.assertEqual([each.args[0] for each in sleep.await_args_list], [0.1, 0.2])
+
+    async def test_write_attempts(self):
+        pool = FakePool(lost_connections=4)
+
+        with patch.multiple(app_config, MYSQL_WRITE_ATTEMPTS=5, MYSQL_WRITE_RETRY_BACKOFF_MS=1):
+            rejected = await self.insert(make_mysql(pool))
+
+        self.assertEqual(rejected, ([], []))
+        self.assertEqual(len(pool.connections), 5)
+
+    async def test_rows_are_chunked_to_the_byte_budget(self):
+        pool = FakePool()
+
+        with patch.object(app_config, "MYSQL_CHUNK_BYTES", 300):
+            rejected = await self.insert(make_mysql(pool))
+
+        self.assertEqual(rejected, ([], []))
+        # 50 transactions of ~32 bytes, 9 per chunk
+        self.assertEqual(pool.commits, 6)
+        self.assertEqual(pool.tables["billing"], [row[0] for row in self.rows_1])
+
+    async def test_values_mode(self):
+        pool = FakePool()
+        mysql = make_mysql(pool)
+
+        await mysql.bulk_insert_data("billing", ("transaction_id", "billing_record"), self.rows_1[:2],
+                                     "product_codes", ("transaction_id", "product_code"), [CodeRow(*self.rows_2[0])], mode="values")
+
+        executed = [each for connection in pool.connections for each in connection.executed]
+        self.assertEqual(executed, [
+            ("INSERT INTO billing (transaction_id, billing_record) VALUES ('T00','record'),('T01','record')"
+             " ON DUPLICATE KEY UPDATE transaction_id = transaction_id", None),
+            ("INSERT INTO product_codes (transaction_id, product_code) VALUES ('T00','code')"
+             " ON DUPLICATE KEY UPDATE transaction_id = transaction_id", None)
+        ])
+
+    async def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            await make_mysql(FakePool()).bulk_insert_data("billing", ("a",), [], "product_codes", ("a",), [], mode="copy")
+
+    def test_chunk_transactions(self):
+        rows_1 = [(f"T{idx}{'a' * 8}",) for idx in range(5)]
+        rows_2 = [(f"T1{'a' * 8}", "x"), (f"T1{'a' * 8}", "y"), (f"T9{'a' * 8}", "z")]
+        chunks = chunk_transactions(rows_1, rows_2, 30)
+        # 15 bytes per transaction, 53 for T1 with its 2 product codes
+        self.assertEqual([len(each) for each in chunks], [1, 1, 2, 1, 1])
+        # the product codes stay with their transaction
+        self.assertEqual(chunks[1], [([rows_1[1]], rows_2[:2])])
+        self.assertEqual(chunks[4], [([], rows_2[2:])])
+        self.assertEqual([len(each) for each in chunk_transactions(rows_1, [], 1)], [1, 1, 1, 1, 1])
+        self.assertEqual(chunk_transactions([], [], 30), [])
+
+    def test_insert_statement_is_cached(self):
+        statement = insert_statement("billing", ("transaction_id", "billing_record"))
+        self.assertEqual(statement, "INSERT INTO billing (transaction_id, billing_record) VALUES (%s, %s)"
+                                    " ON DUPLICATE KEY UPDATE transaction_id = transaction_id")
+        self.assertIs(insert_statement("billing", ("transaction_id", "billing_record")), statement)
+
+    async def test_load_data_file(self):
+        self.assertEqual(load_data_value(None), "\\N")
+        self.assertEqual(load_data_value(True), "1")
+        self.assertEqual(load_data_value(datetime.datetime(2024, 10, 23, 9, 52, 7)), "2024-10-23 09:52:07")
+        self.assertEqual(load_data_value("a\tb\\c"), "a\\tb\\\\c")
+
+        file_path = await write_load_data_file([("T00", False, None), ("T01", True, "x\ny")])
+        try:
+            with open(file_path, encoding="utf-8") as load_file:
+                self.assertEqual(load_file.read(), "T00\t0\t\\N\nT01\t1\tx\\ny\n")
+        finally:
+            os.remove(file_path)
+
+    def test_is_transient_error(self):
+        self.assertTrue(is_transient_error(pymysql.err.OperationalError(2013, "Lost connection")))
+        self.assertTrue(is_transient_error(pymysql.err.OperationalError(1213, "Deadlock found")))
+        self.assertTrue(is_transient_error(pymysql.err.InterfaceError(0, "")))
+        self.assertFalse(is_transient_error(pymysql.err.OperationalError(1366, "Incorrect string value")))
+        self.assertFalse(is_transient_error(pymysql.err.IntegrityError(1062, "Duplicate entry")))
+        self.assertFalse(is_transient_error(pymysql.err.DataError(1406, "Data too long")))
+
+
+class TestSelectExisting(unittest.IsolatedAsyncioTestCase):
+
+    async def test_connection_goes_back_to_the_pool_after_a_read(self):
+        connections = []
+
+        async def connect():
+            connections.append(ReadConnection({"T01", "T03"}))
+            return connections[-1]
+
+        pool = MySQLPool(connect, 1, 1)
+        await pool.warmup()
+        mysql = make_mysql(pool)
+
+        self.assertEqual(await mysql.select_existing("billing", "transaction_id", ["T01", "T02", "T03"]), {"T01", "T03"})
+        self.assertEqual(await mysql.select_existing("billing", "transaction_id", ["T02"]), set())
+
+        # the same connection served both reads and is idle in the pool
+        self.assertEqual(len(connections), 1)
+        self.assertFalse(connections[0].closed)
+        self.assertEqual(pool.freesize, 1)
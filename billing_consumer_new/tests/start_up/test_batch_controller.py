@@ -0,0 +1,52 @@
+import unittest
+from billing_consumer_new.helpers import metrics
+from billing_consumer_new.start_up.batch_controller import AdaptiveBatchController
+
+
+class TestAdaptiveBatchController(unittest.TestCase):
+
+    def make_controller(self, **kwargs):
+        params = dict(initial_records=50, min_records=10, max_records=400, target_batch_ms=2000, max_poll_interval_ms=300000)
+        params.update(kwargs)
+        return AdaptiveBatchController("consumer-1", **params)
+
+    def test_grows_while_lagging_up_to_max_records(self):
+        controller = self.make_controller()
+        sizes = []
+        for _ in range(5):
+            controller.observe(controller.records, controller.records * 0.001, lag=10000)
+            sizes.append(controller.records)
+
+        self.assertEqual(sizes, [100, 200, 400, 400, 400])
+        self.assertEqual(metrics.BATCH_MAX_RECORDS.value(consumer="consumer-1"), 400)
+
+    def test_shrinks_back_to_min_records_when_caught_up(self):
+        controller = self.make_controller(initial_records=400)
+        sizes = []
+        for _ in range(4):
+            controller.observe(5, 0.005, lag=0)
+            sizes.append(controller.records)
+
+        self.assertEqual(sizes, [200, 100, 50, 25])
+        for _ in range(3):
+            controller.observe(5, 0.005, lag=0)
+        self.assertEqual(controller.records, 10)
+
+    def test_batch_stays_within_the_target_batch_time(self):
+        controller = self.make_controller()
+        # 20 ms per record, 2 seconds hold 100 records
+        controller.observe(50, 1.0, lag=10000)
+        self.assertEqual(controller.records, 100)
+        controller.observe(100, 2.0, lag=10000)
+        self.assertEqual(controller.records, 100)
+
+    def test_batch_stays_within_half_of_max_poll_interval(self):
+        controller = self.make_controller(target_batch_ms=600000, max_poll_interval_ms=10000)
+        # 100 ms per record, half of the 10 seconds poll interval holds 50 records
+        controller.observe(50, 5.0, lag=10000)
+        self.assertEqual(controller.records, 50)
+
+    def test_never_below_min_records(self):
+        controller = self.make_controller()
+        controller.observe(10, 100.0, lag=10000)
+        self.assertEqual(controller.records, 10)
@@ -0,0 +1,356 @@
+import asyncio
+import unittest
+from unittest.mock import AsyncMock, Mock
+from aiokafka import TopicPartition
+from billing_consumer_new.helpers import metrics
+from billing_consumer_new.start_up.billing_consumer import AIOConsumer, AssignmentListener
+from billing_consumer_new.start_up.batch_controller import AdaptiveBatchController
+
+
+class StopConsuming(Exception):
+    pass
+
+
+class FakeKafkaConsumer:
+    """ In-memory stand-in for AIOKafkaConsumer, serves the given polls then stops the consume loop """
+
+    def __init__(self, polls, assignment):
+        self.polls = list(polls)
+        self.assigned = set(assignment)
+        self.paused = set()
+        self.commits = []
+        self.fetched_while_paused = []
+        self.highwaters = {}
+        self.max_records = []
+        self.seeks = []
+        self.stopped = False
+
+    def subscribe(self, topics, listener=None):
+        self.listener = listener
+
+    async def start(self):
+        self.listener.on_partitions_assigned(self.assigned)
+
+    def partitions_for_topic(self, topic):
+        return None
+
+    def assignment(self):
+        return set(self.assigned)
+
+    def pause(self, *partitions):
+        self.paused.update(partitions)
+
+    def resume(self, *partitions):
+        self.paused.difference_update(partitions)
+
+    async def getmany(self, timeout_ms=0, max_records=None):
+        await asyncio.sleep(0)
+        self.max_records.append(max_records)
+        if not self.polls:
+            raise StopConsuming()
+        result = self.polls.pop(0)
+        if result is None:
+            # an idle poll, waits until the loop is cancelled
+            await asyncio.Event().wait()
+        self.fetched_while_paused.extend(tp for tp in result if tp in self.paused)
+        return result
+
+    async def commit(self, offsets):
+        self.commits.append(offsets)
+
+    def highwater(self, tp):
+        return self.highwaters.get(tp)
+
+    def seek(self, tp, offset):
+        self.seeks.append((tp, offset))
+
+    async def stop(self):
+        self.stopped = True
+
+
+def make_records(partition, *offsets):
+    return [Mock(partition=partition, offset=offset) for offset in offsets]
+
+
+class TestAIOConsumer(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.tp0 = TopicPartition("billing", 0)
+        self.tp1 = TopicPartition("billing", 1)
+
+    def make_consumer(self, polls, partition_concurrency, commit_interval_ms=0, max_batch_retries=5):
+        consumer = AIOConsumer("client", "group", partition_concurrency=partition_concurrency,
+                               commit_interval_ms=commit_interval_ms, max_batch_retries=max_batch_retries,
+                               retry_backoff_ms=1, retry_max_backoff_ms=4, security_protocol="PLAINTEXT")
+        consumer.consumer = FakeKafkaConsumer(polls, [self.tp0, self.tp1])
+        return consumer
+
+    async def test_serial_mode(self):
+        consumer = self.make_consumer([{self.tp0: make_records(0, 1, 2), self.tp1: make_records(1, 7)}], 0)
+        handled = []
+
+        async def handler(messages):
+            handled.append(messages[0].partition)
+
+        with self.assertRaises(StopConsuming):
+            await consumer.consume_batch("billing", handler)
+
+        self.assertEqual(handled, [0, 1])
+        # one commit for the partitions of the poll
+        self.assertEqual(consumer.consumer.commits, [{self.tp0: 3, self.tp1: 8}])
+
+    async def test_slow_partition_does_not_block_others(self):
+        release_tp0 = asyncio.Event()
+        polls = [{self.tp0: make_records(0, 1), self.tp1: make_records(1, 7)}, {self.tp1: make_records(1, 8)}]
+        consumer = self.make_consumer(polls, 2)
+
+        async def handler(messages):
+            if messages[0].partition == 0:
+                await release_tp0.wait()
+
+        with self.assertRaises(StopConsuming):
+            await consumer.consume_batch("billing", handler)
+
+        # the loop fetched and committed tp1 twice while tp0 was still in flight
+        await asyncio.sleep(0.01)
+        self.assertEqual(consumer.consumer.commits, [{self.tp1: 8}, {self.tp1: 9}])
+        self.assertIn(self.tp0, consumer.consumer.paused)
+
+        release_tp0.set()
+        await asyncio.gather(*consumer._inflight.values())
+        await asyncio.sleep(0.01)
+        self.assertEqual(consumer.consumer.commits[-1], {self.tp0: 2})
+        self.assertEqual(consumer.consumer.paused, set())
+        self.assertEqual(consumer.consumer.fetched_while_paused, [])
+
+    async def test_concurrency_cap(self):
+        running = []
+        max_running = []
+        polls = [{self.tp0: make_records(0, 1), self.tp1: make_records(1, 7)}]
+        consumer = self.make_consumer(polls, 1)
+
+        async def handler(messages):
+            running.append(messages[0].partition)
+            max_running.append(len(running))
+            await asyncio.sleep(0.01)
+            running.remove(messages[0].partition)
+
+        with self.assertRaises(StopConsuming):
+            await consumer.consume_batch("billing", handler)
+        await asyncio.gather(*consumer._inflight.values())
+        await asyncio.sleep(0.01)
+
+        self.assertEqual(max(max_running), 1)
+        self.assertEqual(consumer.consumer.commits, [{self.tp0: 2}, {self.tp1: 8}])
+
+    async def test_batches_in_flight_share_a_commit(self):
+        consumer = self.make_consumer([{self.tp0: make_records(0, 1), self.tp1: make_records(1, 7)}], 2, commit_interval_ms=50)
+
+        async def handler(messages):
+            await asyncio.sleep(0.01 * messages[0].partition)
+
+        with self.assertRaises(StopConsuming):
+            await consumer.consume_batch("billing", handler)
+        await asyncio.gather(*consumer._inflight.values())
+        self.assertEqual(consumer.consumer.commits, [])
+        await asyncio.sleep(0.1)
+        self.assertEqual(consumer.consumer.commits, [{self.tp0: 2, self.tp1: 8}])
+
+    async def test_revoked_partitions_are_committed_first(self):
+        consumer = self.make_consumer([], 0)
+        consumer.offsets.begin(self.tp0, 1, 3)
+        consumer.offsets.complete(self.tp0, 1)
+        consumer.offsets.begin(self.tp1, 7, 8)
+
+        listener = AssignmentListener(consumer.assigned, consumer.partitions_revoked)
+        await listener.on_partitions_revoked({self.tp0, self.tp1})
+
+        self.assertEqual(consumer.consumer.commits, [{self.tp0: 3}])
+        # the batch of tp1 completes after the revoke, its next owner fetches it again
+        consumer.offsets.complete(self.tp1, 7)
+        self.assertEqual(consumer.offsets.ready(), {})
+
+    async def test_lag_is_reported_per_partition(self):
+        consumer = self.make_consumer([{self.tp0: make_records(0, 1, 2)}, {}], 0)
+        consumer.consumer.highwaters = {self.tp0: 10}
+
+        async def handler(messages):
+            pass
+
+        with self.assertRaises(StopConsuming):
+            await consumer.consume_batch("billing", handler)
+        self.assertEqual(metrics.CONSUMER_LAG.value(topic="billing", partition=0), 7)
+
+        # a revoked partition is no longer reported
+        consumer.consumer.assigned = {self.tp1}
+        consumer.consumer.polls = [{}]
+        with self.assertRaises(StopConsuming):
+            await consumer.consume_batch("billing", handler)
+        self.assertIsNone(metrics.CONSUMER_LAG.value(topic="billing", partition=0))
+
+    async def test_poll_size_follows_the_batch_controller(self):
+        consumer = self.make_consumer([{self.tp0: make_records(0, 1, 2)}, {self.tp0: make_records(0, 3, 4, 5, 6)}], 0)
+        consumer.batch_controller = AdaptiveBatchController("client", initial_records=2, min_records=2, max_records=100)
+        consumer.consumer.highwaters = {self.tp0: 100}
+
+        async def handler(messages):
+            pass
+
+        with self.assertRaises(StopConsuming):
+            await consumer.consume_batch("billing", handler)
+
+        # lagging behind, every batch doubles the next poll
+        self.assertEqual(consumer.consumer.max_records, [2, 4, 8])
+
+    async def test_failed_batch_is_fetched_again(self):
+        consumer = self.make_consumer([{self.tp0: make_records(0, 4, 5)}], 0)
+
+        async def handler(messages):
+            raise RuntimeError("broker unavailable")
+
+        with self.assertRaises(StopConsuming):
+            await consumer.consume_batch("billing", handler)
+
+        self.assertEqual(consumer.consumer.commits, [])
+        self.assertEqual(consumer.consumer.seeks, [(self.tp0, 4)])
+
+    async def test_failed_batch_is_retried_then_committed(self):
+        polls = [{self.tp0: make_records(0, 4, 5)}, {self.tp0: make_records(0, 4, 5)}]
+        consumer = self.make_consumer(polls, 0)
+        attempts = []
+
+        async def handler(messages):
+            attempts.append(messages[0].offset)
+            if len(attempts) == 1:
+                raise RuntimeError("broker unavailable")
+
+        with self.assertRaises(StopConsuming):
+            await consumer.consume_batch("billing", handler)
+
+        self.assertEqual(attempts, [4, 4])
+        self.assertEqual(consumer.consumer.seeks, [(self.tp0, 4)])
+        self.assertEqual(consumer.consumer.commits, [{self.tp0: 6}])
+        self.assertEqual(consumer._attempts, {})
+
+    async def test_failed_batch_is_never_committed_without_dead_letter(self):
+        consumer = self.make_consumer([{self.tp0: make_records(0, 4, 5)}] * 4, 0, max_batch_retries=2)
+
+        async def handler(messages):
+            raise RuntimeError("RDS unavailable")
+
+        with self.assertRaises(StopConsuming):
+            await consumer.consume_batch("billing", handler)
+
+        # retried past the cap, nothing to send the batch to
+        self.assertEqual(consumer.consumer.seeks, [(self.tp0, 4)] * 4)
+        self.assertEqual(consumer.consumer.commits, [])
+
+    async def test_batch_is_committed_once_dead_lettered(self):
+        dead_lettered = metrics.BATCH_RETRIES.value(result="dead_lettered")
+        consumer = self.make_consumer([{self.tp0: make_records(0, 4, 5)}] * 3, 0, max_batch_retries=2)
+        consumer.dead_letter = AsyncMock()
+
+        async def handler(messages):
+            raise RuntimeError("poison batch")
+
+        with self.assertRaises(StopConsuming):
+            await consumer.consume_batch("billing", handler)
+
+        # 2 retries, then the batch is committed after it was produced to the dead-letter topic
+        self.assertEqual(consumer.consumer.seeks, [(self.tp0, 4), (self.tp0, 4)])
+        consumer.dead_letter.assert_awaited_once()
+        self.assertEqual([each.offset for each in consumer.dead_letter.await_args.args[0]], [4, 5])
+        self.assertEqual(consumer.consumer.commits, [{self.tp0: 6}])
+        self.assertEqual(metrics.BATCH_RETRIES.value(result="dead_lettered"), dead_lettered + 1)
+
+    async def test_batch_is_not_committed_when_dead_lettering_fails(self):
+        consumer = self.make_consumer([{self.tp0: make_records(0, 4, 5)}] * 4, 0, max_batch_retries=1)
+        consumer.dead_letter = AsyncMock(side_effect=ConnectionError("broker unavailable"))
+
+        async def handler(messages):
+            raise RuntimeError("poison batch")
+
+        with self.assertRaises(StopConsuming):
+            await consumer.consume_batch("billing", handler)
+
+        self.assertEqual(consumer.dead_letter.await_count, 3)
+        self.assertEqual(consumer.consumer.seeks, [(self.tp0, 4)] * 4)
+        self.assertEqual(consumer.consumer.commits, [])
+
+    async def test_unlimited_retries_by_default(self):
+        consumer = self.make_consumer([{self.tp0: make_records(0, 4, 5)}] * 8, 0, max_batch_retries=0)
+        consumer.dead_letter = AsyncMock()
+
+        async def handler(messages):
+            raise RuntimeError("RDS unavailable")
+
+        with self.assertRaises(StopConsuming):
+            await consumer.consume_batch("billing", handler)
+
+        consumer.dead_letter.assert_not_awaited()
+        self.assertEqual(consumer.consumer.commits, [])
+
+    async def test_backoff_is_capped(self):
+        consumer = self.make_consumer([], 0)
+        self.assertEqual([round(consumer.backoff(attempt) * 1000) for attempt in range(1, 6)], [1, 2, 4, 4, 4])
+
+    async def test_assigned_once_the_group_is_joined(self):
+        consumer = self.make_consumer([], 0)
+        self.assertFalse(consumer.assigned.is_set())
+
+        with self.assertRaises(StopConsuming):
+            await consumer.consume_batch("billing", None)
+
+        self.assertTrue(consumer.assigned.is_set())
+
+    async def test_drain_commits_the_batch_in_flight(self):
+        started = asyncio.Event()
+        release = asyncio.Event()
+        polls = [{self.tp0: make_records(0, 1, 2), self.tp1: make_records(1, 7)}, {self.tp0: make_records(0, 3)}]
+        consumer = self.make_consumer(polls, 0)
+
+        async def handler(messages):
+            started.set()
+            await release.wait()
+
+        loop_task = asyncio.create_task(consumer.consume_batch("billing", handler))
+        await started.wait()
+        drain = asyncio.create_task(consumer.drain(timeout=5))
+        await asyncio.sleep(0)
+        self.assertFalse(drain.done())
+
+        release.set()
+        await drain
+        await asyncio.gather(loop_task, return_exceptions=True)
+
+        # tp0 is committed, tp1 and the next poll are left for the next owner
+        self.assertEqual(consumer.consumer.commits, [{self.tp0: 3}])
+        self.assertEqual(len(consumer.consumer.polls), 1)
+        self.assertTrue(consumer.consumer.stopped)
+
+    async def test_drain_timeout_cancels_the_batch(self):
+        started = asyncio.Event()
+        consumer = self.make_consumer([{self.tp0: make_records(0, 1, 2)}], 2)
+
+        async def handler(messages):
+            started.set()
+            await asyncio.Event().wait()
+
+        loop_task = asyncio.create_task(consumer.consume_batch("billing", handler))
+        await started.wait()
+        await consumer.drain(timeout=0.01)
+        await asyncio.gather(loop_task, return_exceptions=True)
+
+        self.assertEqual(consumer.consumer.commits, [])
+        self.assertEqual(consumer._inflight, {})
+        self.assertTrue(consumer.consumer.stopped)
+
+    async def test_drain_while_polling(self):
+        consumer = self.make_consumer([None], 0)
+        loop_task = asyncio.create_task(consumer.consume_batch("billing", None))
+        await asyncio.sleep(0.01)
+
+        await consumer.drain(timeout=5)
+
+        self.assertTrue(loop_task.done())
+        self.assertTrue(consumer.consumer.stopped)
@@ -0,0 +1,121 @@
+import os
+import json
+import shutil
+import struct
+import tempfile
+import unittest
+from billing_consumer_new.billing_service.billing_handler import BillingFailure
+from billing_consumer_new.start_up.billing_replay import (FORMAT_JSONL, FORMAT_LENGTH_PREFIXED, ReplayCheckpoints, dry_run_handler,
+                                                          plan_units, read_batches, read_length_prefixed, replay_unit)
+
+
+def make_value(idx: int) -> bytes:
+    return json.dumps({"transaction_id": f"10232024095207EPUJQ{idx:04d}", "padding": "x" * (idx % 7)}).encode("utf-8")
+
+
+class StopReplay(Exception):
+    pass
+
+
+class TestBillingReplay(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.values = [make_value(idx) for idx in range(40)]
+        self.jsonl_path = os.path.join(self.directory, "dump.jsonl")
+        with open(self.jsonl_path, "wb") as f:
+            # blank lines are skipped
+            f.write(b"\n".join(self.values[:20]) + b"\n\n" + b"\n".join(self.values[20:]) + b"\n")
+        self.lp_path = os.path.join(self.directory, "dump.lp")
+        with open(self.lp_path, "wb") as f:
+            for each in self.values:
+                f.write(struct.pack(">I", len(each)) + each)
+        self.checkpoints = ReplayCheckpoints(os.path.join(self.directory, "checkpoints"))
+
+    async def asyncTearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read_units(self, units):
+        return [record.value for unit in units for records, _ in read_batches(unit, 7) for record in records]
+
+    def test_jsonl_units_cover_every_line_once(self):
+        size = os.path.getsize(self.jsonl_path)
+        for chunk_bytes in (1, 13, 64, 100, size, size * 2):
+            units = plan_units([self.jsonl_path], FORMAT_JSONL, chunk_bytes)
+            self.assertEqual(units[-1].end, size)
+            self.assertEqual(self.read_units(units), self.values, chunk_bytes)
+
+    def test_length_prefixed(self):
+        units = plan_units([self.lp_path], FORMAT_LENGTH_PREFIXED, 13)
+        self.assertEqual(len(units), 1)
+        self.assertEqual(self.read_units(units), self.values)
+
+        with open(self.lp_path, "ab") as f:
+            f.write(struct.pack(">I", 100) + b"{}")
+        with self.assertRaises(ValueError):
+            self.read_units(plan_units([self.lp_path], FORMAT_LENGTH_PREFIXED, 0))
+
+    def test_resume_offset_is_a_record_start(self):
+        unit = plan_units([self.lp_path], FORMAT_LENGTH_PREFIXED, 0)[0]
+        batches = list(read_batches(unit, 15))
+        _, offset = batches[0]
+        self.assertEqual([record.value for record, _ in read_length_prefixed(unit, offset)], self.values[15:])
+
+    async def test_replay_resumes_from_the_checkpoint(self):
+        units = plan_units([self.jsonl_path], FORMAT_JSONL, 200)
+        handled = []
+        progress = []
+
+        async def handler(messages):
+            if len(handled) >= 25:
+                raise StopReplay()
+            handled.extend(each.value for each in messages)
+            return [BillingFailure(each, "write", "rejected", True) for each in messages if each.value == self.values[3]]
+
+        with self.assertRaises(StopReplay):
+            for unit in units:
+                await replay_unit(unit, handler, self.checkpoints, 5, lambda *args: progress.append(args))
+
+        # a new run goes on after the last written batch
+        handled_before = len(handled)
+        handled.clear()
+        for unit in units:
+            await replay_unit(unit, lambda messages: self.collect(handled, messages), self.checkpoints, 5,
+                              lambda *args: progress.append(args))
+        self.assertEqual(len(handled) + handled_before, len(self.values))
+        self.assertEqual(handled, self.values[handled_before:])
+
+        # the checkpoints count the records and failures of both runs
+        checkpoints = [self.checkpoints.load(unit) for unit in units]
+        self.assertEqual(sum(each["records"] for each in checkpoints), len(self.values))
+        self.assertEqual(sum(each["failures"] for each in checkpoints), 1)
+        with open(os.path.join(self.checkpoints.directory, units[0].name + ".failed.lp"), "rb") as f:
+            self.assertEqual(f.read(), struct.pack(">I", len(self.values[3])) + self.values[3])
+
+        # a completed unit is skipped
+        handled.clear()
+        await replay_unit(units[0], lambda messages: self.collect(handled, messages), self.checkpoints, 5)
+        self.assertEqual(handled, [])
+
+    async def collect(self, handled, messages):
+        handled.extend(each.value for each in messages)
+        return []
+
+    async def test_progress_covers_the_dumps(self):
+        units = plan_units([self.jsonl_path], FORMAT_JSONL, 100)
+        progress = []
+
+        for unit in units:
+            await replay_unit(unit, lambda messages: self.collect([], messages), self.checkpoints, 5,
+                              lambda *args: progress.append(args))
+
+        self.assertEqual(sum(records for records, _, _ in progress), len(self.values))
+        self.assertEqual(sum(size for _, _, size in progress), os.path.getsize(self.jsonl_path))
+
+    async def test_dry_run_reports_the_invalid_messages(self):
+        unit = plan_units([self.lp_path], FORMAT_LENGTH_PREFIXED, 0)[0]
+        records, _ = next(read_batches(unit, 3))
+
+        failures = await dry_run_handler(records)
+
+        self.assertEqual([each.stage for each in failures], ["decode"] * 3)
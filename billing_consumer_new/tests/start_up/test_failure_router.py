@@ -0,0 +1,119 @@
+import asyncio
+import unittest
+from unittest.mock import Mock, patch
+from billing_consumer_new.helpers import app_config
+from billing_consumer_new.billing_service.billing_handler import BillingFailure
+from billing_consumer_new.start_up.billing_consumer import BillingConsumer
+from billing_consumer_new.start_up.failure_router import BillingFailureRouter, get_header, retry_at
+
+
+class FakeProducer:
+    def __init__(self, fail=False):
+        self.sent = []
+        self.fail = fail
+
+    async def send(self, topic, value=None, key=None, headers=None):
+        self.sent.append((topic, value, key, {name: header.decode("utf-8") for name, header in headers}))
+        delivery = asyncio.get_running_loop().create_future()
+        if self.fail:
+            delivery.set_exception(RuntimeError("broker unavailable"))
+        else:
+            delivery.set_result(None)
+        return delivery
+
+
+def make_record(offset=5, headers=()):
+    return Mock(topic="refactored_billing", partition=2, offset=offset, key=b"key", value=b"{}", headers=list(headers))
+
+
+class TestBillingFailureRouter(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.producer = FakeProducer()
+        self.router = BillingFailureRouter(self.producer, retry_topic="billing_retry", dlq_topic="billing_dlq",
+                                           max_attempts=3, retry_delay_ms=60000)
+
+    async def test_retryable_failure_goes_to_the_retry_topic(self):
+        with patch("billing_consumer_new.start_up.failure_router.time.time", return_value=1000.0):
+            await self.router.route([BillingFailure(make_record(), "encrypt", "cipher unavailable", True)])
+
+        topic, value, key, headers = self.producer.sent[0]
+        self.assertEqual((topic, value, key), ("billing_retry", b"{}", b"key"))
+        self.assertEqual(headers["billing-attempts"], "1")
+        self.assertEqual(headers["billing-failed-stage"], "encrypt")
+        self.assertEqual(headers["billing-error"], "cipher unavailable")
+        self.assertEqual(headers["billing-retry-at"], "1060000")
+        self.assertEqual((headers["billing-original-topic"], headers["billing-original-partition"], headers["billing-original-offset"]),
+                         ("refactored_billing", "2", "5"))
+
+    async def test_last_attempt_goes_to_the_dead_letter_topic(self):
+        record = make_record(offset=40, headers=[("billing-attempts", b"2"), ("billing-original-offset", b"5")])
+
+        await self.router.route([BillingFailure(record, "write", "rejected by RDS", True)])
+
+        topic, _, _, headers = self.producer.sent[0]
+        self.assertEqual(topic, "billing_dlq")
+        self.assertEqual(headers["billing-attempts"], "3")
+        self.assertEqual(headers["billing-original-offset"], "5")
+        self.assertNotIn("billing-retry-at", headers)
+
+    async def test_non_retryable_failure_goes_to_the_dead_letter_topic(self):
+        await self.router.route([BillingFailure(make_record(), "decode", "subcode: Input should be a valid string", False)])
+
+        self.assertEqual(self.producer.sent[0][0], "billing_dlq")
+
+    async def test_failed_delivery_is_raised(self):
+        self.router.producer = FakeProducer(fail=True)
+
+        with self.assertRaises(RuntimeError):
+            await self.router.route([BillingFailure(make_record(), "encrypt", "cipher unavailable", True)])
+
+    def test_headers(self):
+        record = make_record(headers=[("billing-retry-at", b"1060000")])
+
+        self.assertEqual(retry_at(record), 1060.0)
+        self.assertEqual(retry_at(make_record()), 0)
+        self.assertIsNone(get_header(make_record(), "billing-attempts"))
+
+
+class TestBillingConsumerFailures(unittest.IsolatedAsyncioTestCase):
+
+    def make_consumer(self, **kwargs):
+        with patch("billing_consumer_new.start_up.billing_consumer.AIOConsumer"):
+            return BillingConsumer(crypto_util=Mock(), mysql_instance=Mock(), **kwargs)
+
+    async def test_handler_failures_are_routed(self):
+        router = Mock()
+        router.route = unittest.mock.AsyncMock()
+        consumer = self.make_consumer(failure_router=router)
+        failure = BillingFailure(make_record(), "encrypt", "cipher unavailable", True)
+
+        with patch("billing_consumer_new.start_up.billing_consumer.billing_handler", unittest.mock.AsyncMock(return_value=[failure])):
+            await consumer.batch_handler([failure.message])
+
+        router.route.assert_awaited_once_with([failure])
+
+    async def test_pipeline_error_routes_the_whole_batch(self):
+        router = Mock()
+        router.route = unittest.mock.AsyncMock()
+        pipeline = Mock()
+        pipeline.process_batch = unittest.mock.AsyncMock(side_effect=RuntimeError("RDS unavailable"))
+        consumer = self.make_consumer(failure_router=router, pipeline=pipeline)
+        records = [make_record(5), make_record(6)]
+
+        await consumer.batch_handler(records)
+
+        failures = router.route.await_args.args[0]
+        self.assertEqual([each.message for each in failures], records)
+        self.assertTrue(all(each.retryable and each.stage == "pipeline" for each in failures))
+
+    async def test_retry_consumer_waits_for_the_retry_at(self):
+        consumer = self.make_consumer(retry=True)
+        self.assertEqual(consumer.msk_topic, app_config.BILLING_RETRY_TOPIC)
+        record = make_record(headers=[("billing-retry-at", b"1030000")])
+
+        with patch("billing_consumer_new.start_up.billing_consumer.time.time", return_value=1000.0), \
+                patch("billing_consumer_new.start_up.billing_consumer.asyncio.sleep", unittest.mock.AsyncMock()) as sleep:
+            await consumer.wait_for_retry([record])
+
+        sleep.assert_awaited_once_with(30.0)
@@ -0,0 +1,60 @@
+import unittest
+from aiokafka import TopicPartition
+from billing_consumer_new.start_up.offset_tracker import OffsetTracker
+
+
+class TestOffsetTracker(unittest.TestCase):
+
+    def setUp(self):
+        self.tp0 = TopicPartition("billing", 0)
+        self.tp1 = TopicPartition("billing", 1)
+        self.tracker = OffsetTracker()
+
+    def test_offsets_are_contiguous_per_partition(self):
+        self.tracker.begin(self.tp0, 1, 3)
+        self.tracker.begin(self.tp0, 3, 6)
+        self.tracker.begin(self.tp1, 7, 8)
+
+        # the second batch of tp0 is held back by the first one
+        self.tracker.complete(self.tp0, 3)
+        self.tracker.complete(self.tp1, 7)
+        self.assertEqual(self.tracker.ready(), {self.tp1: 8})
+
+        self.tracker.complete(self.tp0, 1)
+        self.assertEqual(self.tracker.ready(), {self.tp0: 6, self.tp1: 8})
+        self.assertEqual(self.tracker.ready({self.tp1}), {self.tp1: 8})
+
+    def test_committed(self):
+        self.tracker.begin(self.tp0, 1, 3)
+        self.tracker.begin(self.tp0, 3, 4)
+        self.tracker.complete(self.tp0, 1)
+        offsets = self.tracker.ready()
+
+        # completed while the commit was sent
+        self.tracker.complete(self.tp0, 3)
+        self.tracker.committed(offsets)
+        self.assertEqual(self.tracker.ready(), {self.tp0: 4})
+
+        self.tracker.committed(self.tracker.ready())
+        self.assertEqual(self.tracker.ready(), {})
+
+    def test_failed_batch_holds_nothing_back(self):
+        self.tracker.begin(self.tp0, 1, 3)
+        self.tracker.complete(self.tp0, 1)
+        self.tracker.begin(self.tp0, 3, 5)
+        self.tracker.fail(self.tp0, 3)
+
+        # fetched again from the failed offset
+        self.tracker.begin(self.tp0, 3, 5)
+        self.tracker.complete(self.tp0, 3)
+        self.assertEqual(self.tracker.ready(), {self.tp0: 5})
+
+    def test_revoke(self):
+        self.tracker.begin(self.tp0, 1, 3)
+        self.tracker.begin(self.tp1, 7, 8)
+        self.tracker.complete(self.tp0, 1)
+
+        self.tracker.revoke({self.tp0, self.tp1})
+        self.tracker.complete(self.tp1, 7)
+
+        self.assertEqual(self.tracker.ready(), {})
@@ -0,0 +1,66 @@
+import os
+import time
+import unittest
+from unittest.mock import patch
+from billing_consumer_new.start_up.supervisor import ProcessSupervisor
+
+
+def exit_now():
+    os._exit(3)
+
+
+def sleep_long():
+    time.sleep(60)
+
+
+class TestProcessSupervisor(unittest.TestCase):
+
+    def setUp(self):
+        self.supervisor = ProcessSupervisor(min_uptime=30, max_backoff=4)
+
+    def tearDown(self):
+        self.supervisor.stop(timeout=5)
+
+    def start(self):
+        for child in self.supervisor.children:
+            self.supervisor.start_child(child)
+
+    def test_only_the_dead_child_is_restarted(self):
+        self.supervisor.add("crashing", exit_now)
+        self.supervisor.add("healthy", sleep_long)
+        self.start()
+        crashing, healthy = self.supervisor.children
+        healthy_pid = healthy.process.pid
+        crashing.process.join()
+
+        # died right after its start, restarted after a 1 second backoff
+        self.supervisor.check_children(timeout=0.5)
+        self.assertIsNotNone(crashing.restart_at)
+        self.assertEqual(crashing.restarts, 0)
+        self.supervisor.check_children(timeout=2)
+        self.assertEqual(crashing.restarts, 1)
+        self.assertEqual(healthy.process.pid, healthy_pid)
+        self.assertTrue(healthy.process.is_alive())
+
+    def test_backoff_doubles_for_a_crash_loop(self):
+        self.supervisor.add("crashing", exit_now)
+        self.start()
+        child = self.supervisor.children[0]
+        backoffs = []
+        for _ in range(4):
+            child.process.join()
+            with patch("billing_consumer_new.start_up.supervisor.time.monotonic", return_value=child.started_at + 0.1):
+                with patch("billing_consumer_new.start_up.supervisor.time.sleep"):
+                    self.supervisor.check_children(timeout=0)
+            backoffs.append(round(child.restart_at - child.started_at - 0.1, 3))
+            self.supervisor.start_child(child)
+
+        self.assertEqual(backoffs, [1, 2, 4, 4])
+
+    def test_stop_terminates_the_children(self):
+        self.supervisor.add("healthy", sleep_long)
+        self.start()
+
+        self.supervisor.stop(timeout=5)
+
+        self.assertFalse(self.supervisor.children[0].process.is_alive())
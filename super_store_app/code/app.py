@@ -5,7 +5,6 @@ import os
 import sys
 import time
 import uuid
-from multiprocessing import Process
 
 import api.app_global as app_global
 import common.app_config as app_config
@@ -13,6 +12,7 @@ from aiohttp import web
 from batch_consumer.superstore_consumer import SuperStoreConsumer
 from common.aio_utils import async_cputhread, async_logger, time_decorators
 from common.aio_utils.boto3_sessions import AIOBoto3Session
+from common.aio_utils.supervisor import ProcessSupervisor
 from common.kafka_util import get_kafka_params
 
 
@@ -47,12 +47,12 @@ def initialize_logger():
     # log_format = "%(asctime)s - %(name)s - %(process)d - %(levelname)s - %(message)s"
     log_format = "%(message)s"
     logging.basicConfig(stream=sys.stdout, format=log_format, level=logging.ERROR)
-    async_logger.setup_logging_queue()
+    return async_logger.setup_logging_queue()
 
 
 async def startup_tasks(app: web.Application) -> None:
     # start consumers
-    consumers = []
+    consumers = app["consumers"]
     loop = asyncio.get_running_loop()
     await AIOBoto3Session.instance().start()
     num_consumers = min(
@@ -65,10 +65,14 @@ async def startup_tasks(app: web.Application) -> None:
             name=f"SUPERSTORE-{os.getpid()}-{_consumer}-{uuid.uuid4().hex}"
         )
         consumers.append(consumer)
-        loop.create_task(consumer.run())
+        app["consumer_tasks"].append(loop.create_task(consumer.run()))
 
 
 async def shutdown_tasks(app: web.Application) -> None:
+    # the batches in flight are uploaded and committed before the S3 session closes
+    await asyncio.gather(*[consumer.msk_consumer.drain() for consumer in app["consumers"]], return_exceptions=True)
+    for task in app["consumer_tasks"]:
+        task.cancel()
     await AIOBoto3Session.instance().stop()
 
 
@@ -78,14 +82,21 @@ async def main():
     app.on_startup.append(startup_tasks)
     app.on_shutdown.append(shutdown_tasks)
     app["executor"] = async_cputhread.executor_pool
+    app["consumers"] = []
+    app["consumer_tasks"] = []
 
     port = int(os.getenv("SUPER_STORE_CONSUMER_PORT", 7000))
-    await web._run_app(app, port=port, backlog=32, reuse_port=True)
+    # SIGTERM runs the shutdown tasks, the consumers drain before the process exits
+    await web._run_app(app, port=port, backlog=32, reuse_port=True, handle_signals=True)
 
 
 def start():
-    # initialize_logger()
-    asyncio.run(main())
+    log_listener = initialize_logger()
+    try:
+        asyncio.run(main())
+    finally:
+        # flushes the records of the shutdown
+        log_listener.stop()
 
 
 def run():
@@ -97,15 +108,11 @@ def run():
         num_processes = int(os.getenv("ECS_SNAPSHOT_CONSUMER_NUM_PROCESSES", cpu_count))
     if num_processes > 3:
         num_processes = num_processes - 1
-    processes = []
-    for _ in range(num_processes):
-        p = Process(target=start)
-        p.start()
-        processes.append(p)
-
-    for p in processes:
-        p.join()
-    run()
+    # restarts the process that died, forwards SIGTERM so the consumers drain on a deploy
+    supervisor = ProcessSupervisor()
+    for idx in range(num_processes):
+        supervisor.add(f"superstore-consumer-{idx}", start)
+    supervisor.run()
 
 
 if __name__ == "__main__":
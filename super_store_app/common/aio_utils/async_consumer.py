@@ -1,7 +1,23 @@
+import asyncio
 import traceback
-from aiokafka import AIOKafkaConsumer, TopicPartition, OffsetAndMetadata
+from aiokafka import AIOKafkaConsumer, ConsumerRebalanceListener, TopicPartition, OffsetAndMetadata
 from aiokafka.helpers import create_ssl_context
 import common.kafka_util as constants
+from common.aio_utils.offset_tracker import OffsetTracker
+
+
+class RevokeListener(ConsumerRebalanceListener):
+    """Calls on_revoked with the revoked partitions before they are reassigned"""
+
+    def __init__(self, on_revoked):
+        self.on_revoked = on_revoked
+
+    async def on_partitions_revoked(self, revoked):
+        await self.on_revoked(revoked)
+
+    def on_partitions_assigned(self, assigned):
+        pass
+
 
 class AIOConsumer():
 
@@ -13,6 +29,11 @@ class AIOConsumer():
         self.client_id = unique_client_id
         self.group_id = unique_group_id
         self.log = log
+        self.stopping = False
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._loop_task = None
+        self.offsets = OffsetTracker()
         protocol = kwargs.pop("security_protocol", "SSL")
         offset_reset = kwargs.pop("auto_offset_reset", "earliest")
         if protocol == "SSL":
@@ -72,6 +93,9 @@ class AIOConsumer():
             # headers=[], checksum=None, serialized_key_size=13, serialized_value_size=44,
             # key=b'tB_1619202704',
             # value=b'{"msg": {"id": 46}, "body": "tB_1619202704"}')
+            if self.stopping:
+                # the partitions not started yet are fetched again by their next owner
+                break
             try:
                 await handler(message)
                 await self.consumer.commit()# does not work with zookeeper
@@ -90,29 +114,84 @@ class AIOConsumer():
             blocking execution.
         """
         # Need to check if, what partition configuration here
-        self.consumer.subscribe([topic])
+        self.consumer.subscribe([topic], listener=RevokeListener(self.partitions_revoked))
         self.log.info("[S] %s/%s starts consuming from topic: %s", self.group_id, self.client_id, topic)
         # self.log.info("[S] bootstrap_connected %s", self.consumer.bootstrap_connected())
         partitions = self.consumer.partitions_for_topic(topic)
         self.log.info("[S] partitions_for_topic %s", partitions)
 
+        self._loop_task = asyncio.current_task()
         await self.consumer.start()
 
-        while True:
+        while not self.stopping:
             # Now, this consumer picks up message at the right position
             result = await self.consumer.getmany(timeout_ms=10 * 1000)
-            for tp, messages in result.items():
-                # message is an instance of ConsumerRecord(topic='test', partition=0, offset=50,
-                # timestamp=1619202704246, timestamp_type=0, serialized_header_size=-1,
-                # headers=[], checksum=None, serialized_key_size=13, serialized_value_size=44,
-                # key=b'tB_1619202704',
-                # value=b'{"msg": {"id": 46}, "body": "tB_1619202704"}')
-                try:
-                    if messages:
-                        await handler(messages)
-                        await self.consumer.commit({tp: messages[-1].offset + 1})
-                        self.log.info("[S] %s/%s consumed (partition %s offset %s) messages length: %s", self.group_id,
-                                      self.client_id, tp, messages[-1].offset, len(messages))
-                except Exception as err:
-                    self.log.error("[S] %s", err)
-                    self.log.error("[S] %s", traceback.format_exc())
+            if self.stopping:
+                # fetched after the drain started, left uncommitted for the next owner of the partitions
+                break
+            self._idle.clear()
+            try:
+                await self.process_result(result, handler)
+            finally:
+                self._idle.set()
+
+    async def process_result(self, result, handler):
+        """Processes the partition batches of a poll and commits their offsets in a single call"""
+        for tp, messages in result.items():
+            # message is an instance of ConsumerRecord(topic='test', partition=0, offset=50,
+            # timestamp=1619202704246, timestamp_type=0, serialized_header_size=-1,
+            # headers=[], checksum=None, serialized_key_size=13, serialized_value_size=44,
+            # key=b'tB_1619202704',
+            # value=b'{"msg": {"id": 46}, "body": "tB_1619202704"}')
+            if self.stopping:
+                # the partitions not started yet are fetched again by their next owner
+                break
+            if not messages:
+                continue
+            self.offsets.begin(tp, messages[0].offset, messages[-1].offset + 1)
+            try:
+                await handler(messages)
+                self.log.info("[S] %s/%s consumed (partition %s offset %s) messages length: %s", self.group_id,
+                              self.client_id, tp, messages[-1].offset, len(messages))
+            except Exception as err:
+                self.log.error("[S] %s", err)
+                self.log.error("[S] %s", traceback.format_exc())
+            # a failed batch is not fetched again, the next batches of its partition are committed past it
+            self.offsets.complete(tp, messages[0].offset)
+        await self.commit_offsets()
+
+    async def commit_offsets(self):
+        """Commits the ready offsets of every assigned partition in a single call"""
+        offsets = self.offsets.ready(self.consumer.assignment())
+        if not offsets:
+            return
+        try:
+            await self.consumer.commit(offsets)
+            self.offsets.committed(offsets)
+        except Exception as err:
+            # the offsets stay ready, the next commit sends them again
+            self.log.error("[S] %s/%s commit of %s failed: %s", self.group_id, self.client_id, offsets, err)
+
+    async def partitions_revoked(self, revoked):
+        """The completed batches of the revoked partitions are committed before their next owner fetches them"""
+        await self.commit_offsets()
+        self.offsets.revoke(revoked)
+
+    async def drain(self, timeout=constants.DRAIN_TIMEOUT_MS / 1000):
+        """Stop fetching, wait up to timeout for the batch in flight to be committed,
+        then stop the consumer so it leaves the group and its partitions are reassigned at once.
+        """
+        self.stopping = True
+        if not self._idle.is_set():
+            try:
+                await asyncio.wait_for(self._idle.wait(), timeout)
+            except asyncio.TimeoutError:
+                self.log.warning("[S] %s/%s drain timed out with a batch in flight", self.group_id, self.client_id)
+        if self._loop_task is not None and not self._loop_task.done():
+            # the loop is waiting on its poll, or on a batch that timed out
+            self._loop_task.cancel()
+            await asyncio.gather(self._loop_task, return_exceptions=True)
+        # the batches completed before a timeout
+        await self.commit_offsets()
+        await self.consumer.stop()
+        self.log.info("[S] %s/%s drained and stopped", self.group_id, self.client_id)
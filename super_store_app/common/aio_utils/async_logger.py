@@ -20,12 +20,12 @@ class LocalQueueHandler(logging.handlers.QueueHandler):
         except Exception:
             self.handleError(record)
 
-def setup_logging_queue() -> None:
+def setup_logging_queue() -> logging.handlers.QueueListener:
     """Move log handlers to a separate thread.
 
     Replace handlers on the root logger with a LocalQueueHandler,
     and start a logging.QueueListener holding the original
-    handlers.
+    handlers. Stopping the returned listener flushes the queue.
 
     """
     queue = Queue()
@@ -44,3 +44,4 @@ def setup_logging_queue() -> None:
         queue, *handlers, respect_handler_level=True
     )
     listener.start()
+    return listener
@@ -0,0 +1,57 @@
+""" This module contains the bookkeeping of the offsets that can be committed per partition """
+
+from collections import deque
+
+
+class OffsetTracker:
+    """
+    Tracks the partition batches from their fetch to their completion, in fetch order per partition.
+    The offset of a partition is ready to commit once every batch fetched before it completed,
+    a batch still running holds back the offsets of the batches fetched after it.
+    ready() returns the offsets of all the partitions, so they are committed in a single call
+    """
+
+    def __init__(self):
+        # tp -> [first offset, next offset, completed] per batch not committable yet
+        self._batches = {}
+        # tp -> next offset to commit
+        self._ready = {}
+
+    def begin(self, tp, first_offset: int, next_offset: int):
+        self._batches.setdefault(tp, deque()).append([first_offset, next_offset, False])
+
+    def complete(self, tp, first_offset: int):
+        """ the batch starting at first_offset is processed, a batch of a revoked partition is ignored """
+        batches = self._batches.get(tp)
+        if not batches:
+            return
+        for batch in batches:
+            if batch[0] == first_offset:
+                batch[2] = True
+                break
+        while batches and batches[0][2]:
+            self._ready[tp] = batches.popleft()[1]
+
+    def fail(self, tp, first_offset: int):
+        """ the partition is fetched again from first_offset, the batches from there on are dropped """
+        batches = self._batches.get(tp)
+        if batches:
+            self._batches[tp] = deque(batch for batch in batches if batch[0] < first_offset)
+
+    def revoke(self, partitions):
+        """ the partitions moved to another consumer, their next owner starts from the committed offsets """
+        for tp in partitions:
+            self._batches.pop(tp, None)
+            self._ready.pop(tp, None)
+
+    def ready(self, partitions=None) -> dict:
+        """ tp -> offset to commit, of the given partitions only when given """
+        if partitions is None:
+            return dict(self._ready)
+        return {tp: offset for tp, offset in self._ready.items() if tp in partitions}
+
+    def committed(self, offsets: dict):
+        """ forgets the committed offsets, a partition that completed another batch meanwhile stays ready """
+        for tp, offset in offsets.items():
+            if self._ready.get(tp) == offset:
+                del self._ready[tp]
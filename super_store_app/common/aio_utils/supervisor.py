@@ -0,0 +1,121 @@
+"""Supervisor of the superstore consumer processes, it runs as PID 1 of the container
+"""
+import time
+import signal
+import logging
+from multiprocessing import Process
+from multiprocessing.connection import wait
+import common.app_config as app_config
+
+log = logging.getLogger("superstore")
+
+
+def run_child(target, args: tuple):
+    """the forked child gets the default signal handlers back, terminate() must stop it"""
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    target(*args)
+
+
+class ChildProcess:
+    """a supervised process and its restart history"""
+
+    def __init__(self, name: str, target, args: tuple):
+        self.name = name
+        self.target = target
+        self.args = args
+        self.process = None
+        self.started_at = 0.0
+        self.restarts = 0
+        self.quick_failures = 0
+        self.restart_at = None
+
+
+class ProcessSupervisor:
+    """Starts the child processes and restarts only the ones that died, the others keep running.
+    A child that dies within min_uptime seconds of its start is restarted after a backoff
+    doubling up to max_backoff seconds, so a crash loop does not spin.
+    SIGTERM and SIGINT are forwarded to the children as SIGTERM, they drain their consumers and exit,
+    nothing is restarted once the stop has begun
+    """
+
+    def __init__(self, min_uptime: float = app_config.SUPERVISOR_MIN_UPTIME_SECONDS,
+                 max_backoff: float = app_config.SUPERVISOR_MAX_BACKOFF_SECONDS):
+        self.min_uptime = min_uptime
+        self.max_backoff = max_backoff
+        self.children = []
+        self.stopping = False
+
+    def add(self, name: str, target, *args):
+        self.children.append(ChildProcess(name, target, args))
+
+    def start_child(self, child: ChildProcess):
+        child.process = Process(target=run_child, args=(child.target, child.args), name=child.name)
+        child.process.start()
+        child.started_at = time.monotonic()
+        child.restart_at = None
+        log.info("Started %s (pid %s)", child.name, child.process.pid)
+
+    def run(self, stop_timeout: float = app_config.SUPERVISOR_STOP_TIMEOUT_SECONDS):
+        """supervises the children until SIGTERM or SIGINT, then stops them"""
+        signal.signal(signal.SIGTERM, self._request_stop)
+        signal.signal(signal.SIGINT, self._request_stop)
+        for child in self.children:
+            self.start_child(child)
+        try:
+            while not self.stopping:
+                self.check_children(timeout=1.0)
+        finally:
+            self.stop(stop_timeout)
+
+    def check_children(self, timeout: float):
+        """waits up to timeout for a child to exit, schedules the restart of the dead ones and starts the due ones"""
+        alive = [child.process.sentinel for child in self.children if child.process is not None and child.process.is_alive()]
+        pending = [child.restart_at for child in self.children if child.restart_at is not None]
+        if pending:
+            timeout = min(timeout, max(min(pending) - time.monotonic(), 0))
+        if alive:
+            wait(alive, timeout)
+        else:
+            time.sleep(timeout)
+        now = time.monotonic()
+        for child in self.children:
+            if self.stopping:
+                # the signal arrived while waiting, the children exit on their own
+                return
+            if child.process is None or child.process.is_alive():
+                continue
+            if child.restart_at is None:
+                uptime = now - child.started_at
+                if uptime < self.min_uptime:
+                    child.quick_failures += 1
+                    backoff = min(2 ** (child.quick_failures - 1), self.max_backoff)
+                else:
+                    child.quick_failures = 0
+                    backoff = 0
+                child.restart_at = now + backoff
+                log.error("%s (pid %s) exited with code %s after %.1fs, restarting in %ss", child.name,
+                          child.process.pid, child.process.exitcode, uptime, backoff)
+            if now >= child.restart_at:
+                child.process.close()
+                child.restarts += 1
+                self.start_child(child)
+
+    def stop(self, timeout: float = app_config.SUPERVISOR_STOP_TIMEOUT_SECONDS):
+        """terminates the children, they drain within timeout, the ones still running after it are killed"""
+        self.stopping = True
+        for child in self.children:
+            if child.process is not None and child.process.is_alive():
+                child.process.terminate()
+        deadline = time.monotonic() + timeout
+        for child in self.children:
+            if child.process is None:
+                continue
+            child.process.join(max(deadline - time.monotonic(), 0))
+            if child.process.is_alive():
+                log.error("%s (pid %s) did not stop within %ss, killing it", child.name, child.process.pid, timeout)
+                child.process.kill()
+                child.process.join()
+
+    def _request_stop(self, signum, frame):
+        self.stopping = True
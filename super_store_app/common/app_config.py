@@ -25,3 +25,9 @@ PRIVATE_KEY_S3_PATH = os.getenv("PRIVATE_KEY_S3_PATH", "certs/dev_go_private_key
 CACERT_FILE_NAME = os.getenv("CACERT_FILE_NAME", "dev_go_acm_cacert.pem")
 PUBLIC_CERT_FILE_NAME = os.getenv("PUBLIC_CERT_FILE_NAME", "dev_go_public_cert.pem")
 PRIVATE_KEY_FILE_NAME = os.getenv("PRIVATE_KEY_FILE_NAME", "dev_go_private_key.pem")
+
+# Supervisor of the consumer processes, a child dying within the min uptime is restarted with a doubling backoff
+SUPERVISOR_MIN_UPTIME_SECONDS = int(os.getenv("SUPERVISOR_MIN_UPTIME_SECONDS", "30"))
+SUPERVISOR_MAX_BACKOFF_SECONDS = int(os.getenv("SUPERVISOR_MAX_BACKOFF_SECONDS", "60"))
+# time given to the children to drain after SIGTERM, above DRAIN_TIMEOUT_MS and below the stop timeout of the container
+SUPERVISOR_STOP_TIMEOUT_SECONDS = int(os.getenv("SUPERVISOR_STOP_TIMEOUT_SECONDS", "25"))
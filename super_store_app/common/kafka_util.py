@@ -24,6 +24,8 @@ COMSUMER_POLL_TIMEOUT = int(os.getenv("COMSUMER_POLL_TIMEOUT", "10"))
 MAX_POLL_INTERVAL_MS = int(os.getenv("MAX_POLL_INTERVAL_MS", "300000"))
 SESSION_TIMEOUT_MS = int(os.getenv("SESSION_TIMEOUT_MS", "10000"))
 HEARTBEAT_INTERVAL_MS = int(os.getenv("HEARTBEAT_INTERVAL_MS", "3000"))
+# time given to the batch in flight to be committed on shutdown
+DRAIN_TIMEOUT_MS = int(os.getenv("DRAIN_TIMEOUT_MS", "20000"))
 
 DEFAULT_REGION = os.getenv("DEFAULT_REGION", "us-east-1")
 # DEFAULT_ROLE = os.getenv("DEFAULT_ROLE", "arn:aws:iam::994075455914:role/dev-batch-execution-task-execution-role")       
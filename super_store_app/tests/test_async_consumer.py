@@ -0,0 +1,169 @@
+import asyncio
+import logging
+import unittest
+from unittest.mock import Mock
+from aiokafka import TopicPartition
+from common.aio_utils.async_consumer import AIOConsumer
+
+
+class StopConsuming(Exception):
+    pass
+
+
+class FakeKafkaConsumer:
+    """ In-memory stand-in for AIOKafkaConsumer, serves the given polls then stops the consume loop """
+
+    def __init__(self, polls, assignment):
+        self.polls = list(polls)
+        self.assigned = set(assignment)
+        self.commits = []
+        self.failing_commits = 0
+        self.stopped = False
+        self.listener = None
+
+    def subscribe(self, topics, listener=None):
+        self.listener = listener
+
+    async def start(self):
+        pass
+
+    def partitions_for_topic(self, topic):
+        return None
+
+    def assignment(self):
+        return set(self.assigned)
+
+    async def getmany(self, timeout_ms=0):
+        await asyncio.sleep(0)
+        if not self.polls:
+            raise StopConsuming()
+        result = self.polls.pop(0)
+        if result is None:
+            # an idle poll, waits until the loop is cancelled
+            await asyncio.Event().wait()
+        return result
+
+    async def commit(self, offsets):
+        if self.failing_commits:
+            self.failing_commits -= 1
+            raise ConnectionError("coordinator not available")
+        self.commits.append(offsets)
+
+    async def stop(self):
+        self.stopped = True
+
+
+def make_records(partition, *offsets):
+    return [Mock(partition=partition, offset=offset) for offset in offsets]
+
+
+class TestAIOConsumer(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.tp0 = TopicPartition("reporting", 0)
+        self.tp1 = TopicPartition("reporting", 1)
+
+    def make_consumer(self, polls):
+        consumer = AIOConsumer("client", "group", logging.getLogger("superstore"), security_protocol="PLAINTEXT")
+        consumer.consumer = FakeKafkaConsumer(polls, [self.tp0, self.tp1])
+        return consumer
+
+    async def test_poll_is_committed_in_one_call(self):
+        consumer = self.make_consumer([{self.tp0: make_records(0, 1, 2), self.tp1: make_records(1, 7)}])
+        handled = []
+
+        async def handler(messages):
+            handled.append([each.offset for each in messages])
+
+        with self.assertRaises(StopConsuming):
+            await consumer.consume_batch("reporting", handler)
+
+        self.assertEqual(handled, [[1, 2], [7]])
+        self.assertEqual(consumer.consumer.commits, [{self.tp0: 3, self.tp1: 8}])
+
+    async def test_failed_batch_is_skipped(self):
+        consumer = self.make_consumer([{self.tp0: make_records(0, 1, 2), self.tp1: make_records(1, 7)}, {self.tp0: make_records(0, 3)}])
+
+        async def handler(messages):
+            if messages[0].offset == 1:
+                raise RuntimeError("snapshot upload failed")
+
+        with self.assertRaises(StopConsuming):
+            await consumer.consume_batch("reporting", handler)
+
+        # committed past the failed batch, like the commit of every message did before
+        self.assertEqual(consumer.consumer.commits, [{self.tp0: 3, self.tp1: 8}, {self.tp0: 4}])
+
+    async def test_failed_commit_is_sent_again(self):
+        consumer = self.make_consumer([{self.tp0: make_records(0, 1, 2)}, {self.tp1: make_records(1, 7)}])
+        consumer.consumer.failing_commits = 1
+
+        async def handler(messages):
+            pass
+
+        with self.assertRaises(StopConsuming):
+            await consumer.consume_batch("reporting", handler)
+
+        self.assertEqual(consumer.consumer.commits, [{self.tp0: 3, self.tp1: 8}])
+
+    async def test_revoked_partition_is_not_committed(self):
+        consumer = self.make_consumer([])
+
+        async def handler(messages):
+            # a rebalance moved tp1 to another consumer while the poll was processed
+            consumer.consumer.assigned.discard(self.tp1)
+
+        await consumer.process_result({self.tp0: make_records(0, 1, 2), self.tp1: make_records(1, 7)}, handler)
+
+        self.assertEqual(consumer.consumer.commits, [{self.tp0: 3}])
+
+    async def test_drain_commits_the_batch_in_flight(self):
+        started = asyncio.Event()
+        release = asyncio.Event()
+        consumer = self.make_consumer([{self.tp0: make_records(0, 1, 2), self.tp1: make_records(1, 7)}, {self.tp0: make_records(0, 3)}])
+
+        async def handler(messages):
+            started.set()
+            await release.wait()
+
+        loop_task = asyncio.create_task(consumer.consume_batch("reporting", handler))
+        await started.wait()
+        drain_task = asyncio.create_task(consumer.drain(timeout=1))
+        await asyncio.sleep(0.01)
+        release.set()
+        await drain_task
+
+        self.assertTrue(loop_task.done())
+        # tp1 was not started after the drain began, its next owner fetches it again
+        self.assertEqual(consumer.consumer.commits, [{self.tp0: 3}])
+        self.assertTrue(consumer.consumer.stopped)
+
+    async def test_drain_while_polling(self):
+        consumer = self.make_consumer([None])
+        loop_task = asyncio.create_task(consumer.consume_batch("reporting", None))
+        await asyncio.sleep(0.01)
+
+        await consumer.drain(timeout=1)
+
+        self.assertTrue(loop_task.done())
+        self.assertEqual(consumer.consumer.commits, [])
+        self.assertTrue(consumer.consumer.stopped)
+
+    async def test_revoked_partitions_are_committed_first(self):
+        consumer = self.make_consumer([{self.tp0: make_records(0, 1, 2), self.tp1: make_records(1, 7)}])
+
+        async def handler(messages):
+            if messages[0].offset == 7:
+                # the commit of the poll fails, a rebalance then revokes both partitions
+                consumer.consumer.failing_commits = 1
+
+        with self.assertRaises(StopConsuming):
+            await consumer.consume_batch("reporting", handler)
+        self.assertEqual(consumer.consumer.commits, [])
+
+        await consumer.consumer.listener.on_partitions_revoked({self.tp0, self.tp1})
+        consumer.consumer.assigned.clear()
+
+        self.assertEqual(consumer.consumer.commits, [{self.tp0: 3, self.tp1: 8}])
+        # nothing is left to commit for the partitions of the next owner
+        self.assertEqual(consumer.offsets.ready(), {})
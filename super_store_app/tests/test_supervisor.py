@@ -0,0 +1,110 @@
+import os
+import time
+import signal
+import tempfile
+import unittest
+from multiprocessing import Process
+from unittest.mock import patch
+from common.aio_utils.supervisor import ProcessSupervisor
+
+
+def exit_now():
+    os._exit(3)
+
+
+def sleep_long():
+    time.sleep(60)
+
+
+def write_pid_and_wait(pid_file: str):
+    with open(pid_file, "w") as f:
+        f.write(str(os.getpid()))
+    time.sleep(60)
+
+
+def supervise(pid_file: str):
+    supervisor = ProcessSupervisor(min_uptime=30, max_backoff=4)
+    supervisor.add("consumer", write_pid_and_wait, pid_file)
+    supervisor.run(stop_timeout=5)
+
+
+def is_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+class TestProcessSupervisor(unittest.TestCase):
+
+    def setUp(self):
+        self.supervisor = ProcessSupervisor(min_uptime=30, max_backoff=4)
+
+    def tearDown(self):
+        self.supervisor.stop(timeout=5)
+
+    def start(self):
+        for child in self.supervisor.children:
+            self.supervisor.start_child(child)
+
+    def test_only_the_dead_child_is_restarted(self):
+        self.supervisor.add("crashing", exit_now)
+        self.supervisor.add("healthy", sleep_long)
+        self.start()
+        crashing, healthy = self.supervisor.children
+        healthy_pid = healthy.process.pid
+        crashing.process.join()
+
+        # died right after its start, restarted after a 1 second backoff
+        self.supervisor.check_children(timeout=0.5)
+        self.assertIsNotNone(crashing.restart_at)
+        self.assertEqual(crashing.restarts, 0)
+        self.supervisor.check_children(timeout=2)
+        self.assertEqual(crashing.restarts, 1)
+        self.assertEqual(healthy.process.pid, healthy_pid)
+        self.assertTrue(healthy.process.is_alive())
+
+    def test_backoff_doubles_for_a_crash_loop(self):
+        self.supervisor.add("crashing", exit_now)
+        self.start()
+        child = self.supervisor.children[0]
+        backoffs = []
+        for _ in range(4):
+            child.process.join()
+            with patch("common.aio_utils.supervisor.time.monotonic", return_value=child.started_at + 0.1):
+                with patch("common.aio_utils.supervisor.time.sleep"):
+                    self.supervisor.check_children(timeout=0)
+            backoffs.append(round(child.restart_at - child.started_at - 0.1, 3))
+            self.supervisor.start_child(child)
+
+        self.assertEqual(backoffs, [1, 2, 4, 4])
+
+    def test_nothing_is_restarted_once_stopping(self):
+        self.supervisor.add("crashing", exit_now)
+        self.start()
+        child = self.supervisor.children[0]
+        child.process.join()
+
+        self.supervisor._request_stop(signal.SIGTERM, None)
+        self.supervisor.check_children(timeout=0)
+
+        self.assertIsNone(child.restart_at)
+        self.assertEqual(child.restarts, 0)
+
+    def test_sigterm_is_forwarded_to_the_children(self):
+        with tempfile.TemporaryDirectory() as directory:
+            pid_file = os.path.join(directory, "child.pid")
+            supervisor_process = Process(target=supervise, args=(pid_file,))
+            supervisor_process.start()
+            deadline = time.monotonic() + 10
+            while not (os.path.exists(pid_file) and os.path.getsize(pid_file)) and time.monotonic() < deadline:
+                time.sleep(0.05)
+            with open(pid_file) as f:
+                child_pid = int(f.read())
+
+            os.kill(supervisor_process.pid, signal.SIGTERM)
+            supervisor_process.join(10)
+
+        self.assertEqual(supervisor_process.exitcode, 0)
+        self.assertFalse(is_running(child_pid))